@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Database benchmark: hot handler queries on a seeded database, before and after
+the index migration. Prints ms/query and whether SQLite scans or searches.
+
+    python bench_db.py --transactions 2000000 --history 2000000
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+import aiosqlite
+
+from server_online import MIGRATIONS, SCHEMA_VERSION, apply_migrations
+
+# (name, sql, params factory) - copied from the handlers that run them
+HOT_QUERIES = [
+    ("wallet transactions",
+     "SELECT type, amount, status, description, created_at FROM transactions WHERE user_id = ? ORDER BY created_at DESC LIMIT 20",
+     lambda r, a: (r.randint(1, a.users),)),
+    ("deposit lookup",
+     "SELECT amount FROM transactions WHERE paypal_order_id = ? AND user_id = ?",
+     lambda r, a: (f"ORDER{r.randrange(a.transactions)}", r.randint(1, a.users))),
+    ("pending withdrawals",
+     """SELECT t.id, t.amount, u.username FROM transactions t JOIN users u ON t.user_id = u.id
+        WHERE t.status = 'pending_approval' AND t.type = 'withdrawal' ORDER BY t.created_at DESC""",
+     lambda r, a: ()),
+    ("admin transactions",
+     "SELECT t.*, u.username FROM transactions t JOIN users u ON t.user_id = u.id ORDER BY t.created_at DESC LIMIT 100",
+     lambda r, a: ()),
+    ("game history",
+     "SELECT game_type, result, chips_change, hand, created_at FROM game_history WHERE user_id = ? ORDER BY created_at DESC LIMIT 50",
+     lambda r, a: (r.randint(1, a.users),)),
+    ("games today",
+     "SELECT COUNT(*) FROM game_history WHERE created_at >= ? AND created_at < ?",
+     lambda r, a: ("2026-01-15", "2026-01-16")),
+    ("friend status",
+     "SELECT status FROM friends WHERE (user_id = ? AND friend_id = ?) OR (user_id = ? AND friend_id = ?)",
+     lambda r, a: (lambda x, y: (x, y, y, x))(r.randint(1, a.users), r.randint(1, a.users))),
+    ("friends list",
+     """SELECT u.id, u.username FROM friends f
+        JOIN users u ON (CASE WHEN f.user_id = ? THEN f.friend_id ELSE f.user_id END) = u.id
+        WHERE (f.user_id = ? OR f.friend_id = ?) AND f.status = 'accepted'""",
+     lambda r, a: (lambda x: (x, x, x))(r.randint(1, a.users))),
+    ("login statistics",
+     "SELECT games_played FROM statistics WHERE user_id = ?",
+     lambda r, a: (r.randint(1, a.users),)),
+    ("leaderboard",
+     "SELECT u.username, s.games_won FROM statistics s JOIN users u ON s.user_id = u.id ORDER BY s.games_won DESC LIMIT 20",
+     lambda r, a: ()),
+]
+
+
+def seed(path, args):
+    rng = random.Random(args.seed)
+    db = sqlite3.connect(path)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=OFF")
+
+    def stamp():
+        return f"2026-01-{rng.randint(1, 28):02d} {rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:00"
+
+    db.executemany("INSERT INTO users (id, email, username, password_hash, security_question, security_answer) VALUES (?, ?, ?, 'x', 1, 'y')",
+                   ((i, f"u{i}@example.com", f"user{i}") for i in range(1, args.users + 1)))
+    db.executemany("INSERT INTO wallets (user_id, balance) VALUES (?, ?)",
+                   ((i, rng.random() * 1000) for i in range(1, args.users + 1)))
+    db.executemany("INSERT INTO statistics (user_id, games_played, games_won) VALUES (?, ?, ?)",
+                   ((i, rng.randint(0, 500), rng.randint(0, 200)) for i in range(1, args.users + 1)))
+    statuses = ["completed"] * 90 + ["pending"] * 9 + ["pending_approval"]
+    db.executemany("INSERT INTO transactions (user_id, type, amount, status, paypal_order_id, description, created_at) VALUES (?, ?, ?, ?, ?, '', ?)",
+                   ((rng.randint(1, args.users), rng.choice(("deposit", "withdrawal")), rng.random() * 100,
+                     rng.choice(statuses), f"ORDER{i}" if i % 2 else None, stamp()) for i in range(args.transactions)))
+    db.executemany("INSERT INTO game_history (user_id, game_type, result, chips_change, created_at) VALUES (?, 'cash', ?, ?, ?)",
+                   ((rng.randint(1, args.users), rng.choice(("win", "loss")), rng.randint(-100, 100), stamp())
+                    for _ in range(args.history)))
+    db.executemany("INSERT OR IGNORE INTO friends (user_id, friend_id, status) VALUES (?, ?, ?)",
+                   ((rng.randint(1, args.users), rng.randint(1, args.users), rng.choice(("accepted", "pending")))
+                    for _ in range(args.friends)))
+    db.commit()
+    db.close()
+
+
+def run_queries(path, args):
+    rng = random.Random(args.seed)
+    db = sqlite3.connect(path)
+    results = {}
+    for name, sql, params in HOT_QUERIES:
+        plan = " | ".join(row[3] for row in db.execute("EXPLAIN QUERY PLAN " + sql, params(rng, args)))
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            db.execute(sql, params(rng, args)).fetchall()
+        results[name] = (1000 * (time.perf_counter() - start) / args.repeat, plan)
+    db.close()
+    return results
+
+
+async def migrate(path, target):
+    async with aiosqlite.connect(path) as db:
+        await apply_migrations(db, target)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--transactions", type=int, default=2_000_000)
+    parser.add_argument("--history", type=int, default=2_000_000)
+    parser.add_argument("--friends", type=int, default=200_000)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    index_version = next(v for v, name, _ in MIGRATIONS if name.startswith("indexes"))
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        asyncio.run(migrate(path, index_version - 1))
+        start = time.perf_counter()
+        seed(path, args)
+        print(f"seeded {args.users} users, {args.transactions} transactions, {args.history} history rows "
+              f"in {time.perf_counter() - start:.1f}s")
+
+        before = run_queries(path, args)
+        start = time.perf_counter()
+        asyncio.run(migrate(path, SCHEMA_VERSION))
+        print(f"index migration took {time.perf_counter() - start:.1f}s")
+        after = run_queries(path, args)
+
+    print(f"{'query':<22}{'before ms':>12}{'after ms':>12}{'speedup':>10}  plan after")
+    for name, _, _ in HOT_QUERIES:
+        b, a = before[name][0], after[name][0]
+        print(f"{name:<22}{b:>12.3f}{a:>12.3f}{b / max(a, 1e-6):>9.0f}x  {after[name][1]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+Hand evaluator benchmark: hands/second for the legacy, lookup and batch paths.
+
+    python bench_evaluator.py --hands 200000
+"""
+
+import argparse
+import random
+import time
+
+from server_online import HandEvaluator, LookupHandEvaluator, np
+
+
+def random_hands(n, size, seed):
+    rng = random.Random(seed)
+    deck = list(range(52))
+    return [rng.sample(deck, size) for _ in range(n)]
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--hands", type=int, default=200_000)
+    parser.add_argument("--cards", type=int, default=7, choices=(5, 6, 7))
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    hands = random_hands(args.hands, args.cards, args.seed)
+    LookupHandEvaluator.build_tables()
+    rows = []
+
+    legacy, elapsed = timed(lambda: [HandEvaluator.evaluate_legacy(h, [])[0] for h in hands])
+    rows.append(("legacy scalar", elapsed))
+
+    lookup, elapsed = timed(lambda: [LookupHandEvaluator.evaluate(h, [])[0] for h in hands])
+    rows.append(("lookup scalar", elapsed))
+    assert lookup == legacy, "lookup evaluator disagrees with legacy"
+
+    if np is not None:
+        array = np.array(hands, dtype=np.intp)
+        LookupHandEvaluator.evaluate_batch(array[:1]) # build numpy tables outside the timing
+        batch, elapsed = timed(lambda: LookupHandEvaluator.evaluate_batch(array))
+        rows.append(("numpy batch", elapsed))
+        assert batch.tolist() == legacy, "batch evaluator disagrees with legacy"
+    else:
+        print("numpy not installed: skipping batch evaluation")
+
+    print(f"{args.hands} random {args.cards}-card hands")
+    for name, elapsed in rows:
+        print(f"  {name:<14} {args.hands / elapsed:>14,.0f} hands/s  ({elapsed * 1e6 / args.hands:.2f} us/hand)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Login burst benchmark: fires logins at a fixed rate against a temporary
+database and reports login latency and event-loop lag while the burst runs.
+
+    python bench_login.py --rate 500 --seconds 2
+    python bench_login.py --inline     # hash on the event loop, for comparison
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+from server_online import DatabasePool, PasswordHasher, PokerServer
+
+
+class FakeSocket:
+    async def send(self, data, **kwargs):
+        pass
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+async def monitor_loop(lags, stop, interval=0.005):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lags.append(loop.time() - start - interval)
+
+
+async def bench(args, path):
+    server = PokerServer()
+    server.db_path = path
+    server.db = DatabasePool(path)
+    if args.workers:
+        server.passwords = PasswordHasher(args.workers)
+    if args.inline:
+        async def inline(fn, *fn_args):
+            return fn(*fn_args)
+        server.passwords._run = inline
+    await server.init_db()
+
+    # One real hash reused for every account keeps seeding fast
+    stored = PasswordHasher.hash_sync("secret123")
+    async with server.db.write() as db:
+        await db.executemany(
+            "INSERT INTO users (email, username, password_hash, security_question, security_answer) VALUES (?, ?, ?, 1, 'y')",
+            [(f"u{i}@example.com", f"user{i}", stored) for i in range(args.users)])
+        await db.commit()
+
+    latencies, lags, stop = [], [], asyncio.Event()
+    monitor = asyncio.ensure_future(monitor_loop(lags, stop))
+
+    async def login(i):
+        start = time.perf_counter()
+        result = await server.handle_login(FakeSocket(), {"email": f"u{i % args.users}@example.com", "password": "secret123"})
+        assert result["success"], result
+        latencies.append(time.perf_counter() - start)
+
+    total = int(args.rate * args.seconds)
+    tasks = []
+    start = time.perf_counter()
+    for i in range(total):
+        # Open-loop arrivals: do not wait for earlier logins
+        delay = start + i / args.rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.ensure_future(login(i)))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await monitor
+    await server.db.close()
+    server.passwords.shutdown()
+    return total, elapsed, latencies, lags
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rate", type=float, default=500, help="logins per second")
+    parser.add_argument("--seconds", type=float, default=2)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=0, help="KDF threads (default: PasswordHasher default)")
+    parser.add_argument("--inline", action="store_true", help="run the KDF on the event loop")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        total, elapsed, latencies, lags = asyncio.run(bench(args, os.path.join(tmp, "bench.db")))
+
+    print(f"{total} logins in {elapsed:.2f}s ({total / elapsed:.0f}/s), KDF {'inline' if args.inline else 'in pool'}")
+    print(f"login latency ms  p50 {1000 * statistics.median(latencies):.1f}  "
+          f"p99 {1000 * percentile(latencies, 0.99):.1f}  max {1000 * max(latencies):.1f}")
+    print(f"event loop lag ms p50 {1000 * statistics.median(lags):.2f}  "
+          f"p99 {1000 * percentile(lags, 0.99):.2f}  max {1000 * max(lags):.2f}")
+
+
+if __name__ == "__main__":
+    main()
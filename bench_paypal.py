@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+PayPal load test against the local stub: concurrent deposit flows
+(create, get, capture) through one PayPalClient.
+
+    python bench_paypal.py --flows 2000 --concurrency 100 --latency 0.02 --fail-rate 0.02
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+
+from aiohttp import web
+
+from paypal_stub import make_app
+from server_online import PayPalClient
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+async def bench(args):
+    app = make_app(args.latency, args.fail_rate, seed=args.seed)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    client = PayPalClient(api_base=f"http://127.0.0.1:{port}", client_id="bench", secret="bench")
+    latencies, failures = [], 0
+    limit = asyncio.Semaphore(args.concurrency)
+
+    async def flow():
+        nonlocal failures
+        async with limit:
+            start = time.perf_counter()
+            try:
+                order = await client.create_order(10.0)
+                await client.get_order(order["id"])
+                capture = await client.capture_order(order["id"])
+                if capture.get("status") != "COMPLETED":
+                    failures += 1
+            except Exception:
+                failures += 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(flow() for _ in range(args.flows)))
+    elapsed = time.perf_counter() - start
+    await client.close()
+    await runner.cleanup()
+    return elapsed, latencies, failures, client.stats, app["stats"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--flows", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    elapsed, latencies, failures, client_stats, stub_stats = asyncio.run(bench(args))
+    print(f"{args.flows} deposit flows in {elapsed:.2f}s ({args.flows / elapsed:.0f}/s), {failures} failed")
+    print(f"flow latency ms p50 {1000 * statistics.median(latencies):.1f}  p99 {1000 * percentile(latencies, 0.99):.1f}")
+    print(f"client: {client_stats}")
+    print(f"stub:   {stub_stats}")
+
+
+if __name__ == "__main__":
+    main()
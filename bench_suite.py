@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite: the hot engine, serialization and database paths, offline,
+compared against a JSON baseline. Exits with status 1 when a benchmark is
+slower than its baseline by more than --threshold.
+
+    python bench_suite.py --save                 # record bench_baseline.json on this machine
+    python bench_suite.py                        # compare with it
+    python bench_suite.py --only broadcast,sql   # a subset (substring match)
+
+Timings are the best of --repeat short samples, in microseconds per operation;
+apparent regressions are measured again (--retries) before they fail the run.
+Baselines are only comparable on the machine that recorded them.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import timeit
+
+import bench_db
+from server_online import BinaryProtocol, Deck, HandEvaluator, LookupHandEvaluator, PokerServer, PokerTable, apply_migrations
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+TABLE_SIZES = (2, 6, 9)
+
+# name -> setup(args) returning {benchmark name: (op, operations per call)}
+SUITES = {}
+RESOURCES = contextlib.ExitStack() # event loops, databases: closed when the run ends
+
+def suite(name):
+    def register(setup):
+        SUITES[name] = setup
+        return setup
+    return register
+
+
+class FakeSocket:
+    backlog = 0
+
+    async def send(self, data, **kwargs):
+        pass
+
+    def send_nowait(self, data, **kwargs):
+        pass
+
+
+def seated_table(players, seed=1):
+    table = PokerTable(f"bench{players}", f"Bench {players}", 1, 2, 10, 1000, max_players=max(players, 6),
+                       rng=random.Random(seed))
+    for uid in range(1, players + 1):
+        table.add_player(uid, f"player{uid}", 500.0)
+    table.handle_action(table.current_player, "call")
+    return table
+
+
+@suite("evaluator")
+def evaluator_suite(args):
+    LookupHandEvaluator.build_tables()
+    rng = random.Random(args.seed)
+    hands = [rng.sample(range(52), 7) for _ in range(1000)]
+    split = [(h[:2], h[2:]) for h in hands]
+    evaluate = HandEvaluator.evaluate
+
+    def run():
+        for hole, board in split:
+            evaluate(hole, board)
+    return {"evaluate 7 cards": (run, len(split))}
+
+
+@suite("deck")
+def deck_suite(args):
+    random.seed(args.seed)
+    deck = Deck()
+
+    def deal_hand():
+        deck.shuffle()
+        for _ in range(6):
+            deck.deal(2)
+        deck.deal(3), deck.deal(1), deck.deal(1)
+    return {"deck create": (Deck, 1), "deck shuffle + deal 6 players": (deal_hand, 1)}
+
+
+@suite("state")
+def state_suite(args):
+    benchmarks = {}
+    for players in TABLE_SIZES:
+        table = seated_table(players, args.seed)
+        benchmarks[f"get_state {players} players"] = (lambda t=table: t.get_state(1), 1)
+        state = table.get_state(1)
+        benchmarks[f"json.dumps state {players} players"] = (lambda s=state: json.dumps(s), 1)
+        benchmarks[f"binary state {players} players"] = (lambda s=state: BinaryProtocol.encode_table_update(s), 1)
+    return benchmarks
+
+
+@suite("broadcast")
+def broadcast_suite(args):
+    loop = asyncio.new_event_loop()
+    RESOURCES.callback(loop.close)
+    with contextlib.redirect_stdout(io.StringIO()):
+        server = PokerServer()
+    benchmarks = {}
+    batch = 100
+    for players in TABLE_SIZES:
+        table = seated_table(players, args.seed)
+        server.tables[table.table_id] = table
+        for uid in table.players:
+            ws = FakeSocket()
+            server.connections[ws] = uid
+            server.user_connections[uid] = ws
+
+        async def fan_out(table_id=table.table_id):
+            for _ in range(batch):
+                await server.broadcast_table_state(table_id)
+        benchmarks[f"broadcast {players} players"] = (lambda f=fan_out: loop.run_until_complete(f()), batch)
+    return benchmarks
+
+
+@suite("dispatch")
+def dispatch_suite(args):
+    # handle_message end to end (parse, dispatch, handler, encode, queue), without a database
+    loop = asyncio.new_event_loop()
+    RESOURCES.callback(loop.close)
+    with contextlib.redirect_stdout(io.StringIO()):
+        server = PokerServer()
+    table = seated_table(6, args.seed)
+    server.tables[table.table_id] = table
+    waiting = next(uid for uid in table.players if uid != table.current_player)
+    ws = FakeSocket()
+    server.connections[ws] = waiting
+    server.user_tables[waiting] = table.table_id
+    batch = 100
+    messages = {"ping": '{"action": "ping"}',
+                "rejected action": '{"action": "call", "amount": 0}', # not their turn
+                "unknown action": '{"action": "dance"}'}
+    benchmarks = {}
+    for name, message in messages.items():
+        async def send(message=message):
+            for _ in range(batch):
+                await server.handle_message(ws, message)
+        benchmarks[f"handle_message {name}"] = (lambda f=send: loop.run_until_complete(f()), batch)
+    return benchmarks
+
+
+@suite("lobby")
+def lobby_suite(args):
+    # One poll of both lobby lists against one tick with a single table changed
+    with contextlib.redirect_stdout(io.StringIO()):
+        server = PokerServer()
+    for i in range(200):
+        table = PokerTable(f"private_{i}", f"Private {i}", 0.1, 0.2, 5.0, 5.0)
+        table.is_private = True
+        server.tables[table.table_id] = table
+    server.lobby.subscribers.add(FakeSocket())
+    server.lobby_tick()
+    table = server.tables["private_0"]
+
+    def tick():
+        if table.players: # a player comes or goes: one row changes
+            table.players.clear()
+        else:
+            table.players[1] = {}
+        server.lobby.touch(table.table_id)
+        server.lobby_tick()
+    return {"lobby poll 205 tables": (lambda: (server._cash_table_info(), server._friend_game_info()), 1),
+            "lobby tick 1 change 205 tables": (tick, 1)}
+
+
+@suite("sql")
+def sql_suite(args):
+    path = os.path.join(RESOURCES.enter_context(tempfile.TemporaryDirectory()), "bench.db")
+
+    async def migrate():
+        import aiosqlite
+        async with aiosqlite.connect(path) as db:
+            await apply_migrations(db)
+    with contextlib.redirect_stdout(io.StringIO()):
+        asyncio.run(migrate())
+    seed_args = argparse.Namespace(users=args.users, transactions=args.users * 10, history=args.users * 10,
+                                   friends=args.users, seed=args.seed)
+    bench_db.seed(path, seed_args)
+    db = sqlite3.connect(path)
+    RESOURCES.callback(db.close)
+    db.execute("ANALYZE")
+    rng = random.Random(args.seed)
+    user_ids = [rng.randint(1, args.users) for _ in range(1000)]
+    cursor = iter(())
+
+    def next_user():
+        nonlocal cursor
+        for uid in cursor:
+            return uid
+        cursor = iter(user_ids)
+        return next(cursor)
+
+    # The statements below are the ones the handlers run
+    def wallet():
+        uid = next_user()
+        db.execute("SELECT balance, total_deposited, total_withdrawn FROM wallets WHERE user_id = ?", (uid,)).fetchone()
+        db.execute("""SELECT type, amount, status, description, created_at
+                      FROM transactions WHERE user_id = ?
+                      ORDER BY created_at DESC LIMIT 20""", (uid,)).fetchall()
+
+    def transactions():
+        db.execute("""SELECT type, amount, status, description, created_at
+                      FROM transactions WHERE user_id = ?
+                      ORDER BY created_at DESC LIMIT 50""", (next_user(),)).fetchall()
+
+    def leaderboard_chips():
+        db.execute("""SELECT u.username, w.balance as score, u.level
+                      FROM wallets w JOIN users u ON w.user_id = u.id
+                      ORDER BY w.balance DESC LIMIT 20""").fetchall()
+
+    def leaderboard_winnings():
+        db.execute("""SELECT u.username, s.games_won as score, u.level
+                      FROM statistics s JOIN users u ON s.user_id = u.id
+                      ORDER BY s.games_won DESC LIMIT 20""").fetchall()
+
+    return {"sql wallet": (wallet, 1), "sql transactions": (transactions, 1),
+            "sql leaderboard chips": (leaderboard_chips, 1), "sql leaderboard winnings": (leaderboard_winnings, 1)}
+
+
+def measure(op, per_call, repeat, sample=0.01):
+    # Many short samples, keep the best: a burst of noise spoils a few samples, not the minimum
+    timer = timeit.Timer(op)
+    number = 1
+    while timer.timeit(number) < sample:
+        number *= 2
+    return 1e6 * min(timer.repeat(repeat, number)) / number / per_call
+
+
+def run(args):
+    """Returns {benchmark: microseconds per operation}.
+
+    Each --only part selects the suites whose name contains it or, when it
+    names no suite, the benchmarks whose name contains it."""
+    only = args.only or []
+    suites = [part for part in only if any(part in name for name in SUITES)]
+    benches = [part for part in only if part not in suites]
+    results, ops = {}, {}
+    for name, setup in SUITES.items():
+        whole = not only or any(part in name for part in suites)
+        if not whole and not benches:
+            continue
+        for bench, (op, per_call) in setup(args).items():
+            if not whole and not any(part in bench for part in benches):
+                continue
+            ops[bench] = (op, per_call)
+            results[bench] = measure(op, per_call, args.repeat)
+            print(f"  {bench:<36}{results[bench]:>12.2f} us", file=sys.stderr)
+    return results, ops
+
+
+def compare(baseline, results, threshold):
+    """Returns (rows, regressions); a row is (name, baseline us or None, current us, ratio or None)."""
+    rows, regressions = [], []
+    for name, current in results.items():
+        before = baseline.get(name)
+        ratio = current / before if before else None
+        rows.append((name, before, current, ratio))
+        if ratio is not None and ratio > 1 + threshold:
+            regressions.append(name)
+    return rows, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save", action="store_true", help="write the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed slowdown (0.25 = 25%%)")
+    parser.add_argument("--only", type=lambda s: s.split(","), default=None, help="comma separated substrings")
+    parser.add_argument("--repeat", type=int, default=20, help="samples per benchmark (~10ms each)")
+    parser.add_argument("--retries", type=int, default=3, help="re-measure apparent regressions (or, with --save, everything) N times")
+    parser.add_argument("--users", type=int, default=20_000, help="seeded users (x10 transactions and history rows)")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    with RESOURCES:
+        results, ops = run(args)
+        if not results:
+            parser.error("no benchmark matches --only")
+        baseline = None
+        if args.save:
+            # The baseline is the best of several passes, not one that hit a slow patch
+            for attempt in range(args.retries):
+                for bench in results:
+                    results[bench] = min(results[bench], measure(*ops[bench], args.repeat))
+        else:
+            if not os.path.exists(args.baseline):
+                raise SystemExit(f"no baseline at {args.baseline}: record one with --save")
+            with open(args.baseline) as f:
+                recorded = json.load(f)
+            baseline = recorded["results"]
+            # A slowdown has to survive re-measuring: shared machines have slow seconds
+            for attempt in range(args.retries):
+                _, suspects = compare(baseline, results, args.threshold)
+                for bench in suspects:
+                    results[bench] = min(results[bench], measure(*ops[bench], args.repeat))
+                    print(f"  {bench:<36}{results[bench]:>12.2f} us (re-measured)", file=sys.stderr)
+
+    if args.save:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f).get("results", {})
+        baseline.update(results) # --only refreshes just those entries
+        with open(args.baseline, "w") as f:
+            json.dump({"machine": f"{platform.node()} {platform.machine()} {platform.python_implementation()} "
+                                  f"{platform.python_version()}",
+                       "recorded": time.strftime("%Y-%m-%d %H:%M:%S"),
+                       "unit": "us/op",
+                       "results": dict(sorted(baseline.items()))}, f, indent=2)
+            f.write("\n")
+        print(f"baseline saved to {args.baseline} ({len(results)} benchmarks)")
+        return
+
+    rows, regressions = compare(baseline, results, args.threshold)
+    print(f"baseline: {recorded.get('machine', '?')}, {recorded.get('recorded', '?')}")
+    print(f"{'benchmark':<36}{'baseline us':>13}{'now us':>11}{'change':>9}")
+    for name, before, current, ratio in rows:
+        change = f"{100 * (ratio - 1):+.0f}%" if ratio is not None else "new"
+        flag = "  REGRESSION" if name in regressions else ""
+        print(f"{name:<36}{before if before is not None else float('nan'):>13.2f}{current:>11.2f}{change:>9}{flag}")
+    if regressions:
+        raise SystemExit(f"{len(regressions)} benchmark(s) slower than the baseline by more than "
+                         f"{100 * args.threshold:.0f}%: {', '.join(regressions)}")
+    print(f"no regressions over {100 * args.threshold:.0f}%")
+
+
+if __name__ == "__main__":
+    main()
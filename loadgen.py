@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+"""
+Load generator: simulated players speaking the real WebSocket protocol.
+
+Each bot registers, logs in, deposits through PayPal (use the stub), buys in at
+a cash table or a private game, plays with the chosen strategy and chats.
+Cash seats are filled first; the remaining bots are grouped into private games
+created by one bot of each group.
+
+    python loadgen.py --spawn --bots 200 --duration 60
+    python loadgen.py --url ws://127.0.0.1:8765/ws --bots 1000 --ramp 30
+
+--spawn starts paypal_stub.py and server_online.py (with a throwaway HOME, so
+a fresh database) as subprocesses. Registration and login run the password
+KDF, so large bot counts need a matching --ramp.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+import aiohttp
+
+STRATEGIES = {
+    # (fold, check/call, raise) weights when facing a bet
+    "passive": (0.0, 1.0, 0.0),
+    "random": (0.15, 0.65, 0.2),
+    "aggressive": (0.05, 0.45, 0.5),
+}
+
+
+class Stats:
+    def __init__(self):
+        self.rtt = defaultdict(list) # request action -> seconds
+        self.errors = defaultdict(int) # request action -> failures
+        self.error_samples = {} # request action -> first error message
+        self.events = defaultdict(int) # pushed message type -> count
+        self.hands = 0
+
+    def report(self, elapsed):
+        total = sum(len(v) for v in self.rtt.values())
+        errors = sum(self.errors.values())
+        print(f"\n{total} requests in {elapsed:.1f}s ({total / elapsed:.0f}/s), "
+              f"{errors} errors ({100 * errors / max(total, 1):.2f}%), {self.hands} hands seen")
+        print(f"{'request':<22}{'count':>8}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+        for action in sorted(self.rtt, key=lambda a: -len(self.rtt[a])):
+            values = sorted(self.rtt[action])
+            pick = lambda q: 1000 * values[min(len(values) - 1, int(q * len(values)))]
+            print(f"{action:<22}{len(values):>8}{self.errors[action]:>8}"
+                  f"{1000 * statistics.median(values):>10.1f}{pick(0.95):>10.1f}{pick(0.99):>10.1f}")
+        for action, error in self.error_samples.items():
+            print(f"first {action} error: {error}")
+        print("pushed:", dict(self.events))
+
+
+class Bot:
+    # Response type(s) for each request; replies on one socket arrive in order
+    RESPONSES = {
+        "register": ("register_result",),
+        "login": ("login_result",),
+        "create_deposit": ("wallet_deposit_result",),
+        "verify_deposit": ("capture_deposit_result",),
+        "get_cash_tables": ("cash_tables_response",),
+        "join_cash_table": ("cash_table_joined", "join_table_response"),
+        "create_private_game": ("friend_game_created",),
+        "join_private_game": ("friend_game_joined",),
+        "chat_message": ("chat_sent",),
+        "leave_table": ("leave_table_response",),
+    }
+    GAME_ACTIONS = ("check", "call", "raise", "fold")
+
+    def __init__(self, index, args, stats, session):
+        self.index = index
+        self.args = args
+        self.stats = stats
+        self.session = session
+        self.rng = random.Random(args.seed * 100003 + index)
+        self.weights = STRATEGIES[args.strategy]
+        self.ws = None
+        self.user_id = None
+        self.table_id = None
+        self.pending = [] # FIFO of (expected types, future)
+        self.acted_on = None # seq of the state last acted on
+        self.acting = False
+        self.leaving = False
+        self.latest = {}
+        self.last_phase = None
+
+    async def request(self, action, timeout=30.0, **fields):
+        expected = ("action_result",) if action in self.GAME_ACTIONS else self.RESPONSES[action]
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((expected, future))
+        start = time.perf_counter()
+        try:
+            await self.ws.send_str(json.dumps({"action": action, **fields}))
+            reply = await asyncio.wait_for(future, timeout)
+        except Exception as e:
+            reply = {"type": "error", "error": repr(e)}
+        self.stats.rtt[action].append(time.perf_counter() - start)
+        if reply.get("type") == "error" or reply.get("success") is False:
+            self.stats.errors[action] += 1
+            self.stats.error_samples.setdefault(action, reply.get("error") or reply.get("message"))
+        return reply
+
+    async def reader(self):
+        async for msg in self.ws:
+            if msg.type != aiohttp.WSMsgType.TEXT:
+                continue
+            data = json.loads(msg.data)
+            kind = data.get("type")
+            if self.pending and (kind in self.pending[0][0] or kind == "error"):
+                _, future = self.pending.pop(0)
+                if not future.done():
+                    future.set_result(data)
+                if "table_state" in data:
+                    self.on_table_state(data["table_state"])
+                continue
+            self.stats.events[kind] += 1
+            if kind == "table_update":
+                self.on_table_state(data["table_state"])
+        for _, future in self.pending:
+            if not future.done():
+                future.set_exception(ConnectionError("socket closed"))
+
+    def on_table_state(self, state):
+        phase = state.get("game_phase")
+        if phase == "showdown" and self.last_phase != "showdown" and self.index % self.args.table_size == 0:
+            self.stats.hands += 1 # counted once per table, by its first bot
+        self.last_phase = phase
+        self.latest = state
+        if not self.acting and self.my_turn(state):
+            self.acting = True
+            asyncio.ensure_future(self.act())
+
+    def my_turn(self, state):
+        return (not self.leaving and state.get("current_player") == self.user_id and state.get("game_phase") not in ("waiting", "showdown")
+                and state.get("seq") != self.acted_on)
+
+    async def act(self):
+        # One action in flight; states that arrive meanwhile (joins, chat) only refresh self.latest
+        try:
+            while self.my_turn(self.latest):
+                await asyncio.sleep(self.rng.uniform(0, 2 * self.args.think))
+                state = self.latest
+                if not self.my_turn(state):
+                    break
+                self.acted_on = state.get("seq")
+                me = next((p for p in state["players"] if p["user_id"] == self.user_id), None)
+                if me is None:
+                    break
+                to_call = state["current_bet"] - me["current_bet"]
+                fold, call, raise_ = self.weights
+                choice = self.rng.choices(("fold", "call", "raise"), (fold if to_call > 0 else 0, call, raise_))[0]
+                target = max(state["current_bet"] * 2, state["big_blind"])
+                if choice == "raise" and target - me["current_bet"] <= me["chips"]:
+                    await self.request("raise", amount=round(target, 2))
+                else:
+                    await self.request("fold" if choice == "fold" else ("call" if to_call > 0 else "check"))
+        finally:
+            self.acting = False
+
+    async def run(self, seat, private_ready, deadline):
+        self.ws = await self.session.ws_connect(self.args.url, heartbeat=30)
+        hello = await self.ws.receive_json()
+        assert hello.get("type") == "connected", hello
+        reader = asyncio.ensure_future(self.reader())
+        try:
+            name = f"lg{self.args.run_id}x{self.index}"
+            email = f"{name}@load.test"
+            await self.request("register", email=email, username=name, password="loadtest1",
+                               security_question="pet", security_answer="bot")
+            login = await self.request("login", email=email, password="loadtest1")
+            if not login.get("success"):
+                return
+            self.user_id = login["user_id"]
+
+            order = await self.request("create_deposit", amount=100)
+            if order.get("success"):
+                await self.request("verify_deposit", order_id=order["order_id"])
+
+            kind, target = seat
+            if kind == "cash":
+                tables = await self.request("get_cash_tables")
+                info = next(t for t in tables["tables"] if t["table_id"] == target)
+                joined = await self.request("join_cash_table", table_id=target, buy_in=info["min_buy_in"] * 2)
+            else:
+                if self.index % self.args.table_size == 0:
+                    await self.request("create_private_game", game_name=target, password="loadtest",
+                                       max_players=self.args.table_size)
+                    private_ready[target].set()
+                await private_ready[target].wait()
+                joined = await self.request("join_private_game", game_name=target, password="loadtest", buy_in=20)
+            if not joined.get("success"):
+                return
+            self.table_id = joined["table_id"]
+
+            while time.monotonic() < deadline:
+                await asyncio.sleep(min(deadline - time.monotonic(), self.rng.expovariate(1 / self.args.chat_interval)))
+                if time.monotonic() < deadline:
+                    await self.request("chat_message", table_id=self.table_id, message=f"gg {self.rng.randint(1, 99)}")
+            self.leaving = True
+            while self.acting:
+                await asyncio.sleep(0.05)
+            await self.request("leave_table")
+        finally:
+            await self.ws.close()
+            await reader
+
+
+def seats(args, cash_seats=30):
+    """Cash table seats first (5 default tables x 6), then private games."""
+    cash_ids = ["table_micro", "table_low", "table_medium", "table_high", "table_vip"]
+    out = []
+    for i in range(args.bots):
+        group = i // args.table_size
+        if args.cash and i < cash_seats and group < len(cash_ids) and args.table_size <= 6:
+            out.append(("cash", cash_ids[group]))
+        else:
+            out.append(("private", f"lg{args.run_id}g{group}"))
+    return out
+
+
+async def run_bots(args):
+    stats = Stats()
+    connector = aiohttp.TCPConnector(limit=0)
+    plan = seats(args)
+    private_ready = defaultdict(asyncio.Event)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        start = time.perf_counter()
+        deadline = time.monotonic() + args.ramp + args.duration
+        tasks = []
+        for i in range(args.bots):
+            bot = Bot(i, args, stats, session)
+            tasks.append(asyncio.ensure_future(bot.run(plan[i], private_ready, deadline)))
+            if args.ramp:
+                await asyncio.sleep(args.ramp / args.bots)
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        elapsed = time.perf_counter() - start
+    failed = [r for r in results if isinstance(r, Exception)]
+    if failed:
+        print(f"{len(failed)} bots crashed, first: {failed[0]!r}")
+    stats.report(elapsed)
+    return stats
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def wait_for_port(port, timeout=60):
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.2)
+    raise TimeoutError(f"nothing listening on {port}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="ws://127.0.0.1:8765/ws")
+    parser.add_argument("--spawn", action="store_true", help="start a local server and PayPal stub")
+    parser.add_argument("--bots", type=int, default=100)
+    parser.add_argument("--table-size", type=int, default=6)
+    parser.add_argument("--no-cash", dest="cash", action="store_false", help="only private games")
+    parser.add_argument("--strategy", choices=sorted(STRATEGIES), default="random")
+    parser.add_argument("--duration", type=float, default=60, help="seconds of play after the ramp")
+    parser.add_argument("--ramp", type=float, default=10, help="seconds over which bots connect")
+    parser.add_argument("--think", type=float, default=0.3, help="mean think time per action")
+    parser.add_argument("--chat-interval", type=float, default=20, help="mean seconds between chat messages")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    args.run_id = f"{int(time.time()) % 100000}"
+
+    procs = []
+    try:
+        if args.spawn:
+            here = os.path.dirname(os.path.abspath(__file__))
+            stub_port, server_port = free_port(), free_port()
+            home = tempfile.mkdtemp(prefix="loadgen-")
+            env = dict(os.environ, HOME=home, PORT=str(server_port),
+                       PAYPAL_API_BASE=f"http://127.0.0.1:{stub_port}")
+            procs.append(subprocess.Popen([sys.executable, os.path.join(here, "paypal_stub.py"), "--port", str(stub_port)],
+                                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+            procs.append(subprocess.Popen([sys.executable, os.path.join(here, "server_online.py")], env=env, cwd=home,
+                                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+            asyncio.run(wait_for_port(stub_port))
+            asyncio.run(wait_for_port(server_port))
+            args.url = f"ws://127.0.0.1:{server_port}/ws"
+            print(f"spawned server on {server_port} (HOME={home}), PayPal stub on {stub_port}")
+        asyncio.run(run_bots(args))
+    finally:
+        for proc in procs:
+            proc.terminate()
+            proc.wait()
+
+
+if __name__ == "__main__":
+    main()
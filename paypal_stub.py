@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Local PayPal stub: the REST endpoints used by PayPalClient, for offline
+development and load tests. Orders are approved as soon as they are created.
+
+    python paypal_stub.py --port 8766 --latency 0.05 --fail-rate 0.05
+    PAYPAL_API_BASE=http://127.0.0.1:8766 python server_online.py
+
+GET /stub/stats returns request counters.
+"""
+
+import argparse
+import asyncio
+import random
+import uuid
+
+from aiohttp import web
+
+
+def make_app(latency: float = 0.0, fail_rate: float = 0.0, token_ttl: int = 32400, seed: int = None):
+    rng = random.Random(seed)
+    orders = {}
+    seen_requests = {} # PayPal-Request-Id -> response, like PayPal's idempotency
+    stats = {"token": 0, "create_order": 0, "get_order": 0, "capture": 0, "payout": 0,
+             "injected_failures": 0, "replayed": 0}
+
+    @web.middleware
+    async def chaos(request, handler):
+        if latency:
+            await asyncio.sleep(latency)
+        if fail_rate and not request.path.startswith("/stub") and rng.random() < fail_rate:
+            stats["injected_failures"] += 1
+            return web.json_response({"name": "INTERNAL_SERVICE_ERROR"}, status=503)
+        request_id = request.headers.get("PayPal-Request-Id")
+        if request_id and request_id in seen_requests:
+            stats["replayed"] += 1
+            status, body = seen_requests[request_id]
+            return web.json_response(body, status=status)
+        status, body = await handler(request)
+        if request_id and status < 300:
+            seen_requests[request_id] = (status, body)
+        return web.json_response(body, status=status)
+
+    # Handlers return (status, body); the middleware builds the response
+    def json_response(body, status=200):
+        return status, body
+
+    def authorized(request):
+        return request.headers.get("Authorization", "").startswith("Bearer stub-")
+
+    async def token(request):
+        stats["token"] += 1
+        if request.headers.get("Authorization", "").startswith("Basic "):
+            return json_response({"access_token": f"stub-{uuid.uuid4().hex}", "token_type": "Bearer",
+                                  "expires_in": token_ttl})
+        return json_response({"error": "invalid_client"}, status=401)
+
+    async def create_order(request):
+        if not authorized(request):
+            return json_response({"name": "AUTHENTICATION_FAILURE"}, status=401)
+        stats["create_order"] += 1
+        body = await request.json()
+        order_id = uuid.uuid4().hex[:17].upper()
+        orders[order_id] = {"id": order_id, "status": "APPROVED", "purchase_units": body.get("purchase_units", [])}
+        return json_response({
+            "id": order_id,
+            "status": "CREATED",
+            "links": [{"rel": "approve", "href": f"http://stub.local/checkoutnow?token={order_id}"}],
+        }, status=201)
+
+    async def get_order(request):
+        if not authorized(request):
+            return json_response({"name": "AUTHENTICATION_FAILURE"}, status=401)
+        stats["get_order"] += 1
+        order = orders.get(request.match_info["order_id"])
+        if order is None:
+            return json_response({"name": "RESOURCE_NOT_FOUND"}, status=404)
+        return json_response(order)
+
+    async def capture(request):
+        if not authorized(request):
+            return json_response({"name": "AUTHENTICATION_FAILURE"}, status=401)
+        stats["capture"] += 1
+        order = orders.get(request.match_info["order_id"])
+        if order is None:
+            return json_response({"name": "RESOURCE_NOT_FOUND"}, status=404)
+        if order["status"] == "COMPLETED":
+            return json_response({"name": "UNPROCESSABLE_ENTITY", "details": [{"issue": "ORDER_ALREADY_CAPTURED"}]}, status=422)
+        order["status"] = "COMPLETED"
+        return json_response({"id": order["id"], "status": "COMPLETED"}, status=201)
+
+    async def payout(request):
+        if not authorized(request):
+            return json_response({"name": "AUTHENTICATION_FAILURE"}, status=401)
+        stats["payout"] += 1
+        body = await request.json()
+        return json_response({"batch_header": {
+            "payout_batch_id": uuid.uuid4().hex[:13].upper(),
+            "batch_status": "PENDING",
+            "sender_batch_header": body.get("sender_batch_header", {}),
+        }}, status=201)
+
+    async def get_stats(request):
+        return json_response(stats)
+
+    app = web.Application(middlewares=[chaos])
+    app.router.add_post("/v1/oauth2/token", token)
+    app.router.add_post("/v2/checkout/orders", create_order)
+    app.router.add_get("/v2/checkout/orders/{order_id}", get_order)
+    app.router.add_post("/v2/checkout/orders/{order_id}/capture", capture)
+    app.router.add_post("/v1/payments/payouts", payout)
+    app.router.add_get("/stub/stats", get_stats)
+    app["stats"] = stats
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="fraction of calls answered with 503")
+    parser.add_argument("--token-ttl", type=int, default=32400)
+    args = parser.parse_args()
+    web.run_app(make_app(args.latency, args.fail_rate, args.token_ttl), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,11 +8,27 @@ Poker Texas Hold'em Server v14 - Admin Power Update
 """
 
 import asyncio
+import base64
+import bisect
+import contextlib
+import contextvars
 import json
 import hashlib
+import hmac
+import itertools
+import math
+import mmap
+import multiprocessing
 import os
+import pickle
+import struct
+import threading
 import time
+import uuid
 import random
+import re
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timedelta
 import aiohttp
 from aiohttp import web, WSMsgType
@@ -20,6 +36,11 @@ import aiosqlite
 import websockets
 from websockets.exceptions import ConnectionClosed
 
+try:
+    import numpy as np # Optional: only needed for batch evaluation
+except ImportError:
+    np = None
+
 # ==========================================
 # CONFIGURATION
 # ==========================================
@@ -27,7 +48,12 @@ from websockets.exceptions import ConnectionClosed
 SERVER_CONFIG = {
     "maintenance_mode": False,
     "turn_timer": 30, # seconds
-    "rake_percentage": 0.0 # Future use
+    "rake_percentage": 0.0, # Future use
+    "hand_evaluator": "lookup", # lookup (precomputed tables) or legacy
+    "ws_compression": True, # offer permessage-deflate to new connections
+    "ws_compress_min_bytes": 1024, # smaller messages go out uncompressed
+    "lobby_interval_ms": 500, # lobby subscribers get at most one update per interval
+    "admin_feed_interval_ms": 1000 # admin panels get at most one update per interval
 }
 
 # PERSISTENT CONFIG PATH
@@ -51,54 +77,554 @@ def save_config():
 
 load_config()
 
+# ==========================================
+# JSON CODEC
+# ==========================================
+
+try:
+    import orjson # optional: several times faster, and encodes straight to bytes
+except ImportError:
+    orjson = None
+
+class StdlibJson:
+    name = "json"
+
+    @staticmethod
+    def dumps(obj) -> bytes:
+        return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode()
+
+    loads = staticmethod(json.loads)
+
+class OrJson:
+    name = "orjson"
+
+    @staticmethod
+    def dumps(obj) -> bytes:
+        # Non-str keys (user ids) become strings, as with json.dumps
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+    @staticmethod
+    def loads(data):
+        return orjson.loads(data) # errors are json.JSONDecodeError subclasses
+
+# Codecs encode to UTF-8 bytes, sent as text frames; register others here
+JSON_CODECS = {"json": StdlibJson}
+if orjson is not None:
+    JSON_CODECS["orjson"] = OrJson
+
+def json_codec(name=None):
+    """The codec called name, or POKER_JSON; the fastest installed one by default."""
+    name = name or os.environ.get("POKER_JSON")
+    if name:
+        if name not in JSON_CODECS:
+            print(f"JSON codec {name!r} not available, using {'orjson' if orjson else 'json'}")
+        return JSON_CODECS.get(name) or JSON_CODECS.get("orjson", StdlibJson)
+    return JSON_CODECS.get("orjson", StdlibJson)
+
+# ==========================================
+# BINARY WIRE PROTOCOL
+# ==========================================
+
+class BinaryFrame(bytes):
+    """A message sent as a binary WebSocket frame (plain bytes are UTF-8 JSON text frames)."""
+
+class BinaryProtocol:
+    """Compact encoding of the game traffic for clients that connect with the
+    "poker.bin.v1" WebSocket subprotocol; everything else stays JSON on text
+    frames, and clients without the subprotocol see no difference.
+
+    A frame is a u8 kind and a fixed layout, little endian: money in i64
+    cents, a card in one byte (its Card code, 255 face down), enums for
+    phases and actions, strings as u8 length + UTF-8 (u16 for chat text).
+      TABLE_UPDATE  server -> client  the table_update state, see encode_table_update
+      GAME_ACTION   client -> server  u8 action, i64 amount
+      CHAT_MESSAGE  client -> server  table_id, text
+                    server -> client  table_id, u32 user_id, username, text
+    """
+    SUBPROTOCOL = "poker.bin.v1"
+    TABLE_UPDATE, GAME_ACTION, CHAT_MESSAGE = 1, 2, 3
+    NAMES = {TABLE_UPDATE: "table_update", GAME_ACTION: "game_action", CHAT_MESSAGE: "chat_message"}
+    PHASES = ("waiting", "preflop", "flop", "turn", "river", "showdown")
+    ACTIONS = ("check", "call", "raise", "fold", "sitout", "sitin")
+    LAST_ACTIONS = ("", "FOLD", "CALL", "CHECK", "RAISE", "ALL-IN")
+    FLAGS = ("is_active", "is_sitting_out", "has_cards", "folded", "all_in")
+    HIDDEN = 255
+    # kind, seq, phase, dealer position, max players, current player (0: none),
+    # small blind, big blind, min buy-in, max buy-in, pot, current bet
+    TABLE = struct.Struct("<BIBBBIqqqqqq")
+    PLAYER = struct.Struct("<IBqqBB") # user_id, position, chips, current bet, flags, last action
+    WINNER = struct.Struct("<Iq") # user_id, amount, then the hand description
+    EQUITY = struct.Struct("<Ifff") # user_id, win, tie, equity
+    ACTION = struct.Struct("<BBq")
+    USER = struct.Struct("<I")
+
+    @staticmethod
+    def _cents(amount):
+        return round(amount * 100)
+
+    @staticmethod
+    def _string(text, size="B"):
+        data = text.encode()[:255 if size == "B" else 65535]
+        return struct.pack("<" + size, len(data)) + data
+
+    @staticmethod
+    def _read_string(data, pos, size="B"):
+        width = struct.calcsize(size)
+        length = struct.unpack_from("<" + size, data, pos)[0]
+        pos += width
+        return bytes(data[pos:pos + length]).decode(errors="replace"), pos + length
+
+    @classmethod
+    def _card(cls, card):
+        if card.get("rank") == "?":
+            return cls.HIDDEN
+        return Card(card["value"], card["suit"])
+
+    @classmethod
+    def _card_dict(cls, code):
+        return {"rank": "?", "suit": "?", "value": 0} if code == cls.HIDDEN else Card.from_code(code).to_dict()
+
+    @classmethod
+    def encode_table_update(cls, state):
+        """Returns (frame, slots): slots maps the user_id of each player whose
+        cards are a private card slot (see PokerServer._card_slots) to the
+        offset of their two face down card bytes in frame."""
+        out = bytearray(cls.TABLE.pack(
+            cls.TABLE_UPDATE, state['seq'], cls.PHASES.index(state['game_phase']), state['dealer_position'],
+            state['max_players'], state['current_player'] or 0, cls._cents(state['small_blind']),
+            cls._cents(state['big_blind']), cls._cents(state['min_buy_in']), cls._cents(state['max_buy_in']),
+            cls._cents(state['pot']), cls._cents(state['current_bet'])))
+        out += cls._string(state['table_id'])
+        out += cls._string(state['name'])
+        out.append(len(state['community_cards']))
+        out += bytes(cls._card(c) for c in state['community_cards'])
+        slots = {}
+        out.append(len(state['players']))
+        for p in state['players']:
+            flags = sum(1 << i for i, flag in enumerate(cls.FLAGS) if p[flag])
+            last_action = cls.LAST_ACTIONS.index(p['last_action']) if p['last_action'] in cls.LAST_ACTIONS else 0
+            out += cls.PLAYER.pack(p['user_id'], p['position'], cls._cents(p['chips']), cls._cents(p['current_bet']),
+                                   flags, last_action)
+            out += cls._string(p['username'])
+            if isinstance(p['cards'], str): # private card slot: face down here, spliced per recipient
+                out.append(2)
+                slots[p['user_id']] = len(out)
+                out += bytes((cls.HIDDEN, cls.HIDDEN))
+            else:
+                out.append(len(p['cards']))
+                out += bytes(cls._card(c) for c in p['cards'])
+        out.append(len(state['winners']))
+        for w in state['winners']:
+            out += cls.WINNER.pack(w['user_id'], cls._cents(w['amount']))
+            out += cls._string(w.get('hand') or "")
+        equity = state['equity'] or []
+        out.append(len(equity))
+        for e in equity:
+            out += cls.EQUITY.pack(e['user_id'], e['win'], e['tie'], e['equity'])
+        return out, slots
+
+    @classmethod
+    def decode_table_update(cls, data):
+        """The state dict of a TABLE_UPDATE frame, as in a JSON table_update (reference client and tests)."""
+        (_, seq, phase, dealer, max_players, current, sb, bb, min_buy, max_buy, pot,
+         current_bet) = cls.TABLE.unpack_from(data)
+        pos = cls.TABLE.size
+        table_id, pos = cls._read_string(data, pos)
+        name, pos = cls._read_string(data, pos)
+        board = [cls._card_dict(c) for c in data[pos + 1:pos + 1 + data[pos]]]
+        pos += 1 + data[pos]
+        players = []
+        count, pos = data[pos], pos + 1
+        for _ in range(count):
+            uid, position, chips, bet, flags, last_action = cls.PLAYER.unpack_from(data, pos)
+            username, pos = cls._read_string(data, pos + cls.PLAYER.size)
+            cards = [cls._card_dict(c) for c in data[pos + 1:pos + 1 + data[pos]]]
+            pos += 1 + data[pos]
+            player = {'user_id': uid, 'username': username, 'chips': chips / 100, 'position': position,
+                      'current_bet': bet / 100, 'cards': cards, 'last_action': cls.LAST_ACTIONS[last_action]}
+            player.update({flag: bool(flags >> i & 1) for i, flag in enumerate(cls.FLAGS)})
+            players.append(player)
+        winners = []
+        count, pos = data[pos], pos + 1
+        for _ in range(count):
+            uid, amount = cls.WINNER.unpack_from(data, pos)
+            hand, pos = cls._read_string(data, pos + cls.WINNER.size)
+            winners.append({"user_id": uid, "amount": amount / 100, "hand": hand})
+        equity = []
+        count, pos = data[pos], pos + 1
+        for _ in range(count):
+            uid, win, tie, share = cls.EQUITY.unpack_from(data, pos)
+            equity.append({"user_id": uid, "win": win, "tie": tie, "equity": share})
+            pos += cls.EQUITY.size
+        return {'table_id': table_id, 'name': name, 'small_blind': sb / 100, 'big_blind': bb / 100,
+                'min_buy_in': min_buy / 100, 'max_buy_in': max_buy / 100, 'max_players': max_players,
+                'players': players, 'dealer_position': dealer, 'current_player': current or None, 'pot': pot / 100,
+                'community_cards': board, 'game_phase': cls.PHASES[phase], 'current_bet': current_bet / 100,
+                'winners': winners, 'equity': equity or None, 'seq': seq}
+
+    @classmethod
+    def encode_chat(cls, table_id, user_id, username, text):
+        return BinaryFrame(bytes((cls.CHAT_MESSAGE,)) + cls._string(table_id) + cls.USER.pack(user_id)
+                           + cls._string(username) + cls._string(text, "H"))
+
+    @classmethod
+    def decode_chat(cls, data):
+        table_id, pos = cls._read_string(data, 1)
+        user_id = cls.USER.unpack_from(data, pos)[0]
+        username, pos = cls._read_string(data, pos + cls.USER.size)
+        text, _ = cls._read_string(data, pos, "H")
+        return {"type": "chat_message", "table_id": table_id, "user_id": user_id, "username": username, "message": text}
+
+    @classmethod
+    def encode_action(cls, action, amount=0.0):
+        return cls.ACTION.pack(cls.GAME_ACTION, cls.ACTIONS.index(action), cls._cents(amount))
+
+    @classmethod
+    def encode_chat_request(cls, table_id, text):
+        return bytes((cls.CHAT_MESSAGE,)) + cls._string(table_id) + cls._string(text, "H")
+
+    @classmethod
+    def decode_request(cls, data):
+        """A client frame as the message dict handle_message takes; ValueError if malformed."""
+        try:
+            if data[0] == cls.GAME_ACTION:
+                _, action, amount = cls.ACTION.unpack_from(data)
+                return {"action": cls.ACTIONS[action], "amount": amount / 100}
+            if data[0] == cls.CHAT_MESSAGE:
+                table_id, pos = cls._read_string(data, 1)
+                text, _ = cls._read_string(data, pos, "H")
+                return {"action": "chat_message", "table_id": table_id, "message": text}
+        except (IndexError, struct.error) as e:
+            raise ValueError(f"malformed binary frame: {e}")
+        raise ValueError(f"unknown binary frame kind {data[0] if data else None}")
+
 # ==========================================
 # POKER ENGINE
 # ==========================================
 
 class WebSocketAdapter:
-    def __init__(self, ws, request):
+    """Outbound messages go through a per-connection queue drained by one
+    writer task, so a slow client never stalls a broadcast or the handler
+    that triggered it.
+
+    A full table snapshot replaces whatever is still queued for the same
+    table (older snapshots and deltas). A client whose backlog stays above
+    HIGH_WATER for HIGH_WATER_GRACE seconds, or ever reaches MAX_QUEUE, is
+    disconnected.
+    """
+    COALESCE_AFTER = 4 # backlog above which table deltas are replaced by snapshots
+    HIGH_WATER = 64
+    HIGH_WATER_GRACE = 10.0 # seconds
+    MAX_QUEUE = 256
+    _ids = itertools.count(1)
+    _TYPE = re.compile(rb'\{"type": ?"([^"]{1,40})"')
+
+    def __init__(self, ws, request, stats=None):
+        self.conn_id = next(self._ids) # routing key between a gateway and shard workers
         self._ws = ws
         self._request = request
-        
-    async def send(self, data):
-        await self._ws.send_str(data)
+        self._queue = deque() # (table_id, data)
+        self._wakeup = asyncio.Event()
+        self._writer = None
+        self._over_since = None
+        self.closed = False
+        self.binary = False # negotiated BinaryProtocol
+        self.stats = stats # message type -> [messages, compressed, payload bytes, wire bytes, send seconds]
+        
+    async def send(self, data, table=None, snapshot=False):
+        self.send_nowait(data, table, snapshot)
+
+    def send_nowait(self, data, table=None, snapshot=False):
+        if self.closed:
+            return
+        if snapshot and table is not None and self._queue:
+            self._queue = deque(item for item in self._queue if item[0] != table)
+        self._queue.append((table, data))
+
+        backlog = len(self._queue)
+        if backlog >= self.HIGH_WATER:
+            now = time.monotonic()
+            if self._over_since is None:
+                self._over_since = now
+            if backlog >= self.MAX_QUEUE or now - self._over_since > self.HIGH_WATER_GRACE:
+                print(f"Disconnecting slow client {self.remote_address} ({backlog} queued messages)")
+                self.stop()
+                asyncio.ensure_future(self._ws.close())
+                return
+
+        if self._writer is None:
+            self._writer = asyncio.ensure_future(self._drain())
+        self._wakeup.set()
+
+    async def _drain(self):
+        try:
+            while not self.closed:
+                if not self._queue:
+                    self._over_since = None
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    continue
+                _, data = self._queue.popleft()
+                await self._send(data)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f"Send failed to {self.remote_address}: {e}")
+            await self.close()
+
+    async def _send(self, data):
+        # Once permessage-deflate is negotiated aiohttp compresses every frame, so
+        # below the threshold its writer is switched off for the frame. Wire bytes
+        # come from the writer's output counter, which restarts at the flow
+        # control mark: the odd frame that crosses it counts at its plain size.
+        writer = getattr(self._ws, "_writer", None)
+        size = len(data)
+        compress = bool(getattr(self._ws, "compress", 0)) and size >= SERVER_CONFIG.get("ws_compress_min_bytes", 1024)
+        level = None
+        if writer is not None and getattr(self._ws, "compress", 0) and not compress:
+            level, writer.compress = writer.compress, 0
+        before = getattr(writer, "_output_size", 0)
+        start = time.perf_counter()
+        try:
+            if type(data) is BinaryFrame:
+                await self._ws.send_bytes(data)
+            elif isinstance(data, bytes):
+                await self._ws.send_frame(data, WSMsgType.TEXT) # already UTF-8 JSON
+            else:
+                await self._ws.send_str(data)
+        finally:
+            if level is not None:
+                writer.compress = level
+        if self.stats is not None:
+            elapsed = time.perf_counter() - start
+            after = getattr(writer, "_output_size", 0)
+            kind = self.message_type(data)
+            entry = self.stats.get(kind)
+            if entry is None:
+                entry = self.stats[kind] = [0, 0, 0, 0, 0.0]
+            entry[0] += 1
+            entry[1] += compress
+            entry[2] += size
+            entry[3] += after - before if after > before else size
+            entry[4] += elapsed
+
+    @classmethod
+    def message_type(cls, data):
+        if type(data) is BinaryFrame:
+            return f"{BinaryProtocol.NAMES.get(data[0], 'unknown')} (binary)"
+        if isinstance(data, str):
+            data = data[:64].encode()
+        found = cls._TYPE.match(data, 0, 64)
+        return found.group(1).decode() if found else "other"
+
+    @property
+    def backlog(self):
+        return len(self._queue)
+
+    def stop(self):
+        # Drop anything still queued and stop the writer (connection is gone)
+        self.closed = True
+        self._queue.clear()
+        if self._writer is not None and self._writer is not asyncio.current_task():
+            self._writer.cancel()
         
     async def close(self):
+        self.stop()
         await self._ws.close()
         
     @property
     def remote_address(self):
         return self._request.remote
 
-class Card:
+    @property
+    def compressed(self):
+        return bool(getattr(self._ws, "compress", 0))
+
+class Card(int):
+    """A card is a plain int code: (rank - 2) * 4 + suit index, 0..51.
+
+    The engine passes codes and bitmasks around (bit suit * 16 + rank, one
+    16 bit lane per suit). Card(rank, suit) builds a code from rank and suit,
+    and to_dict is only used when a state is serialized for clients.
+    """
     SUITS = ['s', 'h', 'd', 'c'] # spades, hearts, diamonds, clubs
     RANKS = {2: '2', 3: '3', 4: '4', 5: '5', 6: '6', 7: '7', 8: '8', 9: '9', 10: 'T', 11: 'J', 12: 'Q', 13: 'K', 14: 'A'}
-    
-    def __init__(self, rank, suit):
-        self.rank = rank
-        self.suit = suit
-        
+    BITS = [] # code -> mask bit, filled below
+    __slots__ = ()
+
+    def __new__(cls, rank, suit):
+        return int.__new__(cls, (rank - 2) * 4 + cls.SUITS.index(suit))
+
+    @classmethod
+    def from_code(cls, code):
+        return int.__new__(cls, code)
+
+    @property
+    def rank(self):
+        return (self >> 2) + 2
+
+    @property
+    def suit(self):
+        return Card.SUITS[self & 3]
+
     def __repr__(self):
-        return f"{self.RANKS[self.rank]}{self.suit}"
-        
+        return f"{Card.RANKS[(self >> 2) + 2]}{Card.SUITS[self & 3]}"
+
     def to_dict(self):
-        return {"rank": self.RANKS[self.rank], "suit": self.suit, "value": self.rank}
+        # Works on plain codes too: Card.to_dict(code)
+        rank = (self >> 2) + 2
+        return {"rank": Card.RANKS[rank], "suit": Card.SUITS[self & 3], "value": rank}
+
+    @staticmethod
+    def mask(codes):
+        bits = Card.BITS
+        mask = 0
+        for c in codes:
+            mask |= bits[c]
+        return mask
+
+    @staticmethod
+    def codes_from_mask(mask):
+        return [c for c in range(52) if mask & Card.BITS[c]]
+
+Card.BITS = [1 << ((c & 3) * 16 + (c >> 2) + 2) for c in range(52)]
 
 class Deck:
-    def __init__(self):
-        self.cards = [Card(r, s) for r in range(2, 15) for s in Card.SUITS]
+    """One per table: the same 52 codes are reshuffled in place every hand.
+    rng is any random.Random, for seeded simulations (default: the module RNG)."""
+    def __init__(self, rng=None):
+        self.cards = list(range(52))
+        self.position = 0
+        self.rng = rng or random
         self.shuffle()
         
     def shuffle(self):
-        random.shuffle(self.cards)
+        self.rng.shuffle(self.cards)
+        self.position = 0
         
     def deal(self, n=1):
-        return [self.cards.pop() for _ in range(n)]
+        start = self.position
+        self.position += n
+        return self.cards[start:self.position]
+
+    def remaining(self):
+        return self.cards[self.position:]
+
+    def __getstate__(self):
+        # The module RNG can't be pickled (tables move between shard workers): reattach on load
+        state = dict(self.__dict__)
+        if state['rng'] is random:
+            state['rng'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.rng = self.rng or random
+
+# ==========================================
+# SUIT ISOMORPHISM & CACHES
+# ==========================================
+
+class LRUCache:
+    """Bounded least-recently-used mapping with hit/miss counters."""
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
+
+def canonical_mask(mask):
+    # A card set's suit-isomorphic representative: its four suit lanes sorted
+    lanes = sorted((mask & 0xFFFF, mask >> 16 & 0xFFFF, mask >> 32 & 0xFFFF, mask >> 48))
+    return lanes[0] | lanes[1] << 16 | lanes[2] << 32 | lanes[3] << 48
+
+def canonicalize(groups):
+    """Suit-isomorphic representative of ordered card groups (hands, board, dead...).
+
+    Suits are relabelled by their rank pattern across the groups, so any two
+    spots that only differ by a suit permutation map to the same tuple.
+    """
+    signatures = []
+    for suit in range(4):
+        signatures.append(tuple(sum(1 << (c >> 2) for c in g if c & 3 == suit) for g in groups))
+    order = sorted(range(4), key=lambda suit: signatures[suit], reverse=True)
+    relabel = [0] * 4
+    for new, old in enumerate(order):
+        relabel[old] = new
+    return tuple(tuple(sorted((c & ~3) | relabel[c & 3] for c in g)) for g in groups)
+
+EVALUATION_CACHE = LRUCache(100_000) # canonical mask -> (score, name), legacy evaluator only
 
 class HandEvaluator:
+    BASE = 10_000_000_000 # score // BASE is the hand category
+    CATEGORY_NAMES = ["High Card", "Pair", "Two Pair", "Three of a Kind", "Straight",
+                      "Flush", "Full House", "Four of a Kind", "Straight Flush", "Royal Flush"]
+
     @staticmethod
     def evaluate(hole_cards, community_cards):
-        cards = hole_cards + community_cards
+        if SERVER_CONFIG.get("hand_evaluator", "lookup") == "lookup":
+            return LookupHandEvaluator.evaluate(hole_cards, community_cards)
+        return HandEvaluator._evaluate_legacy_cached(Card.mask(hole_cards) | Card.mask(community_cards))
+
+    @staticmethod
+    def evaluate_mask(mask):
+        if SERVER_CONFIG.get("hand_evaluator", "lookup") == "lookup" and 5 <= bin(mask).count("1") <= 7:
+            return LookupHandEvaluator.evaluate_mask(mask)
+        return HandEvaluator._evaluate_legacy_cached(mask)
+
+    @staticmethod
+    def _evaluate_legacy_cached(mask):
+        # The lookup evaluator is already a perfect table; only the legacy path is memoized
+        key = canonical_mask(mask)
+        result = EVALUATION_CACHE.get(key)
+        if result is None:
+            result = HandEvaluator.evaluate_legacy(Card.codes_from_mask(key), [])
+            EVALUATION_CACHE.put(key, result)
+        return result
+
+    @staticmethod
+    def evaluate_batch(codes):
+        """Scores for an N x 5..7 array of card codes, same as evaluate() row by row."""
+        if np is None:
+            raise RuntimeError("Batch evaluation requires numpy")
+        return LookupHandEvaluator.evaluate_batch(codes)
+
+    @staticmethod
+    def category_name(score):
+        return HandEvaluator.CATEGORY_NAMES[int(score) // HandEvaluator.BASE]
+
+    @staticmethod
+    def evaluate_legacy(hole_cards, community_cards):
+        cards = [Card.from_code(c) for c in list(hole_cards) + list(community_cards)]
         if not cards:
             return (0, "No Hand")
             
@@ -221,11 +747,893 @@ class HandEvaluator:
             score += c.rank * (100 ** (4-i))
         return (score, "High Card")
 
+class LookupHandEvaluator:
+    """Table driven evaluator for 5, 6 and 7 card hands.
+
+    Flushes are resolved with one lookup on the rank mask of each suit, every
+    other hand with one lookup on the product of the rank primes (Cactus Kev
+    scheme). The tables are generated from HandEvaluator.evaluate_legacy, so
+    scores and category names are exactly the ones clients already get.
+    """
+    PRIMES = {2: 2, 3: 3, 4: 5, 5: 7, 6: 11, 7: 13, 8: 17, 9: 19, 10: 23, 11: 29, 12: 31, 13: 37, 14: 41}
+
+    _flush_table = None # rank mask (bit = rank) -> (score, name), None if < 5 ranks
+    _prime_products = None # rank mask -> product of the primes of its ranks
+    _unsuited_table = None # prime product -> (score, name)
+    _np_tables = None # numpy copies of the tables above, see evaluate_batch
+    BATCH_CHUNK = 1 << 18 # rows per vectorized pass, bounds temporary memory
+
+    @staticmethod
+    def _rank_multisets(size, min_rank=2):
+        # Every multiset of `size` ranks with at most 4 cards per rank
+        if size == 0:
+            yield []
+            return
+        for rank in range(min_rank, 15):
+            for count in range(1, min(4, size) + 1):
+                for rest in LookupHandEvaluator._rank_multisets(size - count, rank + 1):
+                    yield [rank] * count + rest
+
+    @classmethod
+    def build_tables(cls):
+        if cls._flush_table is not None:
+            return
+
+        mask_size = 1 << 15 # ranks 2..14 map to bits 2..14
+        prime_products = [1] * mask_size
+        for mask in range(1, mask_size):
+            low = mask & -mask
+            prime_products[mask] = prime_products[mask ^ low] * cls.PRIMES.get(low.bit_length() - 1, 1)
+
+        # Flushes: every set of 5..7 distinct ranks in a single suit
+        flush_table = [None] * mask_size
+        for mask in range(mask_size):
+            ranks = [r for r in range(2, 15) if mask >> r & 1]
+            if 5 <= len(ranks) <= 7 and mask & 0b11 == 0:
+                flush_table[mask] = HandEvaluator.evaluate_legacy([Card(r, 's') for r in ranks], [])
+
+        # Everything else: rank multisets dealt round-robin over the suits so
+        # no suit ever reaches five cards
+        unsuited_table = {}
+        for size in (5, 6, 7):
+            for ranks in cls._rank_multisets(size):
+                cards = [Card(r, Card.SUITS[i % 4]) for i, r in enumerate(ranks)]
+                product = 1
+                for r in ranks:
+                    product *= cls.PRIMES[r]
+                unsuited_table[product] = HandEvaluator.evaluate_legacy(cards, [])
+
+        cls._prime_products = prime_products
+        cls._unsuited_table = unsuited_table
+        cls._flush_table = flush_table
+
+    @classmethod
+    def _lookup(cls, spades, hearts, diamonds, clubs):
+        # One rank mask per suit, 5 to 7 cards in total
+        flush_table = cls._flush_table
+        hit = flush_table[spades] or flush_table[hearts] or flush_table[diamonds] or flush_table[clubs]
+        if hit:
+            return hit
+        products = cls._prime_products
+        return cls._unsuited_table[products[spades] * products[hearts] * products[diamonds] * products[clubs]]
+
+    @classmethod
+    def evaluate(cls, hole_cards, community_cards):
+        count = len(hole_cards) + len(community_cards)
+        if count < 5 or count > 7:
+            return HandEvaluator.evaluate_legacy(hole_cards, community_cards)
+        bits = Card.BITS
+        mask = 0
+        for c in hole_cards:
+            mask |= bits[c]
+        for c in community_cards:
+            mask |= bits[c]
+        return cls.evaluate_mask(mask)
+
+    @classmethod
+    def evaluate_mask(cls, mask):
+        if cls._flush_table is None:
+            cls.build_tables()
+        return cls._lookup(mask & 0xFFFF, mask >> 16 & 0xFFFF, mask >> 32 & 0xFFFF, mask >> 48)
+
+    @classmethod
+    def _build_np_tables(cls):
+        cls.build_tables()
+        flush_scores = np.full(len(cls._flush_table), -1, dtype=np.int64)
+        for mask, hit in enumerate(cls._flush_table):
+            if hit:
+                flush_scores[mask] = hit[0]
+        keys = sorted(cls._unsuited_table)
+        cls._np_tables = (
+            np.array([1 << ((c >> 2) + 2) for c in range(52)], dtype=np.int64), # code -> rank bit
+            flush_scores,
+            np.array(cls._prime_products, dtype=np.int64),
+            np.array(keys, dtype=np.int64),
+            np.array([cls._unsuited_table[k][0] for k in keys], dtype=np.int64),
+        )
+
+    @classmethod
+    def evaluate_batch(cls, codes):
+        codes = np.asarray(codes, dtype=np.intp)
+        if codes.ndim != 2 or not 5 <= codes.shape[1] <= 7:
+            raise ValueError("Expected an N x 5..7 array of card codes")
+        if cls._np_tables is None:
+            cls._build_np_tables()
+        rank_bits, flush_scores, prime_products, unsuited_keys, unsuited_scores = cls._np_tables
+
+        scores = np.empty(len(codes), dtype=np.int64)
+        for start in range(0, len(codes), cls.BATCH_CHUNK):
+            chunk = codes[start:start + cls.BATCH_CHUNK]
+            bits = rank_bits[chunk]
+            suits = chunk & 3
+            # Per-suit rank masks, shape (4, rows); ranks are distinct within a suit so sum == or
+            lanes = np.stack([np.where(suits == s, bits, 0).sum(axis=1) for s in range(4)])
+            flush = flush_scores[lanes].max(axis=0)
+            products = prime_products[lanes].prod(axis=0)
+            unsuited = unsuited_scores[np.searchsorted(unsuited_keys, products)]
+            scores[start:start + len(chunk)] = np.where(flush >= 0, flush, unsuited)
+        return scores
+
+class EquityCalculator:
+    """All-in equity for known hole cards, board and dead cards.
+
+    The rest of the board is enumerated exactly when there are at most
+    EXACT_LIMIT run-outs (flop and later), otherwise sampled with a seeded
+    Monte Carlo run so the same spot always gives the same numbers.
+    """
+    EXACT_LIMIT = 50_000
+    MONTE_CARLO_TRIALS = 20_000
+    cache = LRUCache(4096) # canonical key -> result
+
+    @staticmethod
+    def canonical_key(hands, board=(), dead=()):
+        groups = canonicalize(list(hands) + [board, dead])
+        return (groups[:-2], groups[-2], groups[-1])
+
+    @staticmethod
+    def compute_cached(hands, board=(), dead=(), cache=None):
+        # Synchronous memoized entry point for simulations; the server uses EquityService
+        cache = cache if cache is not None else EquityCalculator.cache
+        key = EquityCalculator.canonical_key(hands, board, dead)
+        result = cache.get(key)
+        if result is None:
+            # Suit permutations keep player order, so the canonical spot answers for the original one
+            result = EquityCalculator.compute(*key)
+            cache.put(key, result)
+        return result
+
+    @staticmethod
+    def compute(hands, board=(), dead=(), trials=None, seed=0):
+        known = set(board) | set(dead) | {c for h in hands for c in h}
+        deck = [c for c in range(52) if c not in known]
+        missing = 5 - len(board)
+        total = math.comb(len(deck), missing)
+        if total <= EquityCalculator.EXACT_LIMIT:
+            exact = True
+            runouts = list(itertools.combinations(deck, missing))
+        else:
+            exact = False
+            rng = random.Random(seed)
+            runouts = [rng.sample(deck, missing) for _ in range(trials or EquityCalculator.MONTE_CARLO_TRIALS)]
+
+        if np is not None:
+            wins, ties, shares = EquityCalculator._tally_batch(hands, board, runouts)
+        else:
+            wins, ties, shares = EquityCalculator._tally_scalar(hands, board, runouts)
+
+        n = len(runouts)
+        return {
+            "players": [{"win": wins[i] / n, "tie": ties[i] / n, "equity": shares[i] / n} for i in range(len(hands))],
+            "exact": exact,
+            "runouts": n
+        }
+
+    @staticmethod
+    def _tally_scalar(hands, board, runouts):
+        hand_masks = [Card.mask(h) for h in hands]
+        board_mask = Card.mask(board)
+        bits = Card.BITS
+        evaluate_mask = LookupHandEvaluator.evaluate_mask
+        wins = [0] * len(hands)
+        ties = [0] * len(hands)
+        shares = [0.0] * len(hands)
+        for runout in runouts:
+            mask = board_mask
+            for c in runout:
+                mask |= bits[c]
+            scores = [evaluate_mask(h | mask)[0] for h in hand_masks]
+            best = max(scores)
+            winners = [i for i, score in enumerate(scores) if score == best]
+            if len(winners) == 1:
+                wins[winners[0]] += 1
+                shares[winners[0]] += 1.0
+            else:
+                for i in winners:
+                    ties[i] += 1
+                    shares[i] += 1.0 / len(winners)
+        return wins, ties, shares
+
+    @staticmethod
+    def _tally_batch(hands, board, runouts):
+        runout_codes = np.array(runouts, dtype=np.intp).reshape(len(runouts), -1)
+        fixed = np.broadcast_to(np.array(list(board), dtype=np.intp), (len(runouts), len(board)))
+        scores = np.stack([
+            LookupHandEvaluator.evaluate_batch(np.hstack([
+                np.broadcast_to(np.array(list(h), dtype=np.intp), (len(runouts), len(h))), fixed, runout_codes
+            ]))
+            for h in hands
+        ])
+        winners = scores == scores.max(axis=0)
+        counts = winners.sum(axis=0)
+        wins = (winners & (counts == 1)).sum(axis=1)
+        ties = (winners & (counts > 1)).sum(axis=1)
+        shares = (winners / counts).sum(axis=1)
+        return wins.tolist(), ties.tolist(), shares.tolist()
+
+class EquityService:
+    """Runs EquityCalculator in a process pool, caching per canonical spot."""
+    def __init__(self, workers: int = None, cache: LRUCache = None):
+        self.workers = workers or max(1, min(4, (os.cpu_count() or 2) - 1))
+        self.cache = cache if cache is not None else EquityCalculator.cache
+        self._pool = None
+
+    async def compute(self, hands, board=(), dead=()):
+        key = EquityCalculator.canonical_key(hands, board, dead)
+        result = self.cache.get(key)
+        if result is not None:
+            return result
+
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, initializer=LookupHandEvaluator.build_tables)
+        # Suit permutations keep player order, so the canonical spot answers for the original one
+        result = await asyncio.get_running_loop().run_in_executor(self._pool, EquityCalculator.compute, *key)
+        self.cache.put(key, result)
+        return result
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+
+# ==========================================
+# METRICS
+# ==========================================
+
+# Action being handled by the current task, so DB time can be attributed to it
+CURRENT_ACTION = contextvars.ContextVar("current_action", default="background")
+
+class Metrics:
+    """In-process counters, histograms and scrape-time gauges in Prometheus text format.
+
+    Recording is a bisect and a few list increments, cheap enough to leave on for
+    every message; gauges are callbacks evaluated only when /metrics is scraped.
+    """
+    LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    SIZE_BUCKETS = (0, 1, 2, 3, 4, 6, 9, 16, 32, 64, 128, 256)
+
+    def __init__(self):
+        self._families = OrderedDict() # name -> [kind, help, label names, buckets, {label values: series}]
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self._families[name] = ["histogram", help, tuple(labels), tuple(buckets), {}]
+
+    def counter(self, name, help, labels=()):
+        self._families[name] = ["counter", help, tuple(labels), None, {}]
+
+    def gauge(self, name, help, fn, labels=()):
+        """fn() returns a number, or a {label values tuple: number} dict when labels are given."""
+        self._families[name] = ["gauge", help, tuple(labels), None, fn]
+
+    def observe(self, name, value, labels=()):
+        family = self._families[name]
+        series = family[4].get(labels)
+        if series is None:
+            series = family[4][labels] = [[0] * (len(family[3]) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(family[3], value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def inc(self, name, labels=(), amount=1):
+        series = self._families[name][4]
+        series[labels] = series.get(labels, 0) + amount
+
+    def value(self, name, labels=()):
+        """Counter value or (count, sum) of a histogram series; for tests and admin views."""
+        kind, _, _, _, series = self._families[name]
+        found = series.get(labels)
+        if kind == "histogram":
+            return (found[2], found[1]) if found else (0, 0.0)
+        return found or 0
+
+    @staticmethod
+    def _labels(names, values, le=None):
+        pairs = []
+        for n, v in zip(names, values):
+            v = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+            pairs.append(f'{n}="{v}"')
+        if le is not None:
+            pairs.append(f'le="{le}"')
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def totals(self):
+        """One number per family: counters and gauges summed over labels, histogram observation counts."""
+        out = {}
+        for name, (kind, _, _, _, series) in self._families.items():
+            if kind == "gauge":
+                try:
+                    value = series()
+                except Exception:
+                    continue
+                out[name] = sum(value.values()) if isinstance(value, dict) else value
+            elif kind == "histogram":
+                out[name] = sum(s[2] for s in series.values())
+            else:
+                out[name] = sum(series.values())
+        return out
+
+    def render(self) -> str:
+        lines = []
+        for name, (kind, help, label_names, buckets, series) in self._families.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "gauge":
+                try:
+                    values = series()
+                except Exception as e:
+                    print(f"Metrics gauge {name} failed: {e}")
+                    continue
+                if not label_names:
+                    values = {(): values}
+                for labels, v in values.items():
+                    lines.append(f"{name}{self._labels(label_names, labels)} {v}")
+            elif kind == "counter":
+                for labels, v in list(series.items()):
+                    lines.append(f"{name}{self._labels(label_names, labels)} {v}")
+            else:
+                for labels, (counts, total, count) in list(series.items()):
+                    cumulative = 0
+                    for bound, c in zip(buckets, counts):
+                        cumulative += c
+                        lines.append(f"{name}_bucket{self._labels(label_names, labels, bound)} {cumulative}")
+                    lines.append(f"{name}_bucket{self._labels(label_names, labels, '+Inf')} {count}")
+                    lines.append(f"{name}_sum{self._labels(label_names, labels)} {total}")
+                    lines.append(f"{name}_count{self._labels(label_names, labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    async def monitor_loop_lag(self, name="poker_event_loop_lag_seconds", interval=0.5):
+        """Samples how late a sleep wakes up; the overshoot is time the loop spent busy."""
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            self.observe(name, max(0.0, loop.time() - start - interval))
+
+# ==========================================
+# PASSWORDS
+# ==========================================
+
+class PasswordHasher:
+    """Salted scrypt hashes computed off the event loop.
+
+    hashlib.scrypt releases the GIL, so a small dedicated thread pool keeps
+    login storms from stalling table traffic; the semaphore bounds how many
+    hashes run at once, everyone else waits on the loop at no cost.
+    Stored format: scrypt$n$r$p$salt_hex$hash_hex. Bare 64-char hex strings
+    are legacy unsalted SHA-256 hashes, accepted once and then upgraded.
+    """
+    N, R, P = 2 ** 14, 8, 1
+    SALT_BYTES = 16
+    KEY_BYTES = 32
+
+    def __init__(self, workers: int = None):
+        self.workers = workers or max(1, min(4, (os.cpu_count() or 2) - 1))
+        self._pool = None
+        self._limit = None
+
+    @staticmethod
+    def legacy_hash(password: str) -> str:
+        return hashlib.sha256(password.encode()).hexdigest()
+
+    @classmethod
+    def _derive(cls, password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+        return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p,
+                              maxmem=2 * 128 * r * n + (1 << 20), dklen=cls.KEY_BYTES)
+
+    @classmethod
+    def hash_sync(cls, password: str) -> str:
+        salt = os.urandom(cls.SALT_BYTES)
+        key = cls._derive(password, salt, cls.N, cls.R, cls.P)
+        return f"scrypt${cls.N}${cls.R}${cls.P}${salt.hex()}${key.hex()}"
+
+    @classmethod
+    def verify_sync(cls, password: str, stored: str):
+        """Returns (matches, needs_rehash)."""
+        if not stored:
+            # Unknown account: pay the same cost so timing does not reveal which emails exist
+            cls._derive(password, bytes(cls.SALT_BYTES), cls.N, cls.R, cls.P)
+            return False, False
+        if not stored.startswith("scrypt$"):
+            return hmac.compare_digest(cls.legacy_hash(password), stored), True
+        try:
+            _, n, r, p, salt, key = stored.split("$")
+            n, r, p = int(n), int(r), int(p)
+            derived = cls._derive(password, bytes.fromhex(salt), n, r, p)
+        except (ValueError, MemoryError):
+            return False, False
+        ok = hmac.compare_digest(derived.hex(), key)
+        return ok, ok and (n, r, p) != (cls.N, cls.R, cls.P)
+
+    async def _run(self, fn, *args):
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="kdf")
+            self._limit = asyncio.Semaphore(self.workers)
+        async with self._limit:
+            return await asyncio.get_running_loop().run_in_executor(self._pool, fn, *args)
+
+    async def hash(self, password: str) -> str:
+        return await self._run(self.hash_sync, password)
+
+    async def verify(self, password: str, stored: str):
+        return await self._run(self.verify_sync, password, stored)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+
+# ==========================================
+# TIMERS
+# ==========================================
+
+class Timer:
+    """Handle returned by TimingWheel.arm; cancel() is O(1) and idempotent."""
+    __slots__ = ("wheel", "expires", "deadline", "callback", "args", "bucket")
+
+    def __init__(self, wheel, expires, deadline, callback, args):
+        self.wheel = wheel
+        self.expires = expires # absolute tick
+        self.deadline = deadline # loop time requested by the caller
+        self.callback = callback
+        self.args = args
+        self.bucket = None
+
+    def cancel(self):
+        if self.bucket is not None:
+            del self.bucket[self]
+            self.bucket = None
+            self.wheel.armed -= 1
+            self.wheel.cancelled += 1
+
+    @property
+    def active(self):
+        return self.bucket is not None
+
+
+class TimingWheel:
+    """Hierarchical timing wheel driven by a single task.
+
+    Level 0 has one slot per tick; each higher level slot covers a whole turn of
+    the level below and is cascaded down when that turn starts. Arming and
+    cancelling only touch one dict, so thousands of tables re-arming turn timers
+    on every action cost no tasks and no loop timer-heap entries.
+    Callbacks run on the loop; a coroutine they return is wrapped in a task.
+    """
+    def __init__(self, tick: float = 0.1, slots=(256, 64, 64)):
+        self.tick = tick
+        self.slots = slots
+        self.levels = [[{} for _ in range(size)] for size in slots]
+        self.current = 0
+        self.armed = 0
+        self.fired = 0
+        self.cancelled = 0
+        self.lag_max = 0.0
+        self.lag_total = 0.0
+        self._origin = None
+        self._task = None
+        self._wakeup = None
+
+    def _now_tick(self, loop):
+        return int((loop.time() - self._origin) / self.tick)
+
+    def _ensure_running(self, loop):
+        if self._task is None or self._task.done():
+            # Keep tick numbering continuous if the driver is restarted on a new loop
+            self._origin = loop.time() - self.current * self.tick
+            self._wakeup = asyncio.Event()
+            self._task = loop.create_task(self._run())
+
+    def arm(self, delay: float, callback, *args) -> Timer:
+        loop = asyncio.get_running_loop()
+        self._ensure_running(loop)
+        if not self.armed:
+            self.current = max(self.current, self._now_tick(loop)) # idle driver: nothing to cascade
+        ticks = max(1, math.ceil((loop.time() + delay - self._origin) / self.tick) - self.current)
+        timer = Timer(self, self.current + ticks, loop.time() + delay, callback, args)
+        self._place(timer)
+        self.armed += 1
+        self._wakeup.set()
+        return timer
+
+    def _place(self, timer):
+        delta = timer.expires - self.current
+        span = 1
+        for level, size in enumerate(self.slots):
+            if delta < span * size or level == len(self.slots) - 1:
+                if delta <= 0:
+                    index = self.current % size # overdue: fire on this tick
+                else:
+                    index = (min(timer.expires, self.current + span * size - 1) // span) % size
+                bucket = self.levels[level][index]
+                break
+            span *= size
+        bucket[timer] = None
+        timer.bucket = bucket
+
+    def _advance(self, loop):
+        self.current += 1
+        c = self.current
+        cascade = []
+        span = 1
+        for level in range(1, len(self.slots)):
+            span *= self.slots[level - 1]
+            if c % span:
+                break
+            cascade.append((level, (c // span) % self.slots[level]))
+        # Highest level first: its timers may land in the lower slot cascaded next
+        for level, index in reversed(cascade):
+            bucket = self.levels[level][index]
+            self.levels[level][index] = {}
+            for timer in bucket:
+                self._place(timer)
+
+        index = c % self.slots[0]
+        due = self.levels[0][index]
+        self.levels[0][index] = {}
+        now = loop.time()
+        for timer in due:
+            timer.bucket = None
+            self.armed -= 1
+            self.fired += 1
+            lag = max(0.0, now - timer.deadline)
+            self.lag_total += lag
+            self.lag_max = max(self.lag_max, lag)
+            try:
+                result = timer.callback(*timer.args)
+                if asyncio.iscoroutine(result):
+                    loop.create_task(result)
+            except Exception as e:
+                print(f"Timer callback {getattr(timer.callback, '__name__', timer.callback)} failed: {e}")
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self.armed:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            delay = self._origin + (self.current + 1) * self.tick - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            target = self._now_tick(loop)
+            while self.current < target and self.armed:
+                self._advance(loop)
+            if not self.armed:
+                self.current = max(self.current, target)
+
+    def stats(self):
+        return {
+            "armed": self.armed,
+            "fired": self.fired,
+            "cancelled": self.cancelled,
+            "tick_ms": self.tick * 1000,
+            "lag_avg_ms": round(1000 * self.lag_total / self.fired, 3) if self.fired else 0.0,
+            "lag_max_ms": round(1000 * self.lag_max, 3),
+        }
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+# ==========================================
+# DATABASE
+# ==========================================
+
+class DatabasePool:
+    """Persistent aiosqlite connections: one writer plus a few query-only readers.
+
+    SQLite allows a single writer at a time, so writes are serialized behind a lock
+    instead of failing with "database is locked"; in WAL mode readers never block it.
+    """
+    PRAGMAS = (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA cache_size=-16000", # ~16MB page cache per connection
+        "PRAGMA mmap_size=268435456",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA busy_timeout=5000",
+    )
+    STATEMENT_CACHE = 256
+
+    def __init__(self, path: str, readers: int = 4, metrics: "Metrics" = None):
+        self.path = path
+        self.readers = max(1, readers)
+        self.metrics = metrics
+        self._writer = None
+        self._write_lock = asyncio.Lock()
+        self._read_queue = None
+        self._all = []
+        self._opened = time.monotonic()
+        self.stats_data = {
+            "read": {"acquired": 0, "wait_total": 0.0, "wait_max": 0.0, "busy_total": 0.0, "in_use": 0},
+            "write": {"acquired": 0, "wait_total": 0.0, "wait_max": 0.0, "busy_total": 0.0, "in_use": 0},
+        }
+
+    async def _connect(self, query_only=False):
+        db = await aiosqlite.connect(self.path, cached_statements=self.STATEMENT_CACHE)
+        db.row_factory = aiosqlite.Row
+        for pragma in self.PRAGMAS:
+            await db.execute(pragma)
+        if query_only:
+            await db.execute("PRAGMA query_only=ON")
+        self._all.append(db)
+        return db
+
+    async def open(self):
+        if self._writer is not None:
+            return
+        # Writer first so WAL mode is set before the readers attach
+        self._writer = await self._connect()
+        self._read_queue = asyncio.Queue()
+        for _ in range(self.readers):
+            self._read_queue.put_nowait(await self._connect(query_only=True))
+        self._opened = time.monotonic()
+
+    async def close(self):
+        for db in self._all:
+            try:
+                await db.close()
+            except:
+                pass
+        self._all = []
+        self._writer = None
+        self._read_queue = None
+
+    def _record(self, kind, waited):
+        if self.metrics is not None:
+            self.metrics.observe("poker_db_wait_seconds", waited, (kind,))
+        s = self.stats_data[kind]
+        s["acquired"] += 1
+        s["wait_total"] += waited
+        s["wait_max"] = max(s["wait_max"], waited)
+        s["in_use"] += 1
+
+    def _release(self, kind, held):
+        self.stats_data[kind]["in_use"] -= 1
+        self.stats_data[kind]["busy_total"] += held
+        if self.metrics is not None:
+            self.metrics.observe("poker_db_seconds", held, (CURRENT_ACTION.get(), kind))
+
+    @contextlib.asynccontextmanager
+    async def write(self):
+        """Exclusive access to the writer; an uncommitted transaction is rolled back on exit."""
+        if self._writer is None:
+            await self.open()
+        start = time.monotonic()
+        async with self._write_lock:
+            acquired = time.monotonic()
+            self._record("write", acquired - start)
+            try:
+                yield self._writer
+            finally:
+                if self._writer.in_transaction:
+                    await self._writer.rollback()
+                self._release("write", time.monotonic() - acquired)
+
+    @contextlib.asynccontextmanager
+    async def read(self):
+        """A query-only connection borrowed from the reader queue."""
+        if self._read_queue is None:
+            await self.open()
+        start = time.monotonic()
+        db = await self._read_queue.get()
+        acquired = time.monotonic()
+        self._record("read", acquired - start)
+        try:
+            yield db
+        finally:
+            if db.in_transaction:
+                await db.rollback()
+            self._release("read", time.monotonic() - acquired)
+            self._read_queue.put_nowait(db)
+
+    def stats(self):
+        uptime = max(time.monotonic() - self._opened, 1e-9)
+        out = {"readers": self.readers}
+        for kind, s in self.stats_data.items():
+            capacity = self.readers if kind == "read" else 1
+            out[kind] = {
+                "acquired": s["acquired"],
+                "in_use": s["in_use"],
+                "wait_avg_ms": round(1000 * s["wait_total"] / s["acquired"], 3) if s["acquired"] else 0.0,
+                "wait_max_ms": round(1000 * s["wait_max"], 3),
+                "utilization": round(s["busy_total"] / (uptime * capacity), 4),
+            }
+        return out
+
+# Schema migrations, applied in order and tracked with PRAGMA user_version.
+# Each step is SQL or an async callable taking the connection; never edit a
+# released migration, append a new one instead.
+
+async def _add_column(db, table, column, decl):
+    cursor = await db.execute(f"PRAGMA table_info({table})")
+    if column not in [row[1] for row in await cursor.fetchall()]:
+        await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+SCHEMA_V1 = [
+    '''
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        email TEXT UNIQUE NOT NULL,
+        username TEXT UNIQUE NOT NULL,
+        password_hash TEXT NOT NULL,
+        security_question INTEGER NOT NULL,
+        security_answer TEXT NOT NULL,
+        chips INTEGER DEFAULT 10000,
+        level INTEGER DEFAULT 1,
+        avatar_id INTEGER DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        last_login TIMESTAMP,
+        is_banned INTEGER DEFAULT 0
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS statistics (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        games_played INTEGER DEFAULT 0,
+        games_won INTEGER DEFAULT 0,
+        chips_won INTEGER DEFAULT 0,
+        chips_lost INTEGER DEFAULT 0,
+        royal_flush INTEGER DEFAULT 0,
+        straight_flush INTEGER DEFAULT 0,
+        four_of_kind INTEGER DEFAULT 0,
+        full_house INTEGER DEFAULT 0,
+        flush INTEGER DEFAULT 0,
+        straight INTEGER DEFAULT 0,
+        three_of_kind INTEGER DEFAULT 0,
+        two_pair INTEGER DEFAULT 0,
+        pair INTEGER DEFAULT 0,
+        high_card INTEGER DEFAULT 0,
+        FOREIGN KEY (user_id) REFERENCES users(id)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS game_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        game_type TEXT NOT NULL,
+        result TEXT NOT NULL,
+        chips_change INTEGER,
+        hand TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users(id)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS wallets (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER UNIQUE NOT NULL,
+        balance REAL DEFAULT 0.0,
+        total_deposited REAL DEFAULT 0.0,
+        total_withdrawn REAL DEFAULT 0.0,
+        last_deposit TIMESTAMP,
+        last_withdrawal TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users(id)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS transactions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        type TEXT NOT NULL,
+        amount REAL NOT NULL,
+        status TEXT DEFAULT 'pending',
+        paypal_order_id TEXT,
+        description TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        completed_at TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users(id)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS friends (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        friend_id INTEGER NOT NULL,
+        status TEXT DEFAULT 'pending',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users(id),
+        FOREIGN KEY (friend_id) REFERENCES users(id),
+        UNIQUE(user_id, friend_id)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS private_games (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        creator_id INTEGER NOT NULL,
+        game_name TEXT NOT NULL,
+        password TEXT NOT NULL,
+        game_type TEXT DEFAULT 'cash',
+        small_blind REAL DEFAULT 0.10,
+        big_blind REAL DEFAULT 0.20,
+        min_buy_in REAL DEFAULT 5.0,
+        max_buy_in REAL DEFAULT 50.0,
+        max_players INTEGER DEFAULT 6,
+        status TEXT DEFAULT 'waiting',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (creator_id) REFERENCES users(id)
+    )
+    '''
+]
+
+MIGRATIONS = [
+    (1, "base schema (v14)", SCHEMA_V1),
+    (2, "users.is_banned", [lambda db: _add_column(db, "users", "is_banned", "INTEGER DEFAULT 0")]),
+    (3, "indexes for hot queries", [
+        "CREATE INDEX IF NOT EXISTS idx_statistics_user ON statistics(user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_statistics_games_won ON statistics(games_won DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_wallets_balance ON wallets(balance DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_transactions_user_created ON transactions(user_id, created_at DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_transactions_created ON transactions(created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_transactions_paypal_order ON transactions(paypal_order_id) WHERE paypal_order_id IS NOT NULL",
+        "CREATE INDEX IF NOT EXISTS idx_transactions_status_type ON transactions(status, type, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_game_history_user_created ON game_history(user_id, created_at DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_game_history_created ON game_history(created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_friends_friend_status ON friends(friend_id, status)",
+        "CREATE INDEX IF NOT EXISTS idx_friends_user_status ON friends(user_id, status)",
+        "CREATE INDEX IF NOT EXISTS idx_private_games_name ON private_games(game_name)",
+        "CREATE INDEX IF NOT EXISTS idx_private_games_status_created ON private_games(status, created_at)",
+        "ANALYZE",
+    ]),
+    (4, "game_history.hand_id", [lambda db: _add_column(db, "game_history", "hand_id", "INTEGER")]),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+async def apply_migrations(db, target: int = None):
+    """Bring the database up to `target` (default: latest). Returns the versions applied."""
+    target = SCHEMA_VERSION if target is None else target
+    cursor = await db.execute("PRAGMA user_version")
+    current = (await cursor.fetchone())[0]
+    applied = []
+    for version, name, steps in MIGRATIONS:
+        if version <= current or version > target:
+            continue
+        try:
+            # Explicit BEGIN: sqlite3 does not open a transaction around DDL on its own
+            await db.execute("BEGIN")
+            for step in steps:
+                if callable(step):
+                    await step(db)
+                else:
+                    await db.execute(step)
+            # user_version is transactional: it only moves if the whole step commits
+            await db.execute(f"PRAGMA user_version = {version}")
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+        print(f"Migration {version} applied: {name}")
+        applied.append(version)
+    return applied
+
 # PayPal Configuration
 PAYPAL_CLIENT_ID = os.environ.get('PAYPAL_CLIENT_ID', 'ATGUiTFJ0G6kKrJ4RYJ0sg80pZ3qlTqK8WFkIieVu2fU0X354vLFsyel8QVKleajel1ZpgslVsliuVAI')
 PAYPAL_SECRET = os.environ.get('PAYPAL_SECRET', 'EPsoCGBkuF3LI8KQKbTWBDhjw6f4gc2RUscrAw9W3baDJlU-0ZyKnuU6qVmAnGbzmn12AcMNcbRRYGgB')
 # PAYPAL_API_BASE = "https://api-m.sandbox.paypal.com" # SANDBOX
-PAYPAL_API_BASE = "https://api-m.paypal.com" # LIVE
+# Override with the sandbox or a local paypal_stub.py for offline tests
+PAYPAL_API_BASE = os.environ.get('PAYPAL_API_BASE', "https://api-m.paypal.com").rstrip("/") # LIVE
 
 # Security Questions (5 options)
 SECURITY_QUESTIONS = [
@@ -237,33 +1645,94 @@ SECURITY_QUESTIONS = [
 ]
 
 class PayPalClient:
-    def __init__(self):
+    """PayPal REST client sharing one pooled keep-alive session.
+
+    The OAuth token is refreshed single-flight: concurrent callers wait on one
+    request instead of all fetching a token. Calls are retried with exponential
+    backoff on network errors, 429 and 5xx; POSTs carry a PayPal-Request-Id kept
+    across retries so PayPal applies them at most once.
+    """
+    RETRIES = 3
+    BACKOFF = 0.25 # seconds, doubled per attempt
+    TIMEOUT = aiohttp.ClientTimeout(total=15, connect=5)
+    POOL_SIZE = 20
+
+    def __init__(self, api_base: str = None, client_id: str = None, secret: str = None):
+        self.api_base = api_base or PAYPAL_API_BASE
+        self.client_id = client_id or PAYPAL_CLIENT_ID
+        self.secret = secret or PAYPAL_SECRET
         self.access_token = None
         self.token_expires = 0
-    
+        self._session = None
+        self._token_lock = asyncio.Lock()
+        self.stats = {"requests": 0, "retries": 0, "token_refreshes": 0}
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.POOL_SIZE, keepalive_timeout=60, ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.TIMEOUT)
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
     async def get_access_token(self) -> str:
         if self.access_token and time.time() < self.token_expires:
             return self.access_token
-        
-        auth = aiohttp.BasicAuth(PAYPAL_CLIENT_ID, PAYPAL_SECRET)
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"{PAYPAL_API_BASE}/v1/oauth2/token",
-                auth=auth,
-                data={"grant_type": "client_credentials"}
-            ) as resp:
-                if resp.status != 200:
-                    error = await resp.text()
-                    raise Exception(f"PayPal auth failed: {error}")
-                data = await resp.json()
-                self.access_token = data["access_token"]
-                self.token_expires = time.time() + data["expires_in"] - 60
+        async with self._token_lock:
+            # Another caller may have refreshed it while we waited
+            if self.access_token and time.time() < self.token_expires:
                 return self.access_token
+            basic = base64.b64encode(f"{self.client_id}:{self.secret}".encode()).decode()
+            status, data = await self._send("POST", "/v1/oauth2/token",
+                                            headers={"Authorization": f"Basic {basic}"},
+                                            data={"grant_type": "client_credentials"})
+            if status != 200:
+                raise Exception(f"PayPal auth failed: {data}")
+            self.stats["token_refreshes"] += 1
+            self.access_token = data["access_token"]
+            self.token_expires = time.time() + data["expires_in"] - 60
+            return self.access_token
+
+    async def _send(self, method, path, **kwargs):
+        """One HTTP call with retries; returns (status, parsed body)."""
+        session = self._get_session()
+        for attempt in range(self.RETRIES + 1):
+            self.stats["requests"] += 1
+            try:
+                async with session.request(method, self.api_base + path, **kwargs) as resp:
+                    try:
+                        data = await resp.json(content_type=None)
+                    except ValueError:
+                        data = await resp.text()
+                    if (resp.status == 429 or resp.status >= 500) and attempt < self.RETRIES:
+                        raise aiohttp.ClientResponseError(resp.request_info, (), status=resp.status)
+                    return resp.status, data
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt >= self.RETRIES:
+                    raise
+            self.stats["retries"] += 1
+            await asyncio.sleep(self.BACKOFF * (2 ** attempt) * (0.5 + random.random()))
+
+    async def _call(self, method, path, json_body=None):
+        headers = {"Content-Type": "application/json"}
+        if method == "POST":
+            headers["PayPal-Request-Id"] = uuid.uuid4().hex
+        for _ in range(2):
+            token = await self.get_access_token()
+            headers["Authorization"] = f"Bearer {token}"
+            status, data = await self._send(method, path, headers=headers, json=json_body)
+            if status != 401:
+                break
+            # Token revoked or expired early: drop it and refresh once
+            if self.access_token == token:
+                self.access_token = None
+        return status, data
     
     async def create_order(self, amount: float, currency: str = "EUR",
                           description: str = "Poker Chips Deposit") -> dict:
-        token = await self.get_access_token()
-        
         order_data = {
             "intent": "CAPTURE",
             "purchase_units": [{
@@ -282,51 +1751,21 @@ class PayPalClient:
             }
         }
         
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"{PAYPAL_API_BASE}/v2/checkout/orders",
-                headers={
-                    "Content-Type": "application/json",
-                    "Authorization": f"Bearer {token}"
-                },
-                json=order_data
-            ) as resp:
-                if resp.status not in (200, 201):
-                    error = await resp.text()
-                    raise Exception(f"PayPal order failed: {error}")
-                return await resp.json()
+        status, data = await self._call("POST", "/v2/checkout/orders", order_data)
+        if status not in (200, 201):
+            raise Exception(f"PayPal order failed: {data}")
+        return data
     
     async def capture_order(self, order_id: str) -> dict:
-        token = await self.get_access_token()
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"{PAYPAL_API_BASE}/v2/checkout/orders/{order_id}/capture",
-                headers={
-                    "Content-Type": "application/json",
-                    "Authorization": f"Bearer {token}"
-                }
-            ) as resp:
-                return await resp.json()
+        return (await self._call("POST", f"/v2/checkout/orders/{order_id}/capture"))[1]
     
     async def get_order(self, order_id: str) -> dict:
-        token = await self.get_access_token()
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                f"{PAYPAL_API_BASE}/v2/checkout/orders/{order_id}",
-                headers={
-                    "Authorization": f"Bearer {token}"
-                }
-            ) as resp:
-                return await resp.json()
+        return (await self._call("GET", f"/v2/checkout/orders/{order_id}"))[1]
     
     async def create_payout(self, email: str, amount: float, currency: str = "EUR") -> dict:
-        token = await self.get_access_token()
-        
         payout_data = {
             "sender_batch_header": {
-                "sender_batch_id": f"Payout_{int(time.time())}",
+                "sender_batch_id": f"Payout_{int(time.time())}_{uuid.uuid4().hex[:8]}",
                 "email_subject": "PokerTexas - Prelievo",
                 "email_message": "Hai ricevuto un pagamento da PokerTexas"
             },
@@ -341,20 +1780,11 @@ class PayPalClient:
             }]
         }
         
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"{PAYPAL_API_BASE}/v1/payments/payouts",
-                headers={
-                    "Content-Type": "application/json",
-                    "Authorization": f"Bearer {token}"
-                },
-                json=payout_data
-            ) as resp:
-                return await resp.json()
+        return (await self._call("POST", "/v1/payments/payouts", payout_data))[1]
 
 class PokerTable:
     def __init__(self, table_id: str, name: str, small_blind: float, big_blind: float, 
-                 min_buy_in: float, max_buy_in: float, max_players: int = 6, creator_id: int = None, creator_username: str = "Unknown"):
+                 min_buy_in: float, max_buy_in: float, max_players: int = 6, creator_id: int = None, creator_username: str = "Unknown", rng=None):
         self.table_id = table_id
         self.name = name
         self.small_blind = small_blind
@@ -369,7 +1799,8 @@ class PokerTable:
         self.dealer_position = 0
         self.current_player = None # user_id
         self.pot = 0.0
-        self.community_cards = []
+        self.community_cards = [] # card codes in deal order
+        self.board_mask = 0
         self.game_phase = "waiting"  # waiting, preflop, flop, turn, river, showdown
         self.current_bet = 0.0
         self.last_action_time = None
@@ -377,12 +1808,22 @@ class PokerTable:
         self.password = None
         
         # Game State
-        self.deck = Deck()
+        self.deck = Deck(rng)
         self.winners = []
         self.hand_result = ""
         self.round_bets = {} # user_id -> amount bet in current street
         self.active_seat_order = [] # list of user_ids in seat order for current hand
         self.players_acted = set() # user_ids who acted in current round
+        self.hand_number = 0
+        self.equity_request = None # all-in spot waiting for an equity calculation
+        self.equity = None # [{user_id, win, tie, equity}] once calculated
+        self.running_out = False # all-in: the board comes one street at a time, see run_out_street
+        self.seq = 0 # version of the last published state, see publish()
+        self._published = None
+        self.contributions = {} # user_id -> chips put in the pot this hand
+        self.journal_seq = 0 # last TableStore journal record applied to this table
+        self.hand_log = [] # events of the hand in progress, see HandHistory
+        self.finished_hand = None # (table_id, hand_number, events) until the server takes it
 
     def add_player(self, user_id: int, username: str, chips: float, position: int = None):
         if len(self.players) >= self.max_players:
@@ -403,6 +1844,7 @@ class PokerTable:
             'is_active': True,
             'is_sitting_out': False,
             'cards': [],
+            'hand_mask': 0,
             'current_bet': 0.0,
             'folded': False,
             'all_in': False
@@ -416,23 +1858,40 @@ class PokerTable:
     
     def remove_player(self, user_id: int):
         if user_id in self.players:
-            chips = self.players[user_id]['chips']
-            del self.players[user_id]
-            
-            # If game in progress, handle fold
+            # If game in progress, handle fold (while still seated, so the turn passes on)
             if self.game_phase != "waiting" and self.current_player == user_id:
                 self.handle_action(user_id, "fold")
+            elif self.game_phase not in ("waiting", "showdown") and user_id in self.active_seat_order:
+                # Out of turn: fold in place, and a last contender takes the pot now
+                self.players[user_id]['folded'] = True
+                self.hand_log.append(("fold", user_id))
+                non_folded = [uid for uid in self.active_seat_order if not self.players[uid]['folded']]
+                if len(non_folded) == 1:
+                    self._end_hand_winner(non_folded[0])
             
-            # Check if game should end
+            chips = self.players[user_id]['chips']
+            del self.players[user_id]
+            if user_id in self.active_seat_order:
+                self.active_seat_order.remove(user_id)
+            
+            # Check if game should end. A hand in progress still has two contenders
+            # (a last one already took the pot above), sitting out or not: it plays
+            # on and the turn timer checks or folds for them
             active_players = [p for p in self.players.values() if not p['is_sitting_out']]
-            if len(active_players) < 2:
+            if len(active_players) < 2 and self.game_phase in ("waiting", "showdown"):
                 self.game_phase = "waiting"
                 self.pot = 0
                 self.community_cards = []
+                self.board_mask = 0
                 
             return chips
         return 0
 
+    def sit_out(self, user_id: int):
+        # Disconnected or timed out: skipped from the next hand on
+        if user_id in self.players:
+            self.players[user_id]['is_sitting_out'] = True
+
     def start_hand(self):
         active_players = [uid for uid, p in self.players.items() if not p['is_sitting_out'] and p['chips'] > 0]
         if len(active_players) < 2:
@@ -458,14 +1917,25 @@ class PokerTable:
         self.game_phase = "preflop"
         self.pot = 0.0
         self.community_cards = []
-        self.deck = Deck()
+        self.board_mask = 0
+        self.deck.shuffle()
+        self.hand_number += 1
+        self.equity_request = None
+        self.equity = None
+        self.running_out = False
         self.winners = []
         self.hand_result = ""
         self.round_bets = {uid: 0.0 for uid in active_players}
         self.players_acted = set()
+        self.contributions = {}
+        self.hand_log = [("start", time.time(), self.dealer_position,
+                          [(uid, self.players[uid]['position'], self.players[uid]['chips']) for uid in active_players])]
         
         for uid in active_players:
-            self.players[uid]['cards'] = self.deck.deal(2)
+            cards = self.deck.deal(2)
+            self.hand_log.append(("deal", uid, cards[0], cards[1]))
+            self.players[uid]['cards'] = cards
+            self.players[uid]['hand_mask'] = Card.mask(cards)
             self.players[uid]['current_bet'] = 0.0
             self.players[uid]['folded'] = False
             self.players[uid]['all_in'] = False
@@ -498,6 +1968,8 @@ class PokerTable:
         player['current_bet'] = bet
         self.pot += bet
         self.round_bets[user_id] = bet
+        self.contributions[user_id] = self.contributions.get(user_id, 0.0) + bet
+        self.hand_log.append(("blind", user_id, bet))
         if player['chips'] == 0:
             player['all_in'] = True
 
@@ -525,7 +1997,9 @@ class PokerTable:
         if action == "fold":
             player['folded'] = True
             player['cards'] = []
+            player['hand_mask'] = 0
             player['last_action'] = "FOLD"
+            self.hand_log.append(("fold", user_id))
             
         elif action == "call":
             to_call = self.current_bet - player['current_bet']
@@ -535,9 +2009,12 @@ class PokerTable:
                 player['all_in'] = True
             
             player['chips'] -= to_call
-            player['current_bet'] += to_call
+            # Assigned, not added: float sums can miss current_bet by an ulp and never match
+            player['current_bet'] = player['current_bet'] + to_call if player['all_in'] else self.current_bet
             self.pot += to_call
+            self.contributions[user_id] = self.contributions.get(user_id, 0.0) + to_call
             self.round_bets[user_id] = player['current_bet']
+            self.hand_log.append(("call", user_id, to_call))
             player['last_action'] = "CALL"
             if player['all_in']: player['last_action'] = "ALL-IN"
             
@@ -545,6 +2022,7 @@ class PokerTable:
             if player['current_bet'] < self.current_bet:
                 return False, "Cannot check, must call"
             player['last_action'] = "CHECK"
+            self.hand_log.append(("check", user_id))
                 
         elif action == "raise":
             if amount < self.current_bet * 2: # Min raise
@@ -559,16 +2037,21 @@ class PokerTable:
                 return False, "Not enough chips"
                 
             player['chips'] -= to_add
-            player['current_bet'] += to_add
+            player['current_bet'] = total_bet
             self.pot += to_add
-            self.current_bet = total_bet
+            self.contributions[user_id] = self.contributions.get(user_id, 0.0) + to_add
+            self.current_bet = max(self.current_bet, total_bet) # a short all-in does not lower the bet
             self.round_bets[user_id] = player['current_bet']
+            self.hand_log.append(("raise", user_id, to_add))
             player['last_action'] = "RAISE"
             
             if player['chips'] == 0:
                 player['all_in'] = True
                 player['last_action'] = "ALL-IN"
 
+        else:
+            return False, "Unknown action"
+
         # Check if round complete or next player
         self.players_acted.add(user_id)
         self._next_turn()
@@ -636,16 +2119,26 @@ class PokerTable:
             
         self.current_bet = 0.0
         self.players_acted = set()
+
+        # Nobody left to bet against: the board is run out one street at a time
+        # (run_out_street), each after the players have seen their equity
+        contenders = [uid for uid in self.active_seat_order if not self.players[uid]['folded']]
+        can_act = [uid for uid in contenders if not self.players[uid]['all_in']]
+        if len(can_act) < 2 and self.game_phase in ("preflop", "flop", "turn"):
+            self.running_out = True
+            self.current_player = None
+            self._request_equity()
+            return
         
         if self.game_phase == "preflop":
             self.game_phase = "flop"
-            self.community_cards = self.deck.deal(3)
+            self._deal_board(3)
         elif self.game_phase == "flop":
             self.game_phase = "turn"
-            self.community_cards += self.deck.deal(1)
+            self._deal_board(1)
         elif self.game_phase == "turn":
             self.game_phase = "river"
-            self.community_cards += self.deck.deal(1)
+            self._deal_board(1)
         elif self.game_phase == "river":
             self.game_phase = "showdown"
             self._evaluate_showdown()
@@ -667,20 +2160,47 @@ class PokerTable:
                 next_player = uid
                 break
                 
-        if next_player:
-            self.current_player = next_player
-        else:
-            # Everyone all-in? Run it out
-            while len(self.community_cards) < 5:
-                self.community_cards += self.deck.deal(1)
+        self.current_player = next_player
+
+    def run_out_street(self):
+        """Deal the next street of an all-in run-out, or go to showdown after the river."""
+        if not self.running_out or self.game_phase not in ("preflop", "flop", "turn", "river"):
+            self.running_out = False
+            return False, "Nessun run-out in corso"
+        if self.game_phase == "river":
             self.game_phase = "showdown"
             self._evaluate_showdown()
+            return True, self.game_phase
+        if self.game_phase == "preflop":
+            self.game_phase = "flop"
+            self._deal_board(3)
+        else:
+            self.game_phase = "turn" if self.game_phase == "flop" else "river"
+            self._deal_board(1)
+        self._request_equity()
+        return True, self.game_phase
+
+    def _request_equity(self):
+        # Remember the all-in spot so players and spectators can see equities
+        self.equity_request = {
+            "hands": {uid: list(self.players[uid]['cards'])
+                      for uid in self.active_seat_order if not self.players[uid]['folded']},
+            "board": list(self.community_cards)
+        }
+
+    def _deal_board(self, n):
+        cards = self.deck.deal(n)
+        self.community_cards += cards
+        self.board_mask |= Card.mask(cards)
+        self.hand_log.append(("board", cards))
 
     def _end_hand_winner(self, winner_id):
         # Single winner (everyone else folded)
         self.players[winner_id]['chips'] += self.pot
         self.winners = [{"user_id": winner_id, "amount": self.pot, "hand": "Opponents Folded"}]
         self.game_phase = "showdown"
+        self.hand_log.append(("win", winner_id, self.pot))
+        self._finish_hand()
         # Reset timer would go here
         
     def _evaluate_showdown(self):
@@ -689,7 +2209,7 @@ class PokerTable:
         for uid in self.active_seat_order:
             p = self.players[uid]
             if not p['folded']:
-                score, desc = HandEvaluator.evaluate(p['cards'], self.community_cards)
+                score, desc = HandEvaluator.evaluate_mask(p['hand_mask'] | self.board_mask)
                 results.append({"user_id": uid, "score": score, "desc": desc})
         
         # Sort by score desc
@@ -708,11 +2228,20 @@ class PokerTable:
             self.players[w['user_id']]['chips'] += split_amount
             w['amount'] = split_amount
             w['hand'] = w['desc']
+            self.hand_log.append(("win", w['user_id'], split_amount))
             
         self.winners = winners
         self.hand_result = ", ".join([f"{w['desc']}" for w in winners])
+        self._finish_hand()
+
+    def _finish_hand(self):
+        self.running_out = False
+        self.finished_hand = (self.table_id, self.hand_number, self.hand_log)
+        self.hand_log = []
     
-    def get_state(self, for_user_id: int = None):
+    def get_state(self, for_user_id: int = None, private_cards=None):
+        # private_cards(uid) replaces the hidden cards of players whose hand is
+        # not public, see PokerServer._splice_private_cards
         players_state = []
         for uid, p in self.players.items():
             cards = []
@@ -720,9 +2249,11 @@ class PokerTable:
             # 1. It's the user themselves
             # 2. It's showdown and player didn't fold
             if for_user_id == uid or (self.game_phase == "showdown" and not p['folded']):
-                cards = [c.to_dict() for c in p['cards']]
+                cards = [Card.to_dict(c) for c in p['cards']]
             elif p['folded']:
                  cards = [] # Folded cards hidden
+            elif p['cards'] and private_cards:
+                 cards = private_cards(uid)
             else:
                  cards = [{"rank": "?", "suit": "?", "value": 0}, {"rank": "?", "suit": "?", "value": 0}] if p['cards'] else []
 
@@ -754,17 +2285,839 @@ class PokerTable:
             'dealer_position': self.dealer_position,
             'current_player': self.current_player,
             'pot': self.pot,
-            'community_cards': [c.to_dict() for c in self.community_cards],
+            'community_cards': [Card.to_dict(c) for c in self.community_cards],
             'game_phase': self.game_phase,
             'current_bet': self.current_bet,
-            'winners': self.winners
+            'winners': self.winners,
+            'equity': self.equity if self.game_phase != "showdown" else None, # the result replaces it
+            'seq': self.seq
         }
 
+    SNAPSHOT_FIELDS = ('table_id', 'name', 'small_blind', 'big_blind', 'min_buy_in', 'max_buy_in', 'max_players',
+                       'creator_id', 'creator_username', 'is_private', 'password', 'dealer_position', 'current_player',
+                       'pot', 'community_cards', 'board_mask', 'game_phase', 'current_bet', 'winners', 'hand_result',
+                       'active_seat_order', 'hand_number', 'seq', 'journal_seq')
+
+    def snapshot(self):
+        """Everything needed to rebuild the table, as JSON-safe values (see TableStore).
+        Pending equity requests and the last published state are not kept."""
+        state = {key: getattr(self, key) for key in self.SNAPSHOT_FIELDS}
+        state['players'] = [[uid, p] for uid, p in self.players.items()]
+        state['round_bets'] = list(self.round_bets.items())
+        state['contributions'] = list(self.contributions.items())
+        state['players_acted'] = list(self.players_acted)
+        state['deck'] = bytes(self.deck.cards).hex()
+        state['deck_position'] = self.deck.position
+        state['hand_log'] = self.hand_log
+        state['running_out'] = self.running_out
+        return state
+
+    @classmethod
+    def from_snapshot(cls, state):
+        table = cls(state['table_id'], state['name'], state['small_blind'], state['big_blind'],
+                    state['min_buy_in'], state['max_buy_in'], state['max_players'])
+        for key in cls.SNAPSHOT_FIELDS:
+            setattr(table, key, state[key])
+        table.players = {uid: p for uid, p in state['players']}
+        table.round_bets = dict(state['round_bets'])
+        table.contributions = dict(state['contributions'])
+        table.players_acted = set(state['players_acted'])
+        table.deck.cards = list(bytes.fromhex(state['deck']))
+        table.deck.position = state['deck_position']
+        table.hand_log = state.get('hand_log', [])
+        table.running_out = state.get('running_out', False)
+        return table
+
+    def refunds(self):
+        """user_id -> chips owed if the table is closed right now.
+
+        A hand in progress is voided: everyone seated gets back what they put in,
+        and what players who already left put in is shared by the contenders
+        still in the hand (the first ones in seat order get the odd cent).
+        """
+        owed = {uid: p['chips'] for uid, p in self.players.items()}
+        if self.game_phase in ("waiting", "showdown"):
+            return {uid: round(c, 2) for uid, c in owed.items() if c > 0}
+        for uid, amount in self.contributions.items():
+            if uid in owed:
+                owed[uid] += amount
+        orphaned = round(self.pot - sum(a for uid, a in self.contributions.items() if uid in owed), 2)
+        contenders = [uid for uid in self.active_seat_order if uid in owed and not self.players[uid]['folded']] or list(owed)
+        if orphaned > 0 and contenders:
+            cents = int(round(orphaned * 100))
+            share, extra = divmod(cents, len(contenders))
+            for i, uid in enumerate(contenders):
+                owed[uid] += (share + (1 if i < extra else 0)) / 100
+        return {uid: round(c, 2) for uid, c in owed.items() if c > 0}
+
+    def publish(self, private_cards=None):
+        """Snapshot the state for a broadcast.
+
+        Bumps seq when anything changed since the previous publish and returns
+        (seq, state, ops), ops being the changes from seq - 1 to seq (None on
+        the first publish). Ops are idempotent:
+          ["set", key, value]          top level field
+          ["player", user_id, fields]  changed (or, for a new player, all) fields
+          ["remove_player", user_id]
+        """
+        state = self.get_state(private_cards=private_cards)
+        previous = self._published
+        ops = self._diff(previous, state) if previous is not None else None
+        if ops is None or ops:
+            self.seq += 1
+        state['seq'] = self.seq
+        self._published = state
+        return self.seq, state, ops
+
+    @staticmethod
+    def _diff(old, new):
+        ops = []
+        for key, value in new.items():
+            if key not in ('players', 'seq') and old.get(key) != value:
+                ops.append(["set", key, value])
+        old_players = {p['user_id']: p for p in old['players']}
+        for p in new['players']:
+            before = old_players.pop(p['user_id'], None)
+            if before is None:
+                ops.append(["player", p['user_id'], p])
+                continue
+            changed = {k: v for k, v in p.items() if before.get(k) != v}
+            if changed:
+                ops.append(["player", p['user_id'], changed])
+        for uid in old_players:
+            ops.append(["remove_player", uid])
+        return ops
+
+# ==========================================
+# TABLE SNAPSHOTS
+# ==========================================
+
+class RecordedShuffle:
+    """Stands in for Deck.rng while replaying: 'shuffles' to a journaled order."""
+    def __init__(self, order):
+        self.order = order
+
+    def shuffle(self, cards):
+        cards[:] = self.order
+
+class TableStore:
+    """Crash recovery for the in-memory tables: per table, a snapshot file and
+    an append-only journal of what happened since.
+
+    Every table mutation made by the server goes through PokerServer._apply,
+    which appends [seq, op, args, deck] to <table_id>.log; deck is the new
+    order when the call dealt a hand, so a replay deals the same cards.
+    Dirty tables are snapshotted to <table_id>.snap, oldest first, with at
+    most `budget` seconds spent per tick; a snapshot covers (and truncates)
+    the journal. Journal writes go straight to the OS, so a killed process
+    loses nothing; there is no fsync, so a power cut can.
+    """
+    OPS = ("add_player", "remove_player", "handle_action", "start_hand", "sit_out")
+
+    def __init__(self, directory: str, interval: float = 1.0, budget: float = 0.005, metrics: "Metrics" = None):
+        self.directory = directory
+        self.interval = interval
+        self.budget = budget # seconds of snapshot work per tick
+        self.metrics = metrics
+        self.enabled = False # until open(): tests and simulations keep tables in memory only
+        self._known = {} # table_id -> table object the snapshot on disk belongs to
+        self._dirty = OrderedDict() # table_id -> table with journal records after its snapshot, oldest first
+        self.stats_data = {"records": 0, "snapshots": 0, "snapshot_seconds": 0.0, "deferred_ticks": 0}
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.enabled = True
+
+    def _path(self, table_id, ext):
+        return os.path.join(self.directory, f"{table_id}.{ext}")
+
+    def table_ids(self):
+        return sorted(name[:-5] for name in os.listdir(self.directory) if name.endswith(".snap"))
+
+    @property
+    def dirty(self):
+        return len(self._dirty)
+
+    def before(self, table):
+        # A journal needs a base: snapshot a table (or a new object under an old id) before its first record
+        if self.enabled and self._known.get(table.table_id) is not table:
+            self.snapshot(table)
+
+    def record(self, table, op, args, deck=None):
+        if not self.enabled:
+            return
+        table.journal_seq += 1
+        line = json.dumps([table.journal_seq, op, args, bytes(deck).hex() if deck is not None else None],
+                          separators=(",", ":")).encode() + b"\n"
+        fd = os.open(self._path(table.table_id, "log"), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+        self._dirty.setdefault(table.table_id, table)
+        self.stats_data["records"] += 1
+
+    def snapshot(self, table):
+        start = time.perf_counter()
+        path = self._path(table.table_id, "snap")
+        with open(path + ".tmp", "wb") as f:
+            f.write(json.dumps(table.snapshot(), separators=(",", ":")).encode())
+        os.replace(path + ".tmp", path)
+        # Everything journaled so far is in the snapshot (replay also skips records by seq)
+        with contextlib.suppress(FileNotFoundError):
+            os.truncate(self._path(table.table_id, "log"), 0)
+        self._known[table.table_id] = table
+        self._dirty.pop(table.table_id, None)
+
+        elapsed = time.perf_counter() - start
+        self.stats_data["snapshots"] += 1
+        self.stats_data["snapshot_seconds"] += elapsed
+        if self.metrics is not None:
+            self.metrics.observe("poker_snapshot_seconds", elapsed)
+        return elapsed
+
+    def tick(self):
+        spent = 0.0
+        while self._dirty: # at least one per tick, so a slow disk still makes progress
+            spent += self.snapshot(next(iter(self._dirty.values())))
+            if spent >= self.budget:
+                break
+        if self._dirty:
+            self.stats_data["deferred_ticks"] += 1 # over budget: the rest go first next tick
+
+    def flush(self):
+        for table in list(self._dirty.values()):
+            self.snapshot(table)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.tick()
+            except Exception as e:
+                print(f"Table snapshot failed: {e}")
+
+    def release(self, table_id):
+        # Table moves to another process, which continues the same files
+        table = self._dirty.get(table_id)
+        if table is not None:
+            self.snapshot(table)
+        self._known.pop(table_id, None)
+
+    def forget(self, table_id):
+        # Table closed: its chips were settled elsewhere, nothing to recover
+        self._known.pop(table_id, None)
+        self._dirty.pop(table_id, None)
+        for ext in ("snap", "log"):
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(self._path(table_id, ext))
+
+    def load(self, table_id):
+        """Rebuild a table from its snapshot and journal.
+
+        Returns (table, error). A torn last record (the process died while
+        writing it) just ends the journal; any other bad record stops the
+        replay there and is reported, with the table as far as it got.
+        """
+        with open(self._path(table_id, "snap"), "rb") as f:
+            table = PokerTable.from_snapshot(json.loads(f.read()))
+        try:
+            with open(self._path(table_id, "log"), "rb") as f:
+                lines = f.read().split(b"\n")
+        except FileNotFoundError:
+            lines = []
+        for i, raw in enumerate(lines):
+            if not raw:
+                continue
+            try:
+                seq, op, args, deck = json.loads(raw)
+            except ValueError:
+                if i == len(lines) - 1:
+                    break
+                return table, f"unreadable journal record after seq {table.journal_seq}"
+            if seq <= table.journal_seq:
+                continue
+            if op not in self.OPS:
+                return table, f"unknown journal op {op!r} at seq {seq}"
+            rng = table.deck.rng
+            if deck is not None:
+                table.deck.rng = RecordedShuffle(list(bytes.fromhex(deck)))
+            try:
+                getattr(table, op)(*args)
+            except Exception as e:
+                return table, f"replay of {op} at seq {seq} failed: {e}"
+            finally:
+                table.deck.rng = rng
+            table.journal_seq = seq
+        return table, None
+
+    def stats(self):
+        return dict(self.stats_data, dirty=self.dirty, tables=len(self._known))
+
+# ==========================================
+# HAND HISTORY
+# ==========================================
+
+class HandHistory:
+    """Append-only binary log of finished hands, with replay.
+
+    PokerTable keeps the events of the hand in progress (hand_log); when a
+    hand ends the server passes them to submit(), which only queues them, and
+    a writer thread encodes and appends, so the game loop never waits on the
+    disk. Records go to memory-mapped segment files (<n>.hh, segment_size
+    bytes each, a new one when full). A record's length is written after its
+    body, so a crash mid-write leaves a zero length that ends the scan. The
+    indexes by table, user and time are kept in memory and rebuilt by
+    scanning the segments on open().
+
+    Hand ids are source << 48 | sequence: each process writing a log has its
+    own source (0 for a single server, 1 + n for shard worker wn).
+
+    Record layout, little endian, amounts in cents:
+      u32 length
+      u64 hand_id, u32 hand_number, f64 started, f64 ended, u8 dealer position,
+      u8 seats, u8 len(table_id), table_id
+      seats x (u32 user_id, u8 position, i64 chips at the start)
+      events until the end: u8 kind, then u8 board size + cards for "board",
+      else u8 seat and two cards (deal), an i64 amount (blind, call, raise,
+      win) or nothing (fold, check)
+    """
+    SEGMENT_SIZE = 64 * 1024 * 1024
+    KINDS = ("deal", "blind", "fold", "check", "call", "raise", "board", "win")
+    CODES = {kind: code for code, kind in enumerate(KINDS)}
+    AMOUNT_KINDS = ("blind", "call", "raise", "win")
+    LENGTH = struct.Struct("<I")
+    HEADER = struct.Struct("<QIddBBB")
+    SEAT = struct.Struct("<IBq")
+    AMOUNT = struct.Struct("<BBq")
+    HIDDEN_CARD = {"rank": "?", "suit": "?", "value": 0}
+
+    def __init__(self, directory: str, source: int = 0, segment_size: int = SEGMENT_SIZE, interval: float = 0.05):
+        self.directory = directory
+        self.source = source
+        self.segment_size = segment_size
+        self.interval = interval # writer thread wakeup period
+        self.enabled = False # until open(): tests and simulations keep no history
+        self._queue = deque() # (hand_id, table_id, hand_number, ended, events); deque appends are thread safe
+        self._seq = itertools.count(1)
+        self._submitted = 0
+        self._segments = [] # mmap per segment file, in order
+        self._offset = 0 # append position in the last segment
+        self._where = {} # hand_id -> (segment, offset, table_id)
+        self._by_table = {} # table_id -> [hand_id], ascending
+        self._by_user = {} # user_id -> [hand_id], ascending
+        self._order = [] # hand ids in log order
+        self._ended = [] # end time of each hand in _order
+        self._thread = None
+        self._closing = False
+        self._wakeup = threading.Event()
+        self.stats_data = {"hands": 0, "bytes": 0, "write_seconds": 0.0, "errors": 0}
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(".hh"))
+        last_seq = 0
+        for name in names:
+            with open(os.path.join(self.directory, name), "r+b") as f:
+                mm = mmap.mmap(f.fileno(), 0)
+            self._segments.append(mm)
+            offset = 0
+            while offset + 4 <= len(mm):
+                length = self.LENGTH.unpack_from(mm, offset)[0]
+                if length == 0:
+                    break
+                hand_id = self._index(mm, len(self._segments) - 1, offset)
+                last_seq = max(last_seq, hand_id & 0xFFFFFFFFFFFF)
+                offset += 4 + length
+            self._offset = offset
+        if not self._segments:
+            self._new_segment()
+        self._seq = itertools.count(last_seq + 1)
+        self.enabled = True
+        self._thread = threading.Thread(target=self._run, name="hand-history", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Write out what is queued and stop the writer thread."""
+        if self._thread is None:
+            return
+        self._closing = True
+        self._wakeup.set()
+        self._thread.join()
+        self._thread = None
+        for mm in self._segments:
+            mm.flush()
+            mm.close()
+        self._segments = []
+        self.enabled = False
+
+    @property
+    def queued(self):
+        return len(self._queue)
+
+    def submit(self, table_id, hand_number, events):
+        """Queue a finished hand (PokerTable.finished_hand) and return its id."""
+        if not self.enabled:
+            return None
+        hand_id = self.source << 48 | next(self._seq)
+        self._queue.append((hand_id, table_id, hand_number, time.time(), events))
+        self._submitted += 1
+        return hand_id
+
+    def flush(self, timeout=5.0):
+        """Wait until every submitted hand is written (for tests and tools, not the game loop)."""
+        deadline = time.monotonic() + timeout
+        self._wakeup.set()
+        while self.stats_data["hands"] + self.stats_data["errors"] < self._submitted and time.monotonic() < deadline:
+            time.sleep(0.001)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            closing = self._closing
+            while self._queue:
+                record = self._queue.popleft()
+                try:
+                    self._append(record[0], self._encode(*record))
+                except Exception as e:
+                    self.stats_data["errors"] += 1
+                    print(f"Hand history: hand {record[0]} not written ({e})")
+            if closing:
+                return
+
+    def _new_segment(self):
+        path = os.path.join(self.directory, f"{len(self._segments):06d}.hh")
+        with open(path, "w+b") as f:
+            f.truncate(self.segment_size) # sparse: zeros, so the scan stops at the end of the data
+            mm = mmap.mmap(f.fileno(), 0)
+        self._segments.append(mm)
+        self._offset = 0
+
+    def _append(self, hand_id, data):
+        start = time.perf_counter()
+        size = 4 + len(data)
+        if size > self.segment_size:
+            raise ValueError(f"record of {size} bytes does not fit in a segment")
+        if self._offset + size > self.segment_size:
+            self._new_segment()
+        mm, offset = self._segments[-1], self._offset
+        mm[offset + 4:offset + size] = data
+        self.LENGTH.pack_into(mm, offset, len(data)) # commits the record
+        self._offset += size
+        self._index(mm, len(self._segments) - 1, offset)
+        self.stats_data["hands"] += 1
+        self.stats_data["bytes"] += size
+        self.stats_data["write_seconds"] += time.perf_counter() - start
+
+    def _index(self, mm, segment, offset):
+        hand_id, _, _, ended, _, seats, name_length = self.HEADER.unpack_from(mm, offset + 4)
+        pos = offset + 4 + self.HEADER.size
+        table_id = mm[pos:pos + name_length].decode()
+        pos += name_length
+        self._where[hand_id] = (segment, offset, table_id)
+        self._by_table.setdefault(table_id, []).append(hand_id)
+        for i in range(seats):
+            user_id = self.SEAT.unpack_from(mm, pos + i * self.SEAT.size)[0]
+            self._by_user.setdefault(user_id, []).append(hand_id)
+        self._order.append(hand_id)
+        self._ended.append(ended)
+        return hand_id
+
+    def _encode(self, hand_id, table_id, hand_number, ended, events):
+        _, started, dealer, seats = events[0]
+        seat_of = {seat[0]: i for i, seat in enumerate(seats)}
+        name = table_id.encode()
+        out = [self.HEADER.pack(hand_id, hand_number, started, ended, dealer, len(seats), len(name)), name]
+        out += [self.SEAT.pack(uid, position, round(chips * 100)) for uid, position, chips in seats]
+        for event in events[1:]:
+            code = self.CODES[event[0]]
+            if event[0] == "board":
+                out.append(bytes((code, len(event[1]), *event[1])))
+            elif event[0] == "deal":
+                out.append(bytes((code, seat_of[event[1]], event[2], event[3])))
+            elif len(event) == 3:
+                out.append(self.AMOUNT.pack(code, seat_of[event[1]], round(event[2] * 100)))
+            else:
+                out.append(bytes((code, seat_of[event[1]])))
+        return b"".join(out)
+
+    def _decode(self, data):
+        hand_id, hand_number, started, ended, dealer, seat_count, name_length = self.HEADER.unpack_from(data)
+        pos = self.HEADER.size
+        table_id = data[pos:pos + name_length].decode()
+        pos += name_length
+        seats = []
+        for _ in range(seat_count):
+            uid, position, cents = self.SEAT.unpack_from(data, pos)
+            seats.append({"user_id": uid, "position": position, "chips": cents / 100})
+            pos += self.SEAT.size
+        events = []
+        while pos < len(data):
+            kind = self.KINDS[data[pos]]
+            if kind == "board":
+                events.append((kind, list(data[pos + 2:pos + 2 + data[pos + 1]])))
+                pos += 2 + data[pos + 1]
+                continue
+            uid = seats[data[pos + 1]]["user_id"]
+            if kind == "deal":
+                events.append((kind, uid, data[pos + 2], data[pos + 3]))
+                pos += 4
+            elif kind in self.AMOUNT_KINDS:
+                events.append((kind, uid, self.AMOUNT.unpack_from(data, pos)[2] / 100))
+                pos += self.AMOUNT.size
+            else:
+                events.append((kind, uid))
+                pos += 2
+        return {"hand_id": hand_id, "table_id": table_id, "hand_number": hand_number, "started": started,
+                "ended": ended, "dealer_position": dealer, "seats": seats, "events": events}
+
+    def read(self, hand_id):
+        """The decoded hand, or None if it is not in the log (yet)."""
+        where = self._where.get(hand_id)
+        if where is None:
+            return None
+        segment, offset, _ = where
+        mm = self._segments[segment]
+        length = self.LENGTH.unpack_from(mm, offset)[0]
+        return self._decode(mm[offset + 4:offset + 4 + length])
+
+    def hands(self, table_id=None, user_id=None, since=None, until=None, limit=50):
+        """Hand ids, newest first, filtered by table, player and end time."""
+        if user_id is not None:
+            ids = self._by_user.get(user_id, [])
+        elif table_id is not None:
+            ids = self._by_table.get(table_id, [])
+        else:
+            ids = self._order
+        lo = bisect.bisect_left(self._ended, since) if since is not None else 0
+        hi = bisect.bisect_right(self._ended, until) if until is not None else len(self._order)
+        if lo >= hi:
+            return []
+        # Ids grow along the log, so the time range is an id range in every index
+        start, end = bisect.bisect_left(ids, self._order[lo]), bisect.bisect_right(ids, self._order[hi - 1])
+        found = []
+        for i in range(end - 1, start - 1, -1):
+            if user_id is not None and table_id is not None and self._where[ids[i]][2] != table_id:
+                continue
+            found.append(ids[i])
+            if len(found) >= limit:
+                break
+        return found
+
+    @staticmethod
+    def results(events):
+        """user_id -> (chips put in, chips won) over a hand's events."""
+        out = {}
+        for event in events:
+            if event[0] in ("blind", "call", "raise", "win"):
+                put_in, won = out.get(event[1], (0.0, 0.0))
+                out[event[1]] = (put_in, won + event[2]) if event[0] == "win" else (put_in + event[2], won)
+            elif event[0] == "deal":
+                out.setdefault(event[1], (0.0, 0.0))
+        return out
+
+    def replay(self, hand_id, for_user_id=None):
+        """The states a hand went through, one after each event.
+
+        With for_user_id, hole cards are shown as that player saw them at the
+        end: their own, and those of the players who went to showdown.
+        """
+        hand = self.read(hand_id)
+        if hand is None:
+            return None
+        events = hand["events"]
+        folded = {event[1] for event in events if event[0] == "fold"}
+        showdown = sum(1 for seat in hand["seats"] if seat["user_id"] not in folded) > 1
+        players = {seat["user_id"]: dict(seat, bet=0.0, cards=[], folded=False) for seat in hand["seats"]}
+        pot, board, states = 0.0, [], []
+        for event in events:
+            kind = event[0]
+            if kind == "board":
+                board = board + [Card.from_code(c).to_dict() for c in event[1]]
+                for p in players.values():
+                    p["bet"] = 0.0
+                step = {"action": kind, "cards": board[-len(event[1]):]}
+            else:
+                p = players[event[1]]
+                step = {"action": kind, "user_id": event[1]}
+                if kind == "deal":
+                    uid = event[1]
+                    if for_user_id is None or uid == for_user_id or (showdown and uid not in folded):
+                        p["cards"] = [Card.from_code(event[2]).to_dict(), Card.from_code(event[3]).to_dict()]
+                    else:
+                        p["cards"] = [self.HIDDEN_CARD, self.HIDDEN_CARD]
+                elif kind == "fold":
+                    p["folded"] = True
+                elif kind == "win":
+                    p["chips"] = round(p["chips"] + event[2], 2)
+                    pot -= event[2]
+                    step["amount"] = event[2]
+                elif kind != "check":
+                    p["chips"] = round(p["chips"] - event[2], 2)
+                    p["bet"] = round(p["bet"] + event[2], 2)
+                    pot += event[2]
+                    step["amount"] = event[2]
+            states.append({"event": step, "pot": round(pot, 2), "board": board,
+                           "players": [dict(p) for p in players.values()]})
+        return states
+
+    def stats(self):
+        return dict(self.stats_data, queued=self.queued, segments=len(self._segments), indexed=len(self._order))
+
+# ==========================================
+# LOBBY
+# ==========================================
+
+class TableDict(dict):
+    """table_id -> PokerTable that reports every table added or removed to on_change."""
+
+    def __init__(self, on_change):
+        super().__init__()
+        self.on_change = on_change
+
+    def __setitem__(self, table_id, table):
+        super().__setitem__(table_id, table)
+        self.on_change(table_id)
+
+    def __delitem__(self, table_id):
+        super().__delitem__(table_id)
+        self.on_change(table_id)
+
+    def pop(self, table_id, *default):
+        table = super().pop(table_id, *default)
+        self.on_change(table_id)
+        return table
+
+class Lobby:
+    """Lobby rows kept up to date by table changes instead of rebuilt per poll.
+
+    Tables touched since the last tick are described again and only rows
+    that differ become pending; subscribers get the pending rows as one
+    lobby_update per tick. A ShardGateway merges the pending rows of its
+    workers (source = worker id): a row belongs to the worker that reported
+    it last, so a migrated table's removal from its old worker is ignored.
+    """
+    def __init__(self, kinds=("cash_tables", "friend_games")):
+        self.kinds = kinds
+        self.rows = {} # table_id -> (kind, row)
+        self.owners = {} # table_id -> source, merged lobbies only
+        self.dirty = set() # table ids to describe on the next refresh
+        self.pending = {} # table_id -> (kind, row or None if gone) since the last take
+        self.subscribers = set()
+
+    def touch(self, table_id):
+        self.dirty.add(table_id)
+
+    def refresh(self, describe):
+        """describe(table_id) -> (kind, row), or None once the table is gone."""
+        dirty, self.dirty = self.dirty, set()
+        for table_id in dirty:
+            self.set(table_id, describe(table_id))
+
+    def set(self, table_id, entry, source=None):
+        old = self.rows.get(table_id)
+        if entry is None:
+            if old is None or self.owners.get(table_id, source) != source:
+                return
+            del self.rows[table_id]
+            self.owners.pop(table_id, None)
+            self.pending[table_id] = (old[0], None)
+            return
+        if source is not None:
+            self.owners[table_id] = source
+        if entry != old:
+            self.rows[table_id] = entry
+            self.pending[table_id] = entry
+
+    def merge(self, source, pending):
+        for table_id, (kind, row) in pending.items():
+            self.set(table_id, None if row is None else (kind, row), source)
+
+    def drop(self, source):
+        for table_id in [t for t, s in self.owners.items() if s == source]:
+            self.set(table_id, None, source)
+
+    def take(self):
+        pending, self.pending = self.pending, {}
+        return pending
+
+    def snapshot(self, order):
+        out = {kind: [] for kind in self.kinds}
+        for kind, row in self.rows.values():
+            out[kind].append(row)
+        return {kind: sorted(rows, key=order) for kind, rows in out.items()}
+
+    def changes(self, pending):
+        out = {kind: {"upsert": [], "remove": []} for kind in self.kinds}
+        for table_id, (kind, row) in pending.items():
+            if row is None:
+                out[kind]["remove"].append(table_id)
+            else:
+                out[kind]["upsert"].append(row)
+        return out
+
+class AdminFeed:
+    """Dashboard state pushed to admin panels as server-sent events.
+
+    A panel that connects gets a snapshot; after that each tick sends only
+    what changed: table rows (tracked like the lobby), users who came online
+    or went offline, the pending withdrawals when they changed and the
+    metric totals that moved. A panel that falls behind is dropped and its
+    EventSource reconnects to a fresh snapshot.
+    """
+    QUEUE = 64
+
+    def __init__(self):
+        self.tables = Lobby(("tables",))
+        self.online = set() # user ids at the last tick
+        self.metrics = {} # Metrics.totals() at the last tick
+        self.withdrawals = []
+        self.withdrawals_changed = True # read them again at the next tick with a panel open
+        self.clients = set() # asyncio.Queue of events per panel
+        self.joining = set() # panels waiting for their snapshot
+        self.lock = asyncio.Lock() # one tick at a time
+
+    def join(self):
+        queue = asyncio.Queue(self.QUEUE)
+        self.joining.add(queue)
+        return queue
+
+    def leave(self, queue):
+        self.joining.discard(queue)
+        self.clients.discard(queue)
+
+    @staticmethod
+    def event(name, data: bytes):
+        return b"event: " + name + b"\ndata: " + data + b"\n\n"
+
+    def publish(self, update, snapshot):
+        """update and snapshot are encoded JSON, or None when there is nothing to send."""
+        if update is not None:
+            event = self.event(b"update", update)
+            for queue in list(self.clients):
+                self._put(queue, event)
+        if snapshot is not None:
+            event = self.event(b"snapshot", snapshot)
+            for queue in self.joining:
+                self._put(queue, event)
+                self.clients.add(queue)
+            self.joining.clear()
+
+    def _put(self, queue, event):
+        try:
+            queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self._end(queue)
+
+    def _end(self, queue):
+        self.leave(queue)
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(None) # ends the response
+
+    def close(self):
+        for queue in self.clients | self.joining:
+            self._end(queue)
+
+# ==========================================
+# MESSAGE DISPATCH
+# ==========================================
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def _is_numeric(value):
+    # Handlers that float() a field also take numbers sent as strings
+    if isinstance(value, str):
+        try:
+            float(value)
+        except ValueError:
+            return False
+        return True
+    return _is_number(value)
+
+FIELD_KINDS = {
+    "str": lambda value: isinstance(value, str),
+    "int": lambda value: isinstance(value, int) and not isinstance(value, bool),
+    "number": _is_number,
+    "numeric": _is_numeric,
+}
+
+def compile_schema(fields):
+    """A validator for {field: kind}: returns the first field of the wrong kind, or None.
+    Missing (or null) fields pass, handlers apply their defaults."""
+    checks = tuple((field, FIELD_KINDS[kind]) for field, kind in fields.items())
+    if not checks:
+        return None
+
+    def validate(data):
+        for field, check in checks:
+            value = data.get(field)
+            if value is not None and not check(value):
+                return field
+        return None
+    return validate
+
 class PokerServer:
+    ADMIN_FEED_KEEPALIVE = 15.0 # seconds between SSE comments on a quiet admin feed
+    RUN_OUT_DELAY = 2.0 # seconds between the streets of an all-in run-out
+    # action -> (handler method, {field: FIELD_KINDS kind}); compiled once by _build_dispatch
+    ACTIONS = {
+        'ping': ('handle_ping', {}),
+        'register': ('handle_register', {'email': 'str', 'username': 'str', 'password': 'str', 'security_answer': 'str'}),
+        'login': ('handle_login', {'email': 'str', 'password': 'str'}),
+        'get_security_question': ('handle_get_security_question', {'email': 'str'}),
+        'verify_security_answer': ('handle_verify_security_answer', {'email': 'str', 'answer': 'str'}),
+        'reset_password': ('handle_reset_password', {'email': 'str', 'answer': 'str', 'new_password': 'str'}),
+        'change_password': ('handle_change_password', {'old_password': 'str', 'new_password': 'str'}),
+        'get_wallet': ('handle_get_wallet', {}),
+        'create_deposit': ('handle_create_deposit', {'amount': 'number', 'payment_method': 'str'}),
+        'wallet_deposit': ('handle_create_deposit', {'amount': 'number', 'payment_method': 'str'}), # Alias for client
+        'verify_deposit': ('handle_verify_deposit', {'order_id': 'str'}),
+        'capture_deposit': ('handle_verify_deposit', {'order_id': 'str'}), # Alias for client
+        'cancel_deposit': ('handle_cancel_deposit', {'order_id': 'str'}),
+        'withdraw': ('handle_withdraw', {'amount': 'number', 'paypal_email': 'str'}),
+        'wallet_withdraw': ('handle_withdraw', {'amount': 'number', 'paypal_email': 'str'}), # Alias for client
+        'get_statistics': ('handle_get_statistics', {}),
+        'search_users': ('handle_search_users', {'query': 'str'}),
+        'send_friend_request': ('handle_send_friend_request', {}),
+        'accept_friend_request': ('handle_accept_friend_request', {}),
+        'get_friends': ('handle_get_friends', {}),
+        'get_cash_tables': ('handle_get_cash_tables', {}),
+        'join_cash_table': ('handle_join_cash_table', {'table_id': 'str', 'buy_in': 'number'}),
+        'create_private_game': ('handle_create_private_game', {
+            'game_name': 'str', 'name': 'str', 'password': 'str', 'small_blind': 'numeric', 'big_blind': 'numeric',
+            'min_buy_in': 'numeric', 'max_buy_in': 'numeric', 'max_players': 'numeric'}),
+        'join_private_game': ('handle_join_private_game', {'game_name': 'str', 'password': 'str', 'buy_in': 'numeric'}),
+        'leave_table': ('handle_leave_table', {}),
+        'get_table_state': ('handle_get_table_state', {'table_id': 'str'}),
+        'enable_table_deltas': ('handle_enable_table_deltas', {}),
+        'get_game_history': ('handle_get_game_history', {}),
+        'get_hand_replay': ('handle_get_hand_replay', {'hand_id': 'int'}),
+        'get_transaction_history': ('handle_get_transaction_history', {}),
+        'get_friend_games': ('handle_get_friend_games', {}),
+        'subscribe_lobby': ('handle_subscribe_lobby', {}),
+        'unsubscribe_lobby': ('handle_unsubscribe_lobby', {}),
+        'chat_message': ('handle_chat_message', {'table_id': 'str', 'message': 'str'}),
+        'get_leaderboard': ('handle_get_leaderboard', {'leaderboard_type': 'str'}),
+        'update_avatar': ('handle_update_avatar', {}),
+        'check': ('handle_game_action', {}),
+        'call': ('handle_game_action', {'amount': 'numeric'}),
+        'raise': ('handle_game_action', {'amount': 'numeric'}),
+        'fold': ('handle_game_action', {}),
+        'sitout': ('handle_game_action', {}),
+        'sitin': ('handle_game_action', {}),
+    }
+    ACTIONS['create_friend_game'] = ACTIONS['create_private_game'] # Alias for client
+    ACTIONS['join_friend_game'] = ACTIONS['join_private_game'] # Alias for client
+
     def __init__(self):
         self.connections = {}  # websocket -> user_id
         self.user_connections = {}  # user_id -> websocket
         self.paypal = PayPalClient()
+        self.equity = EquityService()
+        self.passwords = PasswordHasher()
         
         # PERSISTENT DATABASE PATH
         # Store database in user's home directory to prevent data loss during server updates
@@ -773,10 +3126,25 @@ class PokerServer:
             os.makedirs(self.data_dir)
             
         self.db_path = os.path.join(self.data_dir, "poker_database.db")
-        
-        self.tables = {}  # table_id -> PokerTable
+        self.metrics = Metrics()
+        self.db = DatabasePool(self.db_path, metrics=self.metrics)
+        self.sockets = set() # every open WebSocketAdapter, logged in or not
+        self.wire_stats = {} # outbound message type -> counters, see WebSocketAdapter._send
+        
+        self.lobby = Lobby() # rows pushed to lobby subscribers, see lobby_tick
+        self.admin_feed = AdminFeed() # see admin_feed_tick
+        self.tables = TableDict(self._table_changed)  # table_id -> PokerTable
         self.user_tables = {}  # user_id -> table_id (active table)
-        self.table_timers = {} # table_id -> asyncio.Task
+        self._card_slot_nonce = os.urandom(8).hex() # marks private card slots in encoded states
+        self._card_slot_pattern = re.compile(f'"@@{self._card_slot_nonce}:(-?\\d+):\\d+@@"'.encode())
+        self._hidden_cards = StdlibJson.dumps([{"rank": "?", "suit": "?", "value": 0}, {"rank": "?", "suit": "?", "value": 0}])
+        self.delta_clients = {} # websocket -> (table_id, seq) last sent, for clients that enabled table deltas
+        self.timers = TimingWheel() # turn timeouts, hand restarts
+        self.store = TableStore(os.path.join(self.data_dir, "tables"), metrics=self.metrics) # opened by restore_tables
+        self.hand_history = HandHistory(os.path.join(self.data_dir, "hands")) # opened by run()
+        self._game_rows = [] # game_history rows waiting for flush_game_history
+        self.table_timers = {} # table_id -> Timer (turn timeout)
+        self._run_outs = {} # table_id -> hand_number whose next street is on its way
         
         # Define default tables configuration
         self.DEFAULT_TABLES = [
@@ -788,6 +3156,57 @@ class PokerServer:
         ]
         
         self._init_default_tables()
+        self._register_metrics()
+        self.json = json_codec()
+        self._dispatch = self._build_dispatch()
+
+    def _build_dispatch(self):
+        # Bound once: handle_message only looks the action up
+        return {action: (getattr(self, method), compile_schema(fields))
+                for action, (method, fields) in self.ACTIONS.items()}
+    
+    def _register_metrics(self):
+        m = self.metrics
+        m.histogram("poker_action_seconds", "Time to handle a client message, by action", ("action",))
+        m.counter("poker_action_errors_total", "Failed client messages by action; kind is exception or rejected", ("action", "kind"))
+        m.histogram("poker_db_seconds", "Time a DB connection was held, by action and connection kind", ("action", "kind"))
+        m.histogram("poker_db_wait_seconds", "Time waiting for a DB connection", ("kind",))
+        m.histogram("poker_broadcast_seconds", "Duration of a table state broadcast")
+        m.histogram("poker_broadcast_recipients", "Connections reached by one table broadcast", buckets=Metrics.SIZE_BUCKETS)
+        m.histogram("poker_event_loop_lag_seconds", "Extra delay of a periodic loop wakeup")
+        m.gauge("poker_connections", "Open websocket connections", lambda: len(self.sockets))
+        m.gauge("poker_authenticated_connections", "Logged-in websocket connections", lambda: len(self.connections))
+        m.gauge("poker_lobby_subscribers", "Connections subscribed to lobby updates",
+                lambda: len(self.lobby.subscribers))
+        m.gauge("poker_binary_connections", "Websocket connections using the binary protocol",
+                lambda: sum(1 for ws in self.sockets if ws.binary))
+        m.gauge("poker_ws_compressed_connections", "Websocket connections with permessage-deflate",
+                lambda: sum(1 for ws in self.sockets if ws.compressed))
+        for i, (name, help) in enumerate((
+                ("poker_ws_messages", "Messages sent, by type"),
+                ("poker_ws_compressed_messages", "Messages sent compressed, by type"),
+                ("poker_ws_payload_bytes", "Message bytes before compression, by type"),
+                ("poker_ws_wire_bytes", "Frame bytes written to the socket, by type"),
+                ("poker_ws_send_seconds", "Time spent framing and compressing messages, by type"))):
+            m.gauge(name, help, lambda i=i: {(t,): v[i] for t, v in list(self.wire_stats.items())}, ("type",))
+        m.gauge("poker_send_queue_depth", "Queued outbound messages across all connections", lambda: sum(ws.backlog for ws in self.sockets))
+        m.gauge("poker_send_queue_depth_max", "Largest outbound queue of a single connection",
+                lambda: max((ws.backlog for ws in self.sockets), default=0))
+        m.gauge("poker_tables", "Tables by game phase", self._tables_by_phase, ("phase",))
+        m.gauge("poker_timers_armed", "Timers armed in the timing wheel", lambda: self.timers.armed)
+        m.histogram("poker_snapshot_seconds", "Time to write one table snapshot")
+        m.gauge("poker_snapshot_dirty_tables", "Tables with journal records not yet in a snapshot", lambda: self.store.dirty)
+        m.gauge("poker_hand_history_queue", "Finished hands waiting for the hand history writer", lambda: self.hand_history.queued)
+        m.gauge("poker_hand_history_hands", "Hands written to the hand history since start",
+                lambda: self.hand_history.stats_data["hands"])
+        m.gauge("poker_db_in_use", "DB connections currently held",
+                lambda: {(kind,): self.db.stats_data[kind]["in_use"] for kind in ("read", "write")}, ("kind",))
+
+    def _tables_by_phase(self):
+        phases = {}
+        for table in self.tables.values():
+            phases[(table.game_phase,)] = phases.get((table.game_phase,), 0) + 1
+        return phases
     
     def _start_turn_timer(self, table_id):
         # Cancel existing
@@ -797,34 +3216,218 @@ class PokerServer:
         
         if table_id in self.tables:
             table = self.tables[table_id]
-            if table.game_phase not in ["waiting", "showdown"] and table.current_player:
+            if table.running_out:
+                # Nothing on its way after a restore or a migration: deal the next street
+                if self._run_outs.get(table_id) != table.hand_number:
+                    self._run_outs[table_id] = table.hand_number
+                    self.timers.arm(self.RUN_OUT_DELAY, self.run_out_street, table_id)
+            elif table.game_phase not in ["waiting", "showdown"] and table.current_player:
                 duration = SERVER_CONFIG.get("turn_timer", 30)
-                task = asyncio.create_task(self._turn_timeout_task(table_id, table.current_player, duration))
-                self.table_timers[table_id] = task
+                self.table_timers[table_id] = self.timers.arm(duration, self._turn_timeout, table_id, table.current_player)
+
+    async def _turn_timeout(self, table_id, player_id):
+        if table_id in self.tables:
+            table = self.tables[table_id]
+            if table.current_player == player_id and table.game_phase not in ["waiting", "showdown"]:
+                # Force action: Check if possible, else Fold
+                player = table.players.get(player_id)
+                if player:
+                    action = "fold"
+                    if player['current_bet'] == table.current_bet:
+                        action = "check"
+                    
+                    print(f"Timeout for user {player_id} at table {table_id}. Forcing {action}.")
+                    success, msg = self._apply(table, "handle_action", player_id, action)
+                    if success:
+                        # Set to sit out
+                        self._apply(table, "sit_out", player_id)
+                        self._schedule_equity(table_id)
+                        await self.broadcast_table_state(table_id)
+                        # Trigger next timer
+                        self._start_turn_timer(table_id)
+
+    def _apply(self, table, op, *args):
+        """Run a PokerTable mutation and journal it, see TableStore."""
+        self.store.before(table)
+        self._table_changed(table.table_id)
+        hand_number = table.hand_number
+        result = getattr(table, op)(*args)
+        if not (isinstance(result, tuple) and result[0] is False): # rejected: nothing changed
+            self.store.record(table, op, args, table.deck.cards if table.hand_number != hand_number else None)
+        if table.finished_hand is not None:
+            self._hand_finished(table)
+        return result
 
-    async def _turn_timeout_task(self, table_id, player_id, duration):
+    def _hand_finished(self, table):
+        table_id, hand_number, events = table.finished_hand
+        table.finished_hand = None
+        hand_id = self.hand_history.submit(table_id, hand_number, events)
+        if hand_id is None:
+            return
+        game_type = "private" if table.is_private else "cash"
+        for uid, (put_in, won) in HandHistory.results(events).items():
+            change = round(won - put_in, 2)
+            self._game_rows.append((uid, game_type, "win" if change > 0 else "loss", change,
+                                    f"{table.name} #{hand_number}", hand_id))
+
+    async def flush_game_history(self):
+        """Write the buffered game_history rows and statistics in one transaction."""
+        rows, self._game_rows = self._game_rows, []
+        if not rows:
+            return
         try:
-            await asyncio.sleep(duration)
-            if table_id in self.tables:
-                table = self.tables[table_id]
-                if table.current_player == player_id and table.game_phase not in ["waiting", "showdown"]:
-                    # Force action: Check if possible, else Fold
-                    player = table.players.get(player_id)
-                    if player:
-                        action = "fold"
-                        if player['current_bet'] == table.current_bet:
-                            action = "check"
-                        
-                        print(f"Timeout for user {player_id} at table {table_id}. Forcing {action}.")
-                        success, msg = table.handle_action(player_id, action)
-                        if success:
-                            # Set to sit out
-                            table.players[player_id]['is_sitting_out'] = True
-                            await self.broadcast_table_state(table_id)
-                            # Trigger next timer
-                            self._start_turn_timer(table_id)
-        except asyncio.CancelledError:
-            pass
+            async with self.db.write() as db:
+                await db.executemany(
+                    """INSERT INTO game_history (user_id, game_type, result, chips_change, hand, hand_id)
+                       VALUES (?, ?, ?, ?, ?, ?)""", rows)
+                await db.executemany(
+                    """UPDATE statistics SET games_played = games_played + 1, games_won = games_won + ?,
+                       chips_won = chips_won + ?, chips_lost = chips_lost + ? WHERE user_id = ?""",
+                    [(1 if change > 0 else 0, max(change, 0), max(-change, 0), uid)
+                     for uid, _, _, change, _, _ in rows])
+                await db.commit()
+        except Exception:
+            self._game_rows[:0] = rows # retried next time
+            raise
+
+    def _table_changed(self, table_id):
+        self.lobby.touch(table_id)
+        self.admin_feed.tables.touch(table_id)
+
+    def lobby_tick(self):
+        """Describe the tables touched since the last tick and push what changed."""
+        self.lobby.refresh(self._describe_table)
+        self._push_lobby(self.lobby.take())
+
+    def _push_lobby(self, pending):
+        if not pending or not self.lobby.subscribers:
+            return
+        data = self.json.dumps({"type": "lobby_update", **self.lobby.changes(pending)}) # encoded once for every subscriber
+        for ws in list(self.lobby.subscribers):
+            ws.send_nowait(data)
+
+    async def lobby_loop(self):
+        # Changes within one interval reach subscribers as a single lobby_update
+        while True:
+            await asyncio.sleep(SERVER_CONFIG.get("lobby_interval_ms", 500) / 1000)
+            try:
+                self.lobby_tick()
+            except Exception as e:
+                print(f"Lobby update failed: {e}")
+
+    async def admin_feed_tick(self):
+        """Send admin panels what changed since the last tick, and new panels a snapshot."""
+        feed = self.admin_feed
+        async with feed.lock:
+            feed.tables.refresh(self._describe_admin_table)
+            update = {}
+            pending = feed.tables.take()
+            if pending:
+                update.update(feed.tables.changes(pending))
+            online = set(self.user_connections)
+            if online != feed.online:
+                update["online"] = sorted(online - feed.online)
+                update["offline"] = sorted(feed.online - online)
+                feed.online = online
+            if feed.withdrawals_changed and (feed.clients or feed.joining):
+                feed.withdrawals_changed = False
+                withdrawals = await self._pending_withdrawals()
+                if withdrawals != feed.withdrawals:
+                    feed.withdrawals = update["withdrawals"] = withdrawals
+            totals = self.metrics.totals()
+            moved = {name: value for name, value in totals.items() if feed.metrics.get(name) != value}
+            if moved:
+                update["metrics"] = moved
+                feed.metrics = totals
+            snapshot = None
+            if feed.joining:
+                snapshot = self.json.dumps({"tables": feed.tables.snapshot(self._lobby_order)["tables"],
+                                            "online": sorted(feed.online), "withdrawals": feed.withdrawals,
+                                            "metrics": feed.metrics})
+            feed.publish(self.json.dumps(update) if update and feed.clients else None, snapshot)
+
+    async def admin_feed_loop(self):
+        # Work per tick is the same for one open panel or fifty
+        while True:
+            await asyncio.sleep(SERVER_CONFIG.get("admin_feed_interval_ms", 1000) / 1000)
+            try:
+                await self.admin_feed_tick()
+            except Exception as e:
+                print(f"Admin feed update failed: {e}")
+
+    async def _close_game_history(self, app):
+        # Queued hands and the last rows would be lost, as ShardWorker.serve does on stop
+        self._game_history.cancel()
+        self.hand_history.close()
+        with contextlib.suppress(Exception):
+            await self.flush_game_history()
+
+    async def game_history_loop(self, interval=1.0):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush_game_history()
+            except Exception as e:
+                print(f"Game history flush failed: {e}")
+
+    async def restore_tables(self, owned=None):
+        """Bring back the tables of the previous run (owned(table_id) picks them for a shard worker).
+
+        A table comes back exactly as it was, with every player sitting out
+        until they reconnect, so a hand in progress plays out through turn
+        timeouts. With SERVER_CONFIG["table_recovery"] = "refund", or when a
+        table can't be replayed, the table is closed and its chips go back
+        to the wallets instead (see PokerTable.refunds).
+        """
+        self.store.open()
+        refund_all = SERVER_CONFIG.get("table_recovery", "restore") == "refund"
+        restored = refunded = 0
+        for table_id in self.store.table_ids():
+            if owned is not None and not owned(table_id):
+                continue
+            try:
+                table, error = self.store.load(table_id)
+            except Exception as e:
+                print(f"Table {table_id}: unreadable snapshot, not restored ({e})")
+                continue
+            if error or refund_all:
+                if error:
+                    print(f"Table {table_id}: {error}; refunding players")
+                await self._refund_table(table)
+                self.store.forget(table_id)
+                refunded += 1
+                continue
+
+            table.finished_hand = None # its history went out before the crash, or is lost with it
+            for uid in table.players:
+                table.sit_out(uid) # nobody is connected yet
+                self.user_tables[uid] = table_id
+            self.tables[table_id] = table
+            self.store.snapshot(table)
+            if table.game_phase == "showdown":
+                self.timers.arm(8, self.restart_hand, table_id)
+            else:
+                self._start_turn_timer(table_id)
+            restored += 1
+        if restored or refunded:
+            print(f"Tables recovered: {restored} restored, {refunded} refunded")
+
+    async def _refund_table(self, table):
+        # Keyed by the table's journal position, so a crash during recovery never pays twice
+        description = f"Crash refund: {table.name} [{table.table_id}:{table.hand_number}:{table.journal_seq}]"
+        async with self.db.write() as db:
+            for uid, amount in table.refunds().items():
+                cursor = await db.execute("SELECT 1 FROM transactions WHERE user_id = ? AND description = ?",
+                                          (uid, description))
+                if await cursor.fetchone():
+                    continue
+                await db.execute("UPDATE wallets SET balance = balance + ? WHERE user_id = ?", (amount, uid))
+                await db.execute(
+                    """INSERT INTO transactions (user_id, type, amount, status, description)
+                       VALUES (?, 'crash_refund', ?, 'completed', ?)""",
+                    (uid, amount, description)
+                )
+            await db.commit()
 
     def _init_default_tables(self):
         # Create default cash game tables with cent-based blinds
@@ -832,136 +3435,10 @@ class PokerServer:
             self.tables[table_id] = PokerTable(table_id, name, sb, bb, min_buy, max_buy)
     
     async def init_db(self):
-        async with aiosqlite.connect(self.db_path) as db:
-            # Users table with email and security question
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    email TEXT UNIQUE NOT NULL,
-                    username TEXT UNIQUE NOT NULL,
-                    password_hash TEXT NOT NULL,
-                    security_question INTEGER NOT NULL,
-                    security_answer TEXT NOT NULL,
-                    chips INTEGER DEFAULT 10000,
-                    level INTEGER DEFAULT 1,
-                    avatar_id INTEGER DEFAULT 0,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    last_login TIMESTAMP,
-                    is_banned INTEGER DEFAULT 0
-                )
-            ''')
-            
-            # Check for is_banned column (migration)
-            try:
-                await db.execute("ALTER TABLE users ADD COLUMN is_banned INTEGER DEFAULT 0")
-            except:
-                pass
-            
-            # Statistics table
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS statistics (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    games_played INTEGER DEFAULT 0,
-                    games_won INTEGER DEFAULT 0,
-                    chips_won INTEGER DEFAULT 0,
-                    chips_lost INTEGER DEFAULT 0,
-                    royal_flush INTEGER DEFAULT 0,
-                    straight_flush INTEGER DEFAULT 0,
-                    four_of_kind INTEGER DEFAULT 0,
-                    full_house INTEGER DEFAULT 0,
-                    flush INTEGER DEFAULT 0,
-                    straight INTEGER DEFAULT 0,
-                    three_of_kind INTEGER DEFAULT 0,
-                    two_pair INTEGER DEFAULT 0,
-                    pair INTEGER DEFAULT 0,
-                    high_card INTEGER DEFAULT 0,
-                    FOREIGN KEY (user_id) REFERENCES users(id)
-                )
-            ''')
-            
-            # Game history
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS game_history (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    game_type TEXT NOT NULL,
-                    result TEXT NOT NULL,
-                    chips_change INTEGER,
-                    hand TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(id)
-                )
-            ''')
-            
-            # Wallets
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS wallets (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER UNIQUE NOT NULL,
-                    balance REAL DEFAULT 0.0,
-                    total_deposited REAL DEFAULT 0.0,
-                    total_withdrawn REAL DEFAULT 0.0,
-                    last_deposit TIMESTAMP,
-                    last_withdrawal TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(id)
-                )
-            ''')
-            
-            # Transactions
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS transactions (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    type TEXT NOT NULL,
-                    amount REAL NOT NULL,
-                    status TEXT DEFAULT 'pending',
-                    paypal_order_id TEXT,
-                    description TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    completed_at TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(id)
-                )
-            ''')
-            
-            # Friends
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS friends (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    friend_id INTEGER NOT NULL,
-                    status TEXT DEFAULT 'pending',
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(id),
-                    FOREIGN KEY (friend_id) REFERENCES users(id),
-                    UNIQUE(user_id, friend_id)
-                )
-            ''')
-            
-            # Private games
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS private_games (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    creator_id INTEGER NOT NULL,
-                    game_name TEXT NOT NULL,
-                    password TEXT NOT NULL,
-                    game_type TEXT DEFAULT 'cash',
-                    small_blind REAL DEFAULT 0.10,
-                    big_blind REAL DEFAULT 0.20,
-                    min_buy_in REAL DEFAULT 5.0,
-                    max_buy_in REAL DEFAULT 50.0,
-                    max_players INTEGER DEFAULT 6,
-                    status TEXT DEFAULT 'waiting',
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (creator_id) REFERENCES users(id)
-                )
-            ''')
-            
-            await db.commit()
-            print("Database initialized with v14 schema")
-    
-    def hash_password(self, password: str) -> str:
-        return hashlib.sha256(password.encode()).hexdigest()
+        await self.db.open()
+        async with self.db.write() as db:
+            await apply_migrations(db)
+            print(f"Database initialized with v14 schema (version {SCHEMA_VERSION})")
     
     async def handle_register(self, ws, data: dict):
         email = data.get('email', '').strip().lower()
@@ -981,7 +3458,10 @@ class PokerServer:
         if not security_answer or len(security_answer) < 2:
             return {"type": "register_result", "success": False, "error": "Risposta di sicurezza non valida"}
         
-        async with aiosqlite.connect(self.db_path) as db:
+        # Hash before taking the writer so the KDF never holds up other writes
+        password_hash = await self.passwords.hash(password)
+        
+        async with self.db.write() as db:
             # Check email uniqueness
             cursor = await db.execute("SELECT id FROM users WHERE email = ?", (email,))
             if await cursor.fetchone():
@@ -993,7 +3473,6 @@ class PokerServer:
                 return {"type": "register_result", "success": False, "error": "Username già in uso"}
             
             # Create user
-            password_hash = self.hash_password(password)
             cursor = await db.execute(
                 """INSERT INTO users (email, username, password_hash, security_question, security_answer, chips, level)
                    VALUES (?, ?, ?, ?, ?, 10000, 1)""",
@@ -1030,26 +3509,34 @@ class PokerServer:
         if not email or not password:
             return {"type": "login_result", "success": False, "error": "Email e password richiesti"}
         
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.db.read() as db:
             cursor = await db.execute(
-                "SELECT id, username, chips, level, avatar_id, is_banned FROM users WHERE email = ? AND password_hash = ?",
-                (email, self.hash_password(password))
+                "SELECT id, username, chips, level, avatar_id, is_banned, password_hash FROM users WHERE email = ?",
+                (email,)
             )
             user = await cursor.fetchone()
             
-            if not user:
-                return {"type": "login_result", "success": False, "error": "Credenziali non valide"}
-            
-            if user['is_banned']:
-                return {"type": "login_result", "success": False, "error": "Account sospeso. Contatta l'amministratore."}
-            
-            user_id = user['id']
+        ok, needs_rehash = await self.passwords.verify(password, user['password_hash'] if user else None)
+        if not ok:
+            return {"type": "login_result", "success": False, "error": "Credenziali non valide"}
+        
+        if user['is_banned']:
+            return {"type": "login_result", "success": False, "error": "Account sospeso. Contatta l'amministratore."}
+        
+        user_id = user['id']
+        # Transparent upgrade of legacy SHA-256 (or outdated scrypt) hashes
+        new_hash = await self.passwords.hash(password) if needs_rehash else None
             
-            # Update last login
+        # Update last login (short write, the rest of the login only reads)
+        async with self.db.write() as db:
             await db.execute("UPDATE users SET last_login = CURRENT_TIMESTAMP WHERE id = ?", (user_id,))
+            if new_hash:
+                # Only if unchanged: a reset or change committed meanwhile must not be overwritten
+                await db.execute("UPDATE users SET password_hash = ? WHERE id = ? AND password_hash = ?",
+                                 (new_hash, user_id, user['password_hash']))
             await db.commit()
             
+        async with self.db.read() as db:
             # Get wallet balance
             cursor = await db.execute("SELECT balance FROM wallets WHERE user_id = ?", (user_id,))
             wallet = await cursor.fetchone()
@@ -1088,8 +3575,7 @@ class PokerServer:
         if not email or '@' not in email:
             return {"type": "security_question_response", "success": False, "error": "Email non valida"}
         
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.db.read() as db:
             cursor = await db.execute(
                 "SELECT security_question FROM users WHERE email = ?",
                 (email,)
@@ -1118,8 +3604,7 @@ class PokerServer:
         if not email or not answer:
             return {"type": "verify_answer_response", "success": False, "error": "Email e risposta richiesti"}
         
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.db.read() as db:
             cursor = await db.execute(
                 "SELECT id, security_answer FROM users WHERE email = ?",
                 (email,)
@@ -1151,22 +3636,22 @@ class PokerServer:
         if len(new_password) < 6:
             return {"type": "reset_password_response", "success": False, "error": "La password deve avere almeno 6 caratteri"}
         
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.db.read() as db:
             cursor = await db.execute(
                 "SELECT id, security_answer FROM users WHERE email = ?",
                 (email,)
             )
             user = await cursor.fetchone()
             
-            if not user:
-                return {"type": "reset_password_response", "success": False, "error": "Email non trovata"}
-            
-            if user['security_answer'].lower() != answer:
-                return {"type": "reset_password_response", "success": False, "error": "Risposta di sicurezza non corretta"}
-            
-            # Update password
-            new_hash = self.hash_password(new_password)
+        if not user:
+            return {"type": "reset_password_response", "success": False, "error": "Email non trovata"}
+        
+        if user['security_answer'].lower() != answer:
+            return {"type": "reset_password_response", "success": False, "error": "Risposta di sicurezza non corretta"}
+        
+        # Update password
+        new_hash = await self.passwords.hash(new_password)
+        async with self.db.write() as db:
             await db.execute("UPDATE users SET password_hash = ? WHERE id = ?", (new_hash, user['id']))
             await db.commit()
             
@@ -1190,20 +3675,21 @@ class PokerServer:
         if len(new_password) < 6:
             return {"type": "change_password_result", "success": False, "error": "La password deve avere almeno 6 caratteri"}
             
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.db.read() as db:
             cursor = await db.execute("SELECT password_hash FROM users WHERE id = ?", (user_id,))
             user = await cursor.fetchone()
             
-            if not user:
-                return {"type": "change_password_result", "success": False, "error": "Utente non trovato"}
-                
-            # Verify old password
-            if self.hash_password(old_password) != user['password_hash']:
-                return {"type": "change_password_result", "success": False, "error": "Vecchia password non corretta"}
-                
-            # Update to new password
-            new_hash = self.hash_password(new_password)
+        if not user:
+            return {"type": "change_password_result", "success": False, "error": "Utente non trovato"}
+            
+        # Verify old password
+        ok, _ = await self.passwords.verify(old_password, user['password_hash'])
+        if not ok:
+            return {"type": "change_password_result", "success": False, "error": "Vecchia password non corretta"}
+            
+        # Update to new password
+        new_hash = await self.passwords.hash(new_password)
+        async with self.db.write() as db:
             await db.execute("UPDATE users SET password_hash = ? WHERE id = ?", (new_hash, user_id))
             await db.commit()
             
@@ -1218,8 +3704,7 @@ class PokerServer:
         if not user_id:
             return {"type": "wallet_data", "success": False, "error": "Non autenticato"}
         
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.db.read() as db:
             cursor = await db.execute(
                 "SELECT balance, total_deposited, total_withdrawn FROM wallets WHERE user_id = ?",
                 (user_id,)
@@ -1269,7 +3754,7 @@ class PokerServer:
                     break
             
             # Store transaction
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.db.write() as db:
                 await db.execute(
                     """INSERT INTO transactions (user_id, type, amount, status, paypal_order_id, description)
                        VALUES (?, 'deposit', ?, 'pending', ?, ?)""",
@@ -1309,7 +3794,7 @@ class PokerServer:
                     status = 'COMPLETED'
             
             if status == 'COMPLETED':
-                async with aiosqlite.connect(self.db_path) as db:
+                async with self.db.write() as db:
                     # Get transaction
                     cursor = await db.execute(
                         "SELECT amount FROM transactions WHERE paypal_order_id = ? AND user_id = ?",
@@ -1368,7 +3853,7 @@ class PokerServer:
         if not order_id:
             return {"type": "cancel_deposit_result", "success": False, "error": "Order ID mancante"}
             
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.db.write() as db:
             # Check if transaction exists and is pending
             cursor = await db.execute(
                 "SELECT id FROM transactions WHERE paypal_order_id = ? AND user_id = ? AND status = 'pending'",
@@ -1409,7 +3894,7 @@ class PokerServer:
         if not paypal_email or '@' not in paypal_email:
             return {"type": "wallet_withdraw_result", "success": False, "error": "Email PayPal non valida"}
         
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.db.write() as db:
             cursor = await db.execute("SELECT balance FROM wallets WHERE user_id = ?", (user_id,))
             wallet = await cursor.fetchone()
             
@@ -1433,6 +3918,7 @@ class PokerServer:
             )
             
             await db.commit()
+            self.admin_feed.withdrawals_changed = True
             
             # Get new balance
             cursor = await db.execute("SELECT balance FROM wallets WHERE user_id = ?", (user_id,))
@@ -1451,8 +3937,7 @@ class PokerServer:
         if not user_id:
             return {"type": "stats_data", "success": False, "error": "Non autenticato"}
         
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.db.read() as db:
             cursor = await db.execute("SELECT * FROM statistics WHERE user_id = ?", (user_id,))
             stats = await cursor.fetchone()
             
@@ -1473,8 +3958,7 @@ class PokerServer:
         if len(query) < 2:
             return {"type": "search_results", "success": False, "error": "Inserisci almeno 2 caratteri"}
         
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.db.read() as db:
             cursor = await db.execute(
                 """SELECT id, username, level FROM users 
                    WHERE username LIKE ? AND id != ? LIMIT 20""",
@@ -1497,7 +3981,7 @@ class PokerServer:
         if not friend_id or friend_id == user_id:
             return {"type": "friend_request_response", "success": False, "error": "ID amico non valido"}
         
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.db.write() as db:
             # Check if already friends or request exists
             cursor = await db.execute(
                 "SELECT status FROM friends WHERE (user_id = ? AND friend_id = ?) OR (user_id = ? AND friend_id = ?)",
@@ -1522,7 +4006,7 @@ class PokerServer:
             if friend_id in self.user_connections:
                 friend_ws = self.user_connections[friend_id]
                 try:
-                    await friend_ws.send(json.dumps({
+                    await friend_ws.send(self.json.dumps({
                         "type": "notification",
                         "title": "Nuova richiesta di amicizia",
                         "message": "Hai ricevuto una richiesta di amicizia!",
@@ -1540,7 +4024,7 @@ class PokerServer:
         
         friend_id = data.get('friend_id')
         
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.db.write() as db:
             await db.execute(
                 "UPDATE friends SET status = 'accepted' WHERE user_id = ? AND friend_id = ?",
                 (friend_id, user_id)
@@ -1554,8 +4038,7 @@ class PokerServer:
         if not user_id:
             return {"type": "friends_list", "success": False, "error": "Non autenticato"}
         
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.db.read() as db:
             
             # Get accepted friends
             cursor = await db.execute(
@@ -1586,25 +4069,47 @@ class PokerServer:
                 "pending_requests": [dict(p) for p in pending]
             }
     
+    def _cash_table_row(self, table_id, table):
+        return {
+            "table_id": table_id,
+            "name": table.name,
+            "small_blind": table.small_blind,
+            "big_blind": table.big_blind,
+            "min_buy_in": table.min_buy_in,
+            "max_buy_in": table.max_buy_in,
+            "players": len(table.players),
+            "max_players": table.max_players,
+            "status": table.game_phase
+        }
+
+    def _cash_table_info(self):
+        return [self._cash_table_row(table_id, table) for table_id, table in self.tables.items() if not table.is_private]
+
+    def _describe_table(self, table_id):
+        table = self.tables.get(table_id)
+        if table is None:
+            return None
+        if table.is_private:
+            return ("friend_games", self._friend_game_row(table_id, table))
+        return ("cash_tables", self._cash_table_row(table_id, table))
+
+    def _lobby_order(self, row):
+        table_id = row.get("table_id", row.get("id"))
+        defaults = [t[0] for t in self.DEFAULT_TABLES]
+        if table_id in defaults:
+            return (0, defaults.index(table_id), 0)
+        digits = table_id.rpartition("_")[2]
+        return (1, int(digits) if digits.isdigit() else 0, table_id)
+
+    async def _table_info(self, kind):
+        # cash_table, friend_game or admin_table rows; ShardGateway collects them from its workers
+        return getattr(self, f"_{kind}_info")()
+
     async def handle_get_cash_tables(self, ws, data: dict):
-        tables_info = []
-        for table_id, table in self.tables.items():
-            if not table.is_private:
-                tables_info.append({
-                    "table_id": table_id,
-                    "name": table.name,
-                    "small_blind": table.small_blind,
-                    "big_blind": table.big_blind,
-                    "min_buy_in": table.min_buy_in,
-                    "max_buy_in": table.max_buy_in,
-                    "players": len(table.players),
-                    "max_players": table.max_players
-                })
-        
         return {
             "type": "cash_tables_response",
             "success": True,
-            "tables": tables_info
+            "tables": await self._table_info("cash_table")
         }
     
     async def handle_join_cash_table(self, ws, data: dict):
@@ -1625,8 +4130,7 @@ class PokerServer:
                     "error": f"Buy-in deve essere tra €{table.min_buy_in:.2f} e €{table.max_buy_in:.2f}"}
         
         # Check wallet balance
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.db.write() as db:
             cursor = await db.execute("SELECT balance FROM wallets WHERE user_id = ?", (user_id,))
             wallet = await cursor.fetchone()
             
@@ -1648,7 +4152,7 @@ class PokerServer:
             await db.commit()
             
             # Add player to table
-            success, result = table.add_player(user_id, user['username'], buy_in)
+            success, result = self._apply(table, "add_player", user_id, user['username'], buy_in)
             
             if success:
                 self.user_tables[user_id] = table_id
@@ -1695,7 +4199,7 @@ class PokerServer:
         if not password or len(password) < 4:
             return {"type": "friend_game_created", "success": False, "error": "Password deve avere almeno 4 caratteri"}
         
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.db.write() as db:
             # Get username
             cursor = await db.execute("SELECT username FROM users WHERE id = ?", (user_id,))
             row = await cursor.fetchone()
@@ -1734,8 +4238,7 @@ class PokerServer:
         password = data.get('password', '').strip()
         buy_in = float(data.get('buy_in', 10.0))
         
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.db.write() as db:
             cursor = await db.execute(
                 "SELECT id, small_blind, big_blind, min_buy_in, max_buy_in, max_players FROM private_games WHERE game_name = ? AND password = ?",
                 (game_name, password)
@@ -1785,7 +4288,7 @@ class PokerServer:
             await db.commit()
             
             # Add to table
-            success, result = table.add_player(user_id, user['username'], buy_in)
+            success, result = self._apply(table, "add_player", user_id, user['username'], buy_in)
             
             if success:
                 self.user_tables[user_id] = table_id
@@ -1818,12 +4321,12 @@ class PokerServer:
             return {"type": "leave_table_response", "success": False, "error": "Non sei a un tavolo"}
         
         table = self.tables[table_id]
-        remaining_chips = table.remove_player(user_id)
+        remaining_chips = self._apply(table, "remove_player", user_id)
         del self.user_tables[user_id]
         
         # Return chips to wallet
         if remaining_chips > 0:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.db.write() as db:
                 await db.execute("UPDATE wallets SET balance = balance + ? WHERE user_id = ?", (remaining_chips, user_id))
                 await db.execute(
                     """INSERT INTO transactions (user_id, type, amount, status, description)
@@ -1849,35 +4352,118 @@ class PokerServer:
             return {"type": "table_state_response", "success": False, "error": "Tavolo non trovato"}
         
         table = self.tables[table_id]
+        if ws in self.delta_clients:
+            # Full snapshot (e.g. after a seq gap): deltas resume from here
+            self.delta_clients[ws] = (table_id, table.seq)
         return {
             "type": "table_state_response",
             "success": True,
             "table_state": table.get_state(user_id)
         }
+
+    async def handle_enable_table_deltas(self, ws, data: dict):
+        # Opt-in: the client applies table_delta ops and asks get_table_state on a seq gap
+        self.delta_clients[ws] = None
+        return {"type": "table_deltas_enabled", "success": True}
     
+    def _card_slots(self, table):
+        # Hand number is part of the slot so a new hand shows up in table diffs
+        return f"@@{self._card_slot_nonce}:{{}}:{table.hand_number}@@".format
+
+    def _table_update_messages(self, table, state=None):
+        if state is None:
+            state = table.get_state(private_cards=self._card_slots(table))
+        return self._splice_private_cards(table, self.json.dumps({"type": "table_update", "table_state": state}))
+
+    def _splice_private_cards(self, table, encoded):
+        """Turn a message encoded with card slots into per-recipient messages.
+
+        Returns the message everybody without private cards gets, and a dict
+        user_id -> message for players whose cards are still hidden to others.
+        """
+        # [text, uid, text, uid, ..., text]: one slot per player with hidden cards
+        pieces = self._card_slot_pattern.split(encoded)
+        texts = pieces[0::2]
+        hidden = self._hidden_cards
+
+        private = {}
+        for i, uid in enumerate(pieces[1::2]):
+            player = table.players.get(int(uid))
+            if player is None:
+                continue
+            own = self.json.dumps([Card.to_dict(c) for c in player['cards']])
+            private[int(uid)] = hidden.join(texts[:i + 1]) + own + hidden.join(texts[i + 1:])
+        return hidden.join(texts), private
+
+    def _binary_table_updates(self, table, state):
+        # Same shape as _splice_private_cards: (message for everybody, {user_id: message with own cards})
+        frame, slots = BinaryProtocol.encode_table_update(state)
+        private = {}
+        for uid, offset in slots.items():
+            player = table.players.get(uid)
+            if player is None or len(player['cards']) != 2:
+                continue
+            own = bytearray(frame)
+            own[offset:offset + 2] = bytes(player['cards'])
+            private[uid] = BinaryFrame(own)
+        return BinaryFrame(frame), private
+
     async def broadcast_table_state(self, table_id: str):
         if table_id not in self.tables:
             return
         
         table = self.tables[table_id]
+        start = time.perf_counter()
+        recipients = 0
+        seq, state, ops = table.publish(private_cards=self._card_slots(table))
+        full = delta = binary = None
         for player_id in table.players:
             if player_id in self.user_connections:
                 ws = self.user_connections[player_id]
+                if ws in self.delta_clients:
+                    known = self.delta_clients[ws]
+                    if known == (table_id, seq):
+                        continue # Nothing new for this client
+                    self.delta_clients[ws] = (table_id, seq)
+                    if ops and known == (table_id, seq - 1) and ws.backlog <= WebSocketAdapter.COALESCE_AFTER:
+                        if delta is None:
+                            delta = self._splice_private_cards(table, self.json.dumps({
+                                "type": "table_delta",
+                                "table_id": table_id,
+                                "seq": seq,
+                                "base_seq": seq - 1,
+                                "ops": ops
+                            }))
+                        message = delta[1].get(player_id, delta[0])
+                        recipients += 1
+                        try:
+                            await ws.send(message, table=table_id)
+                        except:
+                            pass
+                        continue
+                if getattr(ws, "binary", False):
+                    if binary is None:
+                        binary = self._binary_table_updates(table, state)
+                    message = binary[1].get(player_id, binary[0])
+                else:
+                    if full is None:
+                        full = self._table_update_messages(table, state)
+                    message = full[1].get(player_id, full[0])
+                recipients += 1
                 try:
-                    await ws.send(json.dumps({
-                        "type": "table_update",
-                        "table_state": table.get_state(player_id)
-                    }))
+                    # Replaces any update for this table the client has not received yet
+                    await ws.send(message, table=table_id, snapshot=True)
                 except:
                     pass
+        self.metrics.observe("poker_broadcast_recipients", recipients)
+        self.metrics.observe("poker_broadcast_seconds", time.perf_counter() - start)
     
     async def handle_get_transaction_history(self, ws, data: dict):
         user_id = self.connections.get(ws)
         if not user_id:
             return {"type": "transactions_data", "success": False, "error": "Non autenticato"}
         
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.db.read() as db:
             cursor = await db.execute(
                 """SELECT type, amount, status, description, created_at 
                    FROM transactions WHERE user_id = ? 
@@ -1892,39 +4478,51 @@ class PokerServer:
                 "transactions": [dict(t) for t in transactions]
             }
 
+    def _friend_game_row(self, table_id, table):
+        return {
+            "id": table_id,
+            "name": table.name,
+            "game_type": "Private",
+            "creator": table.creator_username,
+            "creator_id": table.creator_id,
+            "current_players": len(table.players),
+            "max_players": table.max_players,
+            "buy_in": table.min_buy_in,
+            "small_blind": table.small_blind,
+            "big_blind": table.big_blind,
+            "status": table.game_phase,
+            "blinds": f"€{table.small_blind:.2f}/€{table.big_blind:.2f}",
+            "players": f"{len(table.players)}/{table.max_players}",
+            "table_id": table_id
+        }
+
+    def _friend_game_info(self):
+        # Return ALL private tables (not just friends) so creators can see their own tables
+        return [self._friend_game_row(table_id, table) for table_id, table in self.tables.items() if table.is_private]
+
     async def handle_get_friend_games(self, ws, data: dict):
         user_id = self.connections.get(ws)
-        if not user_id:
-            return {"type": "friend_games_list", "success": False, "error": "Non autenticato"}
-        
-        friend_games = []
-        
-        # Return ALL private tables (not just friends) so creators can see their own tables
-        for table_id, table in self.tables.items():
-            if table.is_private:
-                friend_games.append({
-                    "id": table_id,
-                    "name": table.name,
-                    "game_type": "Private",
-                    "creator": table.creator_username,
-                    "creator_id": table.creator_id,
-                    "current_players": len(table.players),
-                    "max_players": table.max_players,
-                    "buy_in": table.min_buy_in,
-                    "small_blind": table.small_blind,
-                    "big_blind": table.big_blind,
-                    "status": table.game_phase,
-                    "blinds": f"€{table.small_blind:.2f}/€{table.big_blind:.2f}",
-                    "players": f"{len(table.players)}/{table.max_players}",
-                    "table_id": table_id
-                })
+        if not user_id:
+            return {"type": "friend_games_list", "success": False, "error": "Non autenticato"}
         
         return {
             "type": "friend_games_list",
             "success": True,
-            "games": friend_games
+            "games": await self._table_info("friend_game")
         }
 
+    async def handle_subscribe_lobby(self, ws, data: dict):
+        user_id = self.connections.get(ws)
+        if not user_id:
+            return {"type": "lobby_snapshot", "success": False, "error": "Non autenticato"}
+        # Rows as of the last tick: the next lobby_update carries everything after it
+        self.lobby.subscribers.add(ws)
+        return {"type": "lobby_snapshot", "success": True, **self.lobby.snapshot(self._lobby_order)}
+
+    async def handle_unsubscribe_lobby(self, ws, data: dict):
+        self.lobby.subscribers.discard(ws)
+        return {"type": "lobby_unsubscribed", "success": True}
+
     async def handle_delete_friend_game(self, ws, data: dict):
         user_id = self.connections.get(ws)
         if not user_id:
@@ -1946,12 +4544,13 @@ class PokerServer:
              
         # Delete
         del self.tables[table_id]
+        self.store.forget(table_id)
         
         # Update DB status
         if table_id.startswith("private_"):
             try:
                 game_id = int(table_id.split("_")[1])
-                async with aiosqlite.connect(self.db_path) as db:
+                async with self.db.write() as db:
                     await db.execute("UPDATE private_games SET status = 'closed' WHERE id = ?", (game_id,))
                     await db.commit()
             except:
@@ -1964,10 +4563,9 @@ class PokerServer:
         if not user_id:
             return {"type": "history_data", "success": False, "error": "Non autenticato"}
         
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.db.read() as db:
             cursor = await db.execute(
-                """SELECT id, game_type, result, chips_change, hand as details, created_at as played_at 
+                """SELECT id, game_type, result, chips_change, hand as details, hand_id, created_at as played_at 
                    FROM game_history WHERE user_id = ? 
                    ORDER BY created_at DESC LIMIT 50""",
                 (user_id,)
@@ -1980,6 +4578,27 @@ class PokerServer:
                 "history": [dict(h) for h in history]
             }
 
+    async def handle_get_hand_replay(self, ws, data: dict):
+        user_id = self.connections.get(ws)
+        if not user_id:
+            return {"type": "hand_replay", "success": False, "error": "Non autenticato"}
+        hand_id = data.get('hand_id')
+        hand = self.hand_history.read(hand_id) if isinstance(hand_id, int) else None
+        # Only hands the player was dealt into
+        if hand is None or user_id not in [seat['user_id'] for seat in hand['seats']]:
+            return {"type": "hand_replay", "success": False, "error": "Mano non trovata"}
+        return {
+            "type": "hand_replay",
+            "success": True,
+            "hand_id": hand_id,
+            "table_id": hand['table_id'],
+            "hand_number": hand['hand_number'],
+            "started": hand['started'],
+            "ended": hand['ended'],
+            "dealer_position": hand['dealer_position'],
+            "states": self.hand_history.replay(hand_id, for_user_id=user_id)
+        }
+
     async def handle_chat_message(self, ws, data: dict):
         user_id = self.connections.get(ws)
         table_id = data.get('table_id')
@@ -1989,7 +4608,7 @@ class PokerServer:
             return {"type": "chat_sent", "success": False}
             
         # Get username
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.db.read() as db:
             cursor = await db.execute("SELECT username FROM users WHERE id = ?", (user_id,))
             row = await cursor.fetchone()
             username = row[0] if row else "Unknown"
@@ -2000,18 +4619,27 @@ class PokerServer:
             # Send to players and spectators (if any)
             # For now just players in self.players dict
             targets = list(table.players.keys())
+            payload = binary = None
             
             for pid in targets:
                 if pid in self.user_connections:
                     pws = self.user_connections[pid]
+                    if getattr(pws, "binary", False):
+                        if binary is None:
+                            binary = BinaryProtocol.encode_chat(table_id, user_id, username, message)
+                        out = binary
+                    else:
+                        if payload is None:
+                            payload = self.json.dumps({
+                                "type": "chat_message",
+                                "table_id": table_id,
+                                "user_id": user_id,
+                                "username": username,
+                                "message": message
+                            })
+                        out = payload
                     try:
-                        await pws.send(json.dumps({
-                            "type": "chat_message",
-                            "table_id": table_id,
-                            "user_id": user_id,
-                            "username": username,
-                            "message": message
-                        }))
+                        await pws.send(out)
                     except:
                         pass
         
@@ -2020,8 +4648,7 @@ class PokerServer:
     async def handle_get_leaderboard(self, ws, data: dict):
         leaderboard_type = data.get('leaderboard_type', 'chips') # chips, winnings
         
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.db.read() as db:
             if leaderboard_type == 'winnings':
                 cursor = await db.execute("""
                     SELECT u.username, s.games_won as score, u.level
@@ -2054,7 +4681,7 @@ class PokerServer:
         if not isinstance(avatar_id, int) or avatar_id < 0 or avatar_id > 50: # Increased limit for new avatars
             return {"type": "avatar_update_result", "success": False, "error": "Avatar non valido"}
             
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.db.write() as db:
             await db.execute("UPDATE users SET avatar_id = ? WHERE id = ?", (avatar_id, user_id))
             await db.commit()
             
@@ -2078,9 +4705,10 @@ class PokerServer:
         action = data.get('action') # check, call, raise, fold
         amount = float(data.get('amount', 0))
         
-        success, message = table.handle_action(user_id, action, amount)
+        success, message = self._apply(table, "handle_action", user_id, action, amount)
         
         if success:
+            self._schedule_equity(table_id)
             # Broadcast update
             await self.broadcast_table_state(table_id)
             
@@ -2092,11 +4720,8 @@ class PokerServer:
                 if table_id in self.table_timers:
                     self.table_timers[table_id].cancel()
                 
-                # Wait 5 seconds then restart (async sleep in background task would be better but blocking here for simplicity is risky)
-                # We should trigger a delayed restart. 
-                # For now, let's just leave it at showdown. 
-                # Ideally: asyncio.create_task(self.restart_hand(table_id))
-                asyncio.create_task(self.restart_hand(table_id))
+                # Restart after 8 seconds to show results
+                self.timers.arm(8, self.restart_hand, table_id)
             else:
                 self._start_turn_timer(table_id)
                 
@@ -2104,89 +4729,127 @@ class PokerServer:
         else:
             return {"type": "action_result", "success": False, "error": message}
 
+    def _schedule_equity(self, table_id):
+        table = self.tables.get(table_id)
+        if table is None or not table.equity_request:
+            return
+        request = table.equity_request
+        table.equity_request = None
+        if table.running_out:
+            self._run_outs[table_id] = table.hand_number # _publish_equity deals the next street
+        asyncio.create_task(self._publish_equity(table_id, table.hand_number, request))
+
+    async def _publish_equity(self, table_id, hand_number, request):
+        user_ids = list(request['hands'])
+        try:
+            result = await self.equity.compute([request['hands'][uid] for uid in user_ids], request['board'])
+        except Exception as e:
+            print(f"Equity calculation failed for table {table_id}: {e}")
+            result = None
+
+        table = self.tables.get(table_id)
+        if (table is None or table.hand_number != hand_number or table.game_phase == "showdown"
+                or len(table.community_cards) != len(request['board'])):
+            return # Street or hand already over
+
+        if result is not None:
+            table.equity = [dict(user_id=uid, **share) for uid, share in zip(user_ids, result['players'])]
+            payload = self.json.dumps({
+                "type": "equity_update",
+                "table_id": table_id,
+                "equity": table.equity,
+                "exact": result['exact']
+            })
+            for uid in list(table.players) + list(table.spectators):
+                if uid in self.user_connections:
+                    try:
+                        await self.user_connections[uid].send(payload)
+                    except:
+                        pass
+        if table.running_out:
+            # The next street only once everyone has seen the odds of this one
+            self.timers.arm(self.RUN_OUT_DELAY, self.run_out_street, table_id)
+
+    async def run_out_street(self, table_id):
+        table = self.tables.get(table_id)
+        if table is None or not table.running_out:
+            return
+        self._run_outs.pop(table_id, None)
+        self._apply(table, "run_out_street")
+        self._schedule_equity(table_id)
+        await self.broadcast_table_state(table_id)
+        if table.game_phase == "showdown":
+            self.timers.arm(8, self.restart_hand, table_id)
+
     async def restart_hand(self, table_id):
-        await asyncio.sleep(8) # Wait 8 seconds to show results
         if table_id in self.tables:
             table = self.tables[table_id]
-            table.start_hand()
+            self._apply(table, "start_hand")
             await self.broadcast_table_state(table_id)
             self._start_turn_timer(table_id)
 
-    async def handle_message(self, ws, message: str):
+    async def handle_message(self, ws, message):
+        """message is raw JSON, or a dict already decoded from a binary frame."""
+        codec = self.json
         try:
-            data = json.loads(message)
+            data = message if isinstance(message, dict) else codec.loads(message)
+            if not isinstance(data, dict):
+                self.metrics.inc("poker_action_errors_total", ("invalid_json", "rejected"))
+                await ws.send(codec.dumps({"type": "error", "error": "Invalid JSON"}))
+                return
             action = data.get('action') or data.get('type', '')
-            
-            handlers = {
-                'ping': self.handle_ping,
-                'register': self.handle_register,
-                'login': self.handle_login,
-                'get_security_question': self.handle_get_security_question,
-                'verify_security_answer': self.handle_verify_security_answer,
-                'reset_password': self.handle_reset_password,
-                'change_password': self.handle_change_password,
-                'get_wallet': self.handle_get_wallet,
-                'create_deposit': self.handle_create_deposit,
-                'wallet_deposit': self.handle_create_deposit, # Alias for client
-                'verify_deposit': self.handle_verify_deposit,
-                'capture_deposit': self.handle_verify_deposit, # Alias for client
-                'cancel_deposit': self.handle_cancel_deposit,
-                'withdraw': self.handle_withdraw,
-                'wallet_withdraw': self.handle_withdraw, # Alias for client
-                'get_statistics': self.handle_get_statistics,
-                'search_users': self.handle_search_users,
-                'send_friend_request': self.handle_send_friend_request,
-                'accept_friend_request': self.handle_accept_friend_request,
-                'get_friends': self.handle_get_friends,
-                'get_cash_tables': self.handle_get_cash_tables,
-                'join_cash_table': self.handle_join_cash_table,
-                'create_private_game': self.handle_create_private_game,
-                'create_friend_game': self.handle_create_private_game, # Alias for client
-                'join_private_game': self.handle_join_private_game,
-                'join_friend_game': self.handle_join_private_game, # Alias for client
-                'leave_table': self.handle_leave_table,
-                'get_table_state': self.handle_get_table_state,
-                'get_game_history': self.handle_get_game_history,
-                'get_transaction_history': self.handle_get_transaction_history,
-                'get_friend_games': self.handle_get_friend_games,
-                'chat_message': self.handle_chat_message,
-                'get_leaderboard': self.handle_get_leaderboard,
-                'update_avatar': self.handle_update_avatar,
-                'check': self.handle_game_action,
-                'call': self.handle_game_action,
-                'raise': self.handle_game_action,
-                'fold': self.handle_game_action,
-                'sitout': self.handle_game_action,
-                'sitin': self.handle_game_action,
-            }
-            
-            handler = handlers.get(action)
-            if handler:
-                response = await handler(ws, data)
-                await ws.send(json.dumps(response))
+            entry = self._dispatch.get(action)
+            if entry:
+                handler, validate = entry
+                invalid = validate(data) if validate is not None else None
+                if invalid is not None:
+                    self.metrics.inc("poker_action_errors_total", (action, "rejected"))
+                    await ws.send(codec.dumps({"type": "error", "success": False, "error": f"Campo non valido: {invalid}"}))
+                    return
+                start = time.perf_counter()
+                token = CURRENT_ACTION.set(action)
+                try:
+                    response = await handler(ws, data)
+                    await ws.send(codec.dumps(response))
+                except Exception:
+                    self.metrics.inc("poker_action_errors_total", (action, "exception"))
+                    raise
+                finally:
+                    CURRENT_ACTION.reset(token)
+                    self.metrics.observe("poker_action_seconds", time.perf_counter() - start, (action,))
+                if isinstance(response, dict) and response.get("success") is False:
+                    self.metrics.inc("poker_action_errors_total", (action, "rejected"))
             else:
-                await ws.send(json.dumps({
+                self.metrics.inc("poker_action_errors_total", ("unknown", "rejected"))
+                await ws.send(codec.dumps({
                     "type": "error",
                     "error": f"Unknown action: {action}"
                 }))
         except json.JSONDecodeError:
-            await ws.send(json.dumps({"type": "error", "error": "Invalid JSON"}))
+            self.metrics.inc("poker_action_errors_total", ("invalid_json", "rejected"))
+            await ws.send(codec.dumps({"type": "error", "error": "Invalid JSON"}))
         except Exception as e:
             print(f"Error handling message: {e}")
-            await ws.send(json.dumps({"type": "error", "error": str(e)}))
+            await ws.send(codec.dumps({"type": "error", "error": str(e)}))
     
     async def handle_websocket_request(self, request):
-        ws = web.WebSocketResponse(heartbeat=30.0) # Enable heartbeat
+        # Heartbeat enabled; clients asking for the binary subprotocol or deflate get them
+        ws = web.WebSocketResponse(heartbeat=30.0, protocols=(BinaryProtocol.SUBPROTOCOL,),
+                                   compress=bool(SERVER_CONFIG.get("ws_compression", True)))
         await ws.prepare(request)
         
-        adapter = WebSocketAdapter(ws, request)
+        adapter = WebSocketAdapter(ws, request, stats=self.wire_stats)
+        adapter.binary = ws.ws_protocol == BinaryProtocol.SUBPROTOCOL
+        self.sockets.add(adapter)
         print(f"New connection from {adapter.remote_address}")
         
         try:
-            await adapter.send(json.dumps({"type": "connected", "status": "ok"}))
+            await adapter.send(self.json.dumps({"type": "connected", "status": "ok",
+                                                "protocol": "binary" if adapter.binary else "json"}))
             print(f"Sent connected ack to {adapter.remote_address}")
         except Exception as e:
             print(f"Failed to send connected ack: {e}")
+            self.sockets.discard(adapter)
             return ws
 
         try:
@@ -2194,6 +4857,13 @@ class PokerServer:
             async for msg in ws:
                 if msg.type == WSMsgType.TEXT:
                     await self.handle_message(adapter, msg.data)
+                elif msg.type == WSMsgType.BINARY and adapter.binary:
+                    try:
+                        data = BinaryProtocol.decode_request(msg.data)
+                    except ValueError as e:
+                        await adapter.send(self.json.dumps({"type": "error", "error": str(e)}))
+                        continue
+                    await self.handle_message(adapter, data)
                 elif msg.type == WSMsgType.ERROR:
                     print('ws connection closed with exception %s', ws.exception())
                 elif msg.type == WSMsgType.PING:
@@ -2205,34 +4875,42 @@ class PokerServer:
         except Exception as e:
             print(f"WS Exception: {e}")
         finally:
-            # Cleanup
-            user_id = self.connections.pop(adapter, None)
-            if user_id:
-                self.user_connections.pop(user_id, None)
-                # Handle leaving table on disconnect
-                table_id = self.user_tables.get(user_id)
-                if table_id and table_id in self.tables:
-                    table = self.tables[table_id]
-                    # Mark as sitting out
-                    if user_id in table.players:
-                        table.players[user_id]['is_sitting_out'] = True
-                        
-                        # If it was their turn, force fold/check to unblock game
-                        if table.current_player == user_id and table.game_phase not in ["waiting", "showdown"]:
-                            action = "fold"
-                            if table.players[user_id]['current_bet'] == table.current_bet:
-                                action = "check"
-                            table.handle_action(user_id, action)
-                            self._start_turn_timer(table_id)
-                            
-                        # Broadcast update
-                        try:
-                            await self.broadcast_table_state(table_id)
-                        except:
-                            pass
-            print(f"Connection closed: {adapter.remote_address}")
+            await self._handle_disconnect(adapter)
             
         return ws
+
+    async def _handle_disconnect(self, adapter):
+        # Cleanup
+        adapter.stop()
+        self.sockets.discard(adapter)
+        self.lobby.subscribers.discard(adapter)
+        self.delta_clients.pop(adapter, None)
+        user_id = self.connections.pop(adapter, None)
+        if user_id:
+            self.user_connections.pop(user_id, None)
+            # Handle leaving table on disconnect
+            table_id = self.user_tables.get(user_id)
+            if table_id and table_id in self.tables:
+                table = self.tables[table_id]
+                # Mark as sitting out
+                if user_id in table.players:
+                    self._apply(table, "sit_out", user_id)
+                    
+                    # If it was their turn, force fold/check to unblock game
+                    if table.current_player == user_id and table.game_phase not in ["waiting", "showdown"]:
+                        action = "fold"
+                        if table.players[user_id]['current_bet'] == table.current_bet:
+                            action = "check"
+                        self._apply(table, "handle_action", user_id, action)
+                        self._schedule_equity(table_id)
+                        self._start_turn_timer(table_id)
+                        
+                    # Broadcast update
+                    try:
+                        await self.broadcast_table_state(table_id)
+                    except:
+                        pass
+        print(f"Connection closed: {adapter.remote_address}")
     
     async def admin_serve_dashboard(self, request):
         try:
@@ -2247,8 +4925,7 @@ class PokerServer:
             return web.Response(text=f"Admin panel file not found. Checked: {path}", status=404)
 
     async def admin_get_users(self, request):
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.db.read() as db:
             cursor = await db.execute("""
                 SELECT u.id, u.username, u.email, u.chips, u.level, u.is_banned, w.balance as wallet_balance
                 FROM users u
@@ -2264,20 +4941,29 @@ class PokerServer:
             
             return web.json_response(users)
 
+    def _admin_table_row(self, table_id, table):
+        return {
+            "id": table_id,
+            "name": table.name,
+            "players": len(table.players),
+            "max_players": table.max_players,
+            "small_blind": table.small_blind,
+            "big_blind": table.big_blind,
+            "min_buy_in": table.min_buy_in,
+            "max_buy_in": table.max_buy_in,
+            "pot": table.pot,
+            "phase": table.game_phase
+        }
+
+    def _admin_table_info(self):
+        return [self._admin_table_row(table_id, table) for table_id, table in self.tables.items()]
+
+    def _describe_admin_table(self, table_id):
+        table = self.tables.get(table_id)
+        return ("tables", self._admin_table_row(table_id, table)) if table is not None else None
+
     async def admin_get_tables(self, request):
-        tables_data = []
-        for tid, table in self.tables.items():
-            tables_data.append({
-                "id": tid,
-                "name": table.name,
-                "players": len(table.players),
-                "max_players": table.max_players,
-                "small_blind": table.small_blind,
-                "big_blind": table.big_blind,
-                "pot": table.pot,
-                "phase": table.game_phase
-            })
-        return web.json_response(tables_data)
+        return web.json_response(await self._table_info("admin_table"))
 
     async def admin_update_balance(self, request):
         try:
@@ -2285,7 +4971,7 @@ class PokerServer:
             data = await request.json()
             amount = float(data.get('amount', 0))
             
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.db.write() as db:
                 await db.execute("UPDATE wallets SET balance = ? WHERE user_id = ?", (amount, user_id))
                 await db.commit()
             
@@ -2296,7 +4982,7 @@ class PokerServer:
     async def admin_ban_user(self, request):
         try:
             user_id = int(request.match_info['id'])
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.db.write() as db:
                 await db.execute("UPDATE users SET is_banned = 1 WHERE id = ?", (user_id,))
                 await db.commit()
             
@@ -2312,7 +4998,7 @@ class PokerServer:
     async def admin_unban_user(self, request):
         try:
             user_id = int(request.match_info['id'])
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.db.write() as db:
                 await db.execute("UPDATE users SET is_banned = 0 WHERE id = ?", (user_id,))
                 await db.commit()
             return web.json_response({"success": True})
@@ -2320,8 +5006,7 @@ class PokerServer:
             return web.json_response({"success": False, "error": str(e)}, status=500)
 
     async def admin_get_transactions(self, request):
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.db.read() as db:
             cursor = await db.execute("""
                 SELECT t.*, u.username 
                 FROM transactions t
@@ -2338,7 +5023,7 @@ class PokerServer:
             if not message:
                 return web.json_response({"success": False, "error": "Message required"}, status=400)
             
-            payload = json.dumps({
+            payload = self.json.dumps({
                 "type": "notification",
                 "title": "Messaggio di Sistema",
                 "message": message,
@@ -2358,8 +5043,7 @@ class PokerServer:
             return web.json_response({"success": False, "error": str(e)}, status=500)
 
     async def admin_get_global_game_history(self, request):
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.db.read() as db:
             cursor = await db.execute("""
                 SELECT h.id, h.game_type, h.result, h.chips_change, h.hand, h.created_at, u.username
                 FROM game_history h
@@ -2371,62 +5055,68 @@ class PokerServer:
 
     async def admin_delete_table(self, request):
         try:
-            table_id = request.match_info['id']
-            if table_id not in self.tables:
-                return web.json_response({"success": False, "error": "Table not found"}, status=404)
-            
-            table = self.tables[table_id]
-            
-            # Refund everyone
-            async with aiosqlite.connect(self.db_path) as db:
-                for uid, player in table.players.items():
-                    chips = player['chips'] + player['current_bet']
-                    
-                    if chips > 0:
-                        await db.execute("UPDATE wallets SET balance = balance + ? WHERE user_id = ?", (chips, uid))
-                        await db.execute(
-                            """INSERT INTO transactions (user_id, type, amount, status, description)
-                               VALUES (?, 'admin_refund', ?, 'completed', ?)""",
-                            (uid, chips, f"Admin closed table: {table.name}")
-                        )
-                await db.commit()
-
-            # Notify players
-            for uid in list(table.players.keys()):
-                if uid in self.user_connections:
-                    ws = self.user_connections[uid]
-                    try:
-                        await ws.send(json.dumps({
-                            "type": "notification",
-                            "title": "Tavolo Chiuso",
-                            "message": "Il tavolo è stato chiuso dall'amministratore.",
-                            "notification_type": "system"
-                        }))
-                        # Remove from user_tables
-                        if uid in self.user_tables:
-                            del self.user_tables[uid]
-                    except:
-                        pass
+            result = await self._close_table(request.match_info['id'])
+            if not result["success"]:
+                return web.json_response(result, status=404)
+            return web.json_response(result)
+        except Exception as e:
+            return web.json_response({"success": False, "error": str(e)}, status=500)
 
-            # Delete table
-            del self.tables[table_id]
-            if table_id in self.table_timers:
-                self.table_timers[table_id].cancel()
-                del self.table_timers[table_id]
+    async def _close_table(self, table_id):
+        if table_id not in self.tables:
+            return {"success": False, "error": "Table not found"}
+        
+        table = self.tables[table_id]
+        
+        # Refund everyone
+        async with self.db.write() as db:
+            for uid, player in table.players.items():
+                chips = player['chips'] + player['current_bet']
                 
-            # If private, update DB
-            if table_id.startswith("private_"):
+                if chips > 0:
+                    await db.execute("UPDATE wallets SET balance = balance + ? WHERE user_id = ?", (chips, uid))
+                    await db.execute(
+                        """INSERT INTO transactions (user_id, type, amount, status, description)
+                           VALUES (?, 'admin_refund', ?, 'completed', ?)""",
+                        (uid, chips, f"Admin closed table: {table.name}")
+                    )
+            await db.commit()
+
+        # Notify players
+        for uid in list(table.players.keys()):
+            if uid in self.user_connections:
+                ws = self.user_connections[uid]
                 try:
-                    game_id = int(table_id.split("_")[1])
-                    async with aiosqlite.connect(self.db_path) as db:
-                        await db.execute("UPDATE private_games SET status = 'closed_admin' WHERE id = ?", (game_id,))
-                        await db.commit()
+                    await ws.send(self.json.dumps({
+                        "type": "notification",
+                        "title": "Tavolo Chiuso",
+                        "message": "Il tavolo è stato chiuso dall'amministratore.",
+                        "notification_type": "system"
+                    }))
+                    # Remove from user_tables
+                    if uid in self.user_tables:
+                        del self.user_tables[uid]
                 except:
                     pass
 
-            return web.json_response({"success": True})
-        except Exception as e:
-            return web.json_response({"success": False, "error": str(e)}, status=500)
+        # Delete table
+        del self.tables[table_id]
+        self.store.forget(table_id)
+        if table_id in self.table_timers:
+            self.table_timers[table_id].cancel()
+            del self.table_timers[table_id]
+            
+        # If private, update DB
+        if table_id.startswith("private_"):
+            try:
+                game_id = int(table_id.split("_")[1])
+                async with self.db.write() as db:
+                    await db.execute("UPDATE private_games SET status = 'closed_admin' WHERE id = ?", (game_id,))
+                    await db.commit()
+            except:
+                pass
+
+        return {"success": True}
 
     async def admin_restore_defaults(self, request):
         """Restore missing default tables"""
@@ -2440,8 +5130,7 @@ class PokerServer:
 
     async def admin_get_closed_games(self, request):
         """Get closed private games that can be reactivated"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.db.read() as db:
             cursor = await db.execute("""
                 SELECT g.*, u.username as creator_name
                 FROM private_games g
@@ -2457,8 +5146,7 @@ class PokerServer:
         try:
             game_id = int(request.match_info['id'])
             
-            async with aiosqlite.connect(self.db_path) as db:
-                db.row_factory = aiosqlite.Row
+            async with self.db.write() as db:
                 cursor = await db.execute("SELECT * FROM private_games WHERE id = ?", (game_id,))
                 game = await cursor.fetchone()
                 
@@ -2527,7 +5215,7 @@ class PokerServer:
                 max_players = table.max_players
                 
                 # Refund everyone
-                async with aiosqlite.connect(self.db_path) as db:
+                async with self.db.write() as db:
                     for uid, player in table.players.items():
                         chips = player['chips'] + player['current_bet']
                         if chips > 0:
@@ -2543,7 +5231,7 @@ class PokerServer:
                 for uid in list(table.players.keys()):
                     if uid in self.user_connections:
                         try:
-                            await self.user_connections[uid].send(json.dumps({
+                            await self.user_connections[uid].send(self.json.dumps({
                                 "type": "notification",
                                 "title": "Tavolo Aggiornato",
                                 "message": "Il tavolo è stato riavviato con nuovi parametri.",
@@ -2554,6 +5242,7 @@ class PokerServer:
                 
                 # Remove old instance
                 del self.tables[table_id]
+                self.store.forget(table_id)
                 if table_id in self.table_timers:
                     self.table_timers[table_id].cancel()
                     del self.table_timers[table_id]
@@ -2570,7 +5259,7 @@ class PokerServer:
             if table_id.startswith("private_"):
                 try:
                     game_id = int(table_id.split("_")[1])
-                    async with aiosqlite.connect(self.db_path) as db:
+                    async with self.db.write() as db:
                         # Fetch original data if we didn't get it from active table
                         if not creator_id:
                             cursor = await db.execute("SELECT * FROM private_games WHERE id = ?", (game_id,))
@@ -2621,9 +5310,8 @@ class PokerServer:
             "release_notes": "Aggiunto Auto-Update e correzioni varie."
         })
 
-    async def admin_get_pending_withdrawals(self, request):
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+    async def _pending_withdrawals(self):
+        async with self.db.read() as db:
             cursor = await db.execute("""
                 SELECT t.id, t.amount, t.description, t.created_at, u.username, u.email
                 FROM transactions t
@@ -2631,46 +5319,48 @@ class PokerServer:
                 WHERE t.status = 'pending_approval' AND t.type = 'withdrawal'
                 ORDER BY t.created_at DESC
             """)
-            rows = await cursor.fetchall()
-            return web.json_response([dict(r) for r in rows])
+            return [dict(r) for r in await cursor.fetchall()]
+
+    async def admin_get_pending_withdrawals(self, request):
+        return web.json_response(await self._pending_withdrawals())
 
     async def admin_approve_withdrawal(self, request):
         try:
             tx_id = int(request.match_info['id'])
-            async with aiosqlite.connect(self.db_path) as db:
-                db.row_factory = aiosqlite.Row
+            async with self.db.read() as db:
                 cursor = await db.execute("SELECT amount, description FROM transactions WHERE id = ?", (tx_id,))
                 tx = await cursor.fetchone()
                 
-                if not tx:
-                    return web.json_response({"success": False, "error": "Transazione non trovata"}, status=404)
-                
-                amount = tx['amount']
-                desc = tx['description'] # Format "PayPal Payout: email"
-                email = desc.split(": ")[1].strip() if ": " in desc else ""
-                
-                if not email:
-                     return web.json_response({"success": False, "error": "Email PayPal non trovata nella descrizione"}, status=400)
+            if not tx:
+                return web.json_response({"success": False, "error": "Transazione non trovata"}, status=404)
+            
+            amount = tx['amount']
+            desc = tx['description'] # Format "PayPal Payout: email"
+            email = desc.split(": ")[1].strip() if ": " in desc else ""
+            
+            if not email:
+                 return web.json_response({"success": False, "error": "Email PayPal non trovata nella descrizione"}, status=400)
 
-                # Call PayPal
-                try:
-                    payout = await self.paypal.create_payout(email, amount)
-                    if 'batch_header' in payout:
+            # Call PayPal without holding a connection (the writer is shared)
+            try:
+                payout = await self.paypal.create_payout(email, amount)
+                if 'batch_header' in payout:
+                    async with self.db.write() as db:
                         await db.execute("UPDATE transactions SET status = 'completed', completed_at = CURRENT_TIMESTAMP WHERE id = ?", (tx_id,))
                         await db.commit()
-                        return web.json_response({"success": True})
-                    else:
-                        return web.json_response({"success": False, "error": "Errore PayPal: " + str(payout)}, status=500)
-                except Exception as pp_err:
-                     return web.json_response({"success": False, "error": "Eccezione PayPal: " + str(pp_err)}, status=500)
+                    self.admin_feed.withdrawals_changed = True
+                    return web.json_response({"success": True})
+                else:
+                    return web.json_response({"success": False, "error": "Errore PayPal: " + str(payout)}, status=500)
+            except Exception as pp_err:
+                 return web.json_response({"success": False, "error": "Eccezione PayPal: " + str(pp_err)}, status=500)
         except Exception as e:
             return web.json_response({"success": False, "error": str(e)}, status=500)
 
     async def admin_reject_withdrawal(self, request):
         try:
             tx_id = int(request.match_info['id'])
-            async with aiosqlite.connect(self.db_path) as db:
-                db.row_factory = aiosqlite.Row
+            async with self.db.write() as db:
                 cursor = await db.execute("SELECT user_id, amount FROM transactions WHERE id = ?", (tx_id,))
                 tx = await cursor.fetchone()
                 
@@ -2683,6 +5373,7 @@ class PokerServer:
                 await db.execute("UPDATE transactions SET status = 'rejected', completed_at = CURRENT_TIMESTAMP WHERE id = ?", (tx_id,))
                 
                 await db.commit()
+            self.admin_feed.withdrawals_changed = True
             return web.json_response({"success": True})
         except Exception as e:
             return web.json_response({"success": False, "error": str(e)}, status=500)
@@ -2690,6 +5381,68 @@ class PokerServer:
     async def admin_get_config(self, request):
         return web.json_response(SERVER_CONFIG)
 
+    async def _close_admin_feed(self, app):
+        self.admin_feed.close()
+
+    async def admin_get_feed(self, request):
+        # Server-sent events for the dashboard, see AdminFeed
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+        queue = self.admin_feed.join()
+        try:
+            await self.admin_feed_tick() # the snapshot goes out now, not at the next tick
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), self.ADMIN_FEED_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    event = b": keepalive\n\n" # also notices panels that went away
+                if event is None:
+                    break
+                await response.write(event)
+        except ConnectionResetError:
+            pass
+        finally:
+            self.admin_feed.leave(queue)
+        return response
+
+    async def admin_get_db_pool(self, request):
+        return web.json_response(self.db.stats())
+
+    async def admin_get_timers(self, request):
+        return web.json_response(self.timers.stats())
+
+    async def admin_get_ws_stats(self, request):
+        # The compression tradeoff per message type: bytes saved against time spent
+        out = {}
+        for kind, (messages, compressed, payload, wire, seconds) in sorted(self.wire_stats.items()):
+            out[kind] = {
+                "messages": messages,
+                "compressed": compressed,
+                "payload_bytes": payload,
+                "wire_bytes": wire,
+                "ratio": round(wire / payload, 3) if payload else None,
+                "send_us_avg": round(1e6 * seconds / messages, 2) if messages else 0.0,
+            }
+        return web.json_response({
+            "compression": SERVER_CONFIG.get("ws_compression", True),
+            "compress_min_bytes": SERVER_CONFIG.get("ws_compress_min_bytes", 1024),
+            "compressed_connections": sum(1 for ws in self.sockets if ws.compressed),
+            "types": out
+        })
+
+    async def admin_get_workers(self, request):
+        return web.json_response({"sharded": False, "workers": []})
+
+    async def admin_add_worker(self, request):
+        return web.json_response({"success": False, "error": "Sharding not enabled (POKER_WORKERS)"}, status=400)
+
+    async def admin_remove_worker(self, request):
+        return web.json_response({"success": False, "error": "Sharding not enabled (POKER_WORKERS)"}, status=400)
+
+    async def handle_metrics(self, request):
+        return web.Response(text=self.metrics.render(), content_type="text/plain", charset="utf-8",
+                            headers={"X-Content-Type-Options": "nosniff"})
+
     async def admin_update_config(self, request):
         try:
             data = await request.json()
@@ -2700,7 +5453,7 @@ class PokerServer:
             return web.json_response({"success": False, "error": str(e)}, status=500)
 
     async def admin_get_analytics(self, request):
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.db.read() as db:
             # Daily stats could be complex, for now simple aggregates
             
             # Total chips
@@ -2713,7 +5466,9 @@ class PokerServer:
             
             # Games played today (from game_history)
             today = datetime.now().strftime("%Y-%m-%d")
-            cursor = await db.execute("SELECT COUNT(*) FROM game_history WHERE date(created_at) = ?", (today,))
+            tomorrow = (datetime.now() + timedelta(days=1)).strftime("%Y-%m-%d")
+            # Range on the raw column so idx_game_history_created applies (date() would scan)
+            cursor = await db.execute("SELECT COUNT(*) FROM game_history WHERE created_at >= ? AND created_at < ?", (today, tomorrow))
             games_today = (await cursor.fetchone())[0] or 0
             
             return web.json_response({
@@ -2728,8 +5483,7 @@ class PokerServer:
     async def admin_get_user_details(self, request):
         try:
             user_id = int(request.match_info['id'])
-            async with aiosqlite.connect(self.db_path) as db:
-                db.row_factory = aiosqlite.Row
+            async with self.db.read() as db:
                 
                 # Basic info
                 cursor = await db.execute("SELECT * FROM users WHERE id = ?", (user_id,))
@@ -2759,6 +5513,14 @@ class PokerServer:
         port = port or int(os.environ.get("PORT", 8765))
         
         await self.init_db()
+        await self.restore_tables()
+        LookupHandEvaluator.build_tables()
+        self._lag_monitor = asyncio.ensure_future(self.metrics.monitor_loop_lag())
+        self._snapshots = asyncio.ensure_future(self.store.run())
+        self.hand_history.open()
+        self._game_history = asyncio.ensure_future(self.game_history_loop())
+        self._lobby = asyncio.ensure_future(self.lobby_loop())
+        self._admin_feed = asyncio.ensure_future(self.admin_feed_loop())
         print(f"Poker Server v14 starting on {host}:{port}")
         print(f"Database file: {os.path.abspath(self.db_path)}")
         print(f"Data Directory: {os.path.abspath(self.data_dir)}")
@@ -2766,6 +5528,8 @@ class PokerServer:
         print(f"PayPal: {'Configured' if PAYPAL_CLIENT_ID else 'Not configured'}")
         
         app = web.Application()
+        app.on_shutdown.append(self._close_admin_feed) # open panels would hold the shutdown
+        app.on_shutdown.append(self._close_game_history)
         # CORS
         import aiohttp_cors
         cors = aiohttp_cors.setup(app, defaults={
@@ -2780,6 +5544,9 @@ class PokerServer:
         app.router.add_get('/', self.handle_websocket_request)
         app.router.add_get('/ws', self.handle_websocket_request)
         
+        # Prometheus scrape endpoint
+        app.router.add_get('/metrics', self.handle_metrics)
+        
         # Admin Routes
         app.router.add_get('/admin', self.admin_serve_dashboard)
         app.router.add_get('/dashboard', self.admin_serve_dashboard)
@@ -2853,6 +5620,24 @@ class PokerServer:
         cors.add(resource_config.add_route("GET", self.admin_get_config))
         cors.add(resource_config.add_route("POST", self.admin_update_config))
 
+        resource_db_pool = cors.add(app.router.add_resource("/api/admin/db_pool"))
+        cors.add(resource_db_pool.add_route("GET", self.admin_get_db_pool))
+
+        resource_timers = cors.add(app.router.add_resource("/api/admin/timers"))
+        cors.add(resource_timers.add_route("GET", self.admin_get_timers))
+        resource_feed = cors.add(app.router.add_resource("/api/admin/feed"))
+        cors.add(resource_feed.add_route("GET", self.admin_get_feed))
+
+        resource_ws_stats = cors.add(app.router.add_resource("/api/admin/ws_stats"))
+        cors.add(resource_ws_stats.add_route("GET", self.admin_get_ws_stats))
+
+        resource_workers = cors.add(app.router.add_resource("/api/admin/workers"))
+        cors.add(resource_workers.add_route("GET", self.admin_get_workers))
+        cors.add(resource_workers.add_route("POST", self.admin_add_worker))
+
+        resource_worker = cors.add(app.router.add_resource("/api/admin/workers/{id}"))
+        cors.add(resource_worker.add_route("DELETE", self.admin_remove_worker))
+
         resource_analytics = cors.add(app.router.add_resource("/api/admin/analytics"))
         cors.add(resource_analytics.add_route("GET", self.admin_get_analytics))
 
@@ -2865,9 +5650,615 @@ class PokerServer:
         await site.start()
         print(f"Poker Server v14 running on http://{host}:{port}")
 
-        await asyncio.Event().wait()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            # Cancelled (Ctrl+C, SIGTERM): the on_shutdown hooks write the hand log and
+            # game history, then what ShardWorker.serve also does on stop
+            await runner.cleanup()
+            for task in (self._lag_monitor, self._snapshots, self._lobby, self._admin_feed):
+                task.cancel()
+            self.store.flush()
+            self.timers.stop()
+            self.equity.shutdown()
+            await self.db.close()
+
+# ==========================================
+# SHARDING (POKER_WORKERS > 1)
+# ==========================================
+
+class TableRing:
+    """Consistent placement of tables on shard workers.
+
+    Rendezvous hashing: a table belongs to the worker with the highest
+    weight(worker, table_id), so adding or removing a worker only moves the
+    tables that worker gains or loses. Weights come from blake2b, not hash(),
+    so every process agrees on the owner.
+    """
+    def __init__(self, workers=()):
+        self.workers = tuple(sorted(workers))
+        self._owners = LRUCache(10_000) # table_id -> worker; ids come from clients, so bounded
+
+    @staticmethod
+    def _weight(worker, table_id):
+        digest = hashlib.blake2b(f"{worker}\0{table_id}".encode(), digest_size=8).digest()
+        return int.from_bytes(digest, "big")
+
+    def owner(self, table_id):
+        owner = self._owners.get(table_id)
+        if owner is None and self.workers:
+            owner = max(self.workers, key=lambda w: self._weight(w, table_id))
+            self._owners.put(table_id, owner)
+        return owner
+
+class ShardLink:
+    """Length-prefixed pickle frames over a Unix socket between a gateway and
+    the workers it spawned (the socket is only readable by the server user)."""
+    HEADER = struct.Struct("!I")
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    def send(self, *frame):
+        if self.writer.is_closing():
+            return
+        data = pickle.dumps(frame, pickle.HIGHEST_PROTOCOL)
+        self.writer.write(self.HEADER.pack(len(data)) + data)
+
+    async def recv(self):
+        """Next frame, or None once the other side is gone."""
+        try:
+            header = await self.reader.readexactly(self.HEADER.size)
+            return pickle.loads(await self.reader.readexactly(self.HEADER.unpack(header)[0]))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+
+    def close(self):
+        self.writer.close()
+
+class ShardConnection:
+    """Worker-side stand-in for a gateway's WebSocketAdapter: sends go back
+    over the link and the gateway queues them on the real connection (which
+    also does the snapshot coalescing, hence no backlog here)."""
+    backlog = 0
+
+    def __init__(self, link, conn_id, remote, binary=False):
+        self.link = link
+        self.conn_id = conn_id
+        self.remote = remote
+        self.binary = binary
+        self.closed = False
+        self.pending = None # last task of this connection, see ShardWorker._chain
+
+    async def send(self, data, table=None, snapshot=False):
+        self.send_nowait(data, table, snapshot)
+
+    def send_nowait(self, data, table=None, snapshot=False):
+        if not self.closed:
+            self.link.send("send", self.conn_id, data, table, snapshot)
+
+    def stop(self):
+        self.closed = True
+
+    async def close(self):
+        self.stop()
+        self.link.send("close", self.conn_id)
+
+    @property
+    def remote_address(self):
+        return self.remote
+
+class ShardWorker(PokerServer):
+    """Owns the tables the ring assigns to worker_id and runs them for the
+    gateway that spawned it, reusing the PokerServer handlers.
+
+    Gateway -> worker frames:
+      ("message", conn_id, user_id, remote, deltas, binary, raw)  routed client message, raw or decoded
+      ("attach", conn_id, user_id, remote, binary)                a seated user logged in again
+      ("disconnect", conn_id)
+      ("rebalance", request_id, workers, lost)                    new ring: migrate the tables we no longer own
+      ("adopt", table_id, table, seats)                           take over a migrated table
+      ("call", request_id, name, args)                            shard_<name>(*args)
+      ("stop",)
+    Worker -> gateway frames:
+      ("send", conn_id, data, table, snapshot)  ("close", conn_id)
+      ("seat", user_id, table_id or None)       ("migrate", table_id, table, seats)
+      ("result", request_id, ok, value)
+      ("lobby", lobby rows, admin rows)         changed rows, {table_id: (kind, row or None)} each
+    """
+    def __init__(self, worker_id, workers, create_defaults=True, data_dir=None, db_path=None):
+        self.worker_id = worker_id
+        self.ring = TableRing(workers)
+        self.create_defaults = create_defaults
+        super().__init__()
+        # The gateway's database and table files, wherever it keeps them
+        if data_dir:
+            self.data_dir = data_dir
+            self.store = TableStore(os.path.join(data_dir, "tables"), metrics=self.metrics)
+        # One hand log per worker: a log has a single writer
+        self.hand_history = HandHistory(os.path.join(self.data_dir, "hands", worker_id), source=int(worker_id[1:]) + 1)
+        if db_path:
+            self.db_path = db_path
+            self.db = DatabasePool(db_path, metrics=self.metrics)
+        self.proxies = {} # conn_id -> ShardConnection
+        self._gateway = None # ShardLink of the gateway, once connected
+        self._tasks = set()
+        self._stopped = asyncio.Event()
+
+    def _init_default_tables(self):
+        # Only at first start: a worker added later receives its tables by migration
+        if self.create_defaults:
+            self._restore_default_tables()
+
+    def _restore_default_tables(self, previous=None, lost=None):
+        for table_id, name, sb, bb, min_buy, max_buy in self.DEFAULT_TABLES:
+            if table_id in self.tables or self.ring.owner(table_id) != self.worker_id:
+                continue
+            if lost is None or previous.owner(table_id) == lost:
+                self.tables[table_id] = PokerTable(table_id, name, sb, bb, min_buy, max_buy)
+
+    async def serve(self, socket_path):
+        await self.init_db()
+        if self.create_defaults:
+            await self.restore_tables(owned=lambda table_id: self.ring.owner(table_id) == self.worker_id)
+        else:
+            self.store.open() # tables arrive by migration, with their files
+        snapshots = asyncio.ensure_future(self.store.run())
+        self.hand_history.open()
+        game_history = asyncio.ensure_future(self.game_history_loop())
+        lobby = asyncio.ensure_future(self.lobby_loop())
+        LookupHandEvaluator.build_tables()
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(socket_path)
+        server = await asyncio.start_unix_server(self._serve_link, path=socket_path)
+        os.chmod(socket_path, 0o600)
+        print(f"Shard worker {self.worker_id} (pid {os.getpid()}) serving {len(self.tables)} tables on {socket_path}")
+        await self._stopped.wait()
+        server.close()
+        snapshots.cancel()
+        self.store.flush()
+        game_history.cancel()
+        lobby.cancel()
+        self.hand_history.close()
+        with contextlib.suppress(Exception):
+            await self.flush_game_history()
+        self.timers.stop()
+        self.equity.shutdown()
+        await self.db.close()
+
+    def _spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def _chain(self, ws, fn, *args):
+        # One connection's messages run in arrival order, as they would on its websocket
+        previous = ws.pending
+
+        async def run():
+            if previous is not None:
+                await asyncio.wait([previous])
+            await fn(*args)
+        ws.pending = self._spawn(run())
+
+    def lobby_tick(self):
+        # The gateway keeps the lobby, the admin feed and their subscribers: changes go there
+        if self._gateway is None:
+            return # touched tables wait for the connection
+        self.lobby.refresh(self._describe_table)
+        self.admin_feed.tables.refresh(self._describe_admin_table)
+        lobby, admin = self.lobby.take(), self.admin_feed.tables.take()
+        if lobby or admin:
+            self._gateway.send("lobby", lobby, admin)
+
+    def _attach(self, link, conn_id, user_id, remote, binary=False):
+        ws = self.proxies.get(conn_id)
+        if ws is None:
+            ws = self.proxies[conn_id] = ShardConnection(link, conn_id, remote, binary)
+        if user_id:
+            self.connections[ws] = user_id
+            self.user_connections[user_id] = ws
+        return ws
+
+    async def _serve_link(self, reader, writer):
+        link = ShardLink(reader, writer)
+        self._gateway = link
+        try:
+            while (frame := await link.recv()) is not None:
+                kind = frame[0]
+                if kind == "message":
+                    _, conn_id, user_id, remote, deltas, binary, raw = frame
+                    ws = self._attach(link, conn_id, user_id, remote, binary)
+                    if deltas:
+                        self.delta_clients.setdefault(ws, None)
+                    self._chain(ws, self._handle_routed, ws, user_id, raw)
+                elif kind == "attach":
+                    self._attach(link, *frame[1:])
+                elif kind == "disconnect":
+                    ws = self.proxies.pop(frame[1], None)
+                    if ws is not None:
+                        self._chain(ws, self._handle_disconnect, ws)
+                elif kind == "rebalance":
+                    _, request_id, workers, lost = frame
+                    await self._rebalance(link, workers, lost)
+                    link.send("result", request_id, True, None)
+                elif kind == "adopt":
+                    await self._adopt(link, *frame[1:])
+                elif kind == "call":
+                    self._spawn(self._answer(link, *frame[1:]))
+                elif kind == "stop":
+                    break
+        finally:
+            # Gateway gone or stopping us: nobody is left to route to this worker
+            link.close()
+            self._stopped.set()
+
+    async def _handle_routed(self, ws, user_id, raw):
+        before = self.user_tables.get(user_id)
+        await self.handle_message(ws, raw)
+        after = self.user_tables.get(user_id)
+        if after != before:
+            ws.link.send("seat", user_id, after)
+
+    async def _answer(self, link, request_id, name, args):
+        try:
+            link.send("result", request_id, True, await getattr(self, f"shard_{name}")(*args))
+        except Exception as e:
+            link.send("result", request_id, False, str(e))
+
+    async def _rebalance(self, link, workers, lost):
+        # Let in-flight messages finish on the tables they started on
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        previous, self.ring = self.ring, TableRing(workers)
+        for table_id in [t for t in self.tables if self.ring.owner(t) != self.worker_id]:
+            table, seats = self._release_table(table_id)
+            link.send("migrate", table_id, table, seats)
+        if lost:
+            # The lost worker's tables come back from their files, default tables empty if they had none
+            await self.restore_tables(owned=lambda table_id: table_id not in self.tables and
+                                      self.ring.owner(table_id) == self.worker_id and previous.owner(table_id) == lost)
+            self._restore_default_tables(previous, lost)
+
+    def _release_table(self, table_id):
+        table = self.tables.pop(table_id)
+        self.store.release(table_id)
+        timer = self.table_timers.pop(table_id, None)
+        if timer is not None:
+            timer.cancel()
+        seats = {} # user_id -> (conn_id, remote, deltas, binary), None while disconnected
+        for uid in table.players:
+            self.user_tables.pop(uid, None)
+            ws = self.user_connections.get(uid)
+            seats[uid] = (ws.conn_id, ws.remote, ws in self.delta_clients, ws.binary) if ws is not None else None
+        return table, seats
+
+    async def _adopt(self, link, table_id, table, seats):
+        if table_id in self.tables:
+            return # Live copy wins over one recreated elsewhere (admin restore)
+        self.tables[table_id] = table
+        for uid, seat in seats.items():
+            self.user_tables[uid] = table_id
+            if seat is not None:
+                conn_id, remote, deltas, binary = seat
+                ws = self._attach(link, conn_id, uid, remote, binary)
+                if deltas:
+                    self.delta_clients[ws] = None # full snapshot first, deltas from there
+        if table.game_phase == "showdown":
+            self.timers.arm(8, self.restart_hand, table_id)
+        else:
+            self._start_turn_timer(table_id)
+        await self.broadcast_table_state(table_id)
+
+    async def shard_table_info(self, kind):
+        return await self._table_info(kind)
+
+    async def shard_close_table(self, table_id):
+        return await self._close_table(table_id)
+
+    async def shard_stats(self):
+        return {
+            "pid": os.getpid(),
+            "tables": len(self.tables),
+            "players": sum(len(t.players) for t in self.tables.values()),
+            "connections": len(self.proxies)
+        }
+
+def run_shard_worker(worker_id, socket_path, workers, create_defaults, data_dir, db_path):
+    # multiprocessing target: a fresh interpreter with its own event loop
+    with contextlib.suppress(KeyboardInterrupt):
+        asyncio.run(ShardWorker(worker_id, workers, create_defaults, data_dir, db_path).serve(socket_path))
+
+class ShardGateway(PokerServer):
+    """Terminates websockets and routes table traffic to shard worker processes.
+
+    Accounts, wallet, friends and the lobby are served here; every message
+    bound to a table goes to the worker that owns it (TableRing) over a Unix
+    socket, and what the worker sends comes back to the real connection.
+    Tables created here (private games, admin restores) are handed to their
+    owner right away. Adding or removing a worker migrates only the tables
+    that change owner, live hands included; a crashed worker's tables are
+    lost and its default tables recreated elsewhere.
+    """
+    GAME_ACTIONS = {'check', 'call', 'raise', 'fold', 'sitout', 'sitin'}
+    SEATED_ACTIONS = GAME_ACTIONS | {'leave_table'} # always the user's own table
+    ROUTED_ACTIONS = SEATED_ACTIONS | {'chat_message', 'get_table_state', 'join_cash_table', 'join_private_game',
+                                       'join_friend_game', 'delete_friend_game', 'get_hand_replay'}
+    START_TIMEOUT = 30.0 # seconds for a worker to open its socket
+
+    def __init__(self, workers: int):
+        super().__init__()
+        self.worker_count = workers
+        self.ring = TableRing()
+        self.workers = {} # worker_id -> {"process", "link", "reader", "draining"}
+        self._worker_ids = itertools.count()
+        self._requests = {} # request_id -> (worker_id, future)
+        self._request_ids = itertools.count(1)
+        self._membership = asyncio.Lock()
+        self._routable = asyncio.Event() # cleared while tables move between workers
+        self._routable.set()
+        self._conns = {} # conn_id -> WebSocketAdapter
+        self._attached = {} # conn_id -> worker_ids that know the connection
+        self._mp = multiprocessing.get_context("spawn")
+        self.metrics.counter("poker_routed_messages_total", "Client messages forwarded to a shard worker", ("worker",))
+        self.metrics.gauge("poker_shard_workers", "Running shard workers", lambda: len(self.workers))
+
+    def _init_default_tables(self):
+        pass # Each worker creates the default tables it owns
+
+    async def restore_tables(self, owned=None):
+        pass # Workers restore the tables they own
+
+    async def init_db(self):
+        await super().init_db() # Migrations run once, here, before any worker opens the database
+        ids = [f"w{next(self._worker_ids)}" for _ in range(self.worker_count)]
+        try:
+            await asyncio.gather(*(self._start_worker(wid, ids, True) for wid in ids))
+        except Exception:
+            await self.stop_workers()
+            raise
+        self.ring = TableRing(ids)
+
+    async def _start_worker(self, wid, ring_workers, create_defaults):
+        socket_dir = os.path.join(self.data_dir, "shards")
+        os.makedirs(socket_dir, exist_ok=True)
+        path = os.path.join(socket_dir, f"{os.getpid()}-{wid}.sock")
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path)
+        # Not a daemon: workers run their own equity process pools
+        process = self._mp.Process(target=run_shard_worker, name=f"poker-{wid}",
+                                   args=(wid, path, list(ring_workers), create_defaults, self.data_dir, self.db_path))
+        process.start()
+        deadline = time.monotonic() + self.START_TIMEOUT
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if not process.is_alive() or time.monotonic() > deadline:
+                    process.kill()
+                    raise RuntimeError(f"Shard worker {wid} did not start")
+                await asyncio.sleep(0.05)
+        link = ShardLink(reader, writer)
+        self.workers[wid] = {"process": process, "link": link, "draining": False}
+        self.workers[wid]["reader"] = asyncio.ensure_future(self._read_worker(wid, link))
+        print(f"Shard worker {wid} started (pid {process.pid})")
+
+    async def _read_worker(self, wid, link):
+        while (frame := await link.recv()) is not None:
+            kind = frame[0]
+            if kind == "send":
+                ws = self._conns.get(frame[1])
+                if ws is not None:
+                    ws.send_nowait(*frame[2:])
+            elif kind == "close":
+                ws = self._conns.get(frame[1])
+                if ws is not None:
+                    asyncio.ensure_future(ws.close())
+            elif kind == "seat":
+                _, user_id, table_id = frame
+                if table_id is None:
+                    self.user_tables.pop(user_id, None)
+                else:
+                    self.user_tables[user_id] = table_id
+            elif kind == "migrate":
+                self._send_table(*frame[1:])
+            elif kind == "result":
+                _, future = self._requests.pop(frame[1], (None, None))
+                if future is not None and not future.done():
+                    future.set_result(frame[2:])
+            elif kind == "lobby":
+                self.lobby.merge(wid, frame[1])
+                self.admin_feed.tables.merge(wid, frame[2])
+
+        link.close()
+        # Whatever it still reported is gone, or comes back from its new owner
+        self.lobby.drop(wid)
+        self.admin_feed.tables.drop(wid)
+        for request_id, (owner, future) in list(self._requests.items()):
+            if owner == wid:
+                del self._requests[request_id]
+                future.set_exception(ConnectionError(f"Shard worker {wid} is gone"))
+        worker = self.workers.get(wid)
+        if worker is not None and worker["link"] is link: # not a planned stop
+            print(f"Shard worker {wid} exited unexpectedly")
+            del self.workers[wid]
+            async with self._membership:
+                await self._rebalance(lost=wid)
+
+    def _send_table(self, table_id, table, seats):
+        owner = self.ring.owner(table_id)
+        if owner not in self.workers:
+            print(f"No shard worker left for table {table_id}")
+            return
+        self.workers[owner]["link"].send("adopt", table_id, table, seats)
+        for seat in seats.values():
+            if seat is not None:
+                self._attached.setdefault(seat[0], set()).add(owner)
+
+    def _ship_tables(self):
+        # Created here (private game, admin restore): the owner runs it from now on
+        for table_id in list(self.tables):
+            self._send_table(table_id, self.tables.pop(table_id), {})
+
+    async def _request(self, wid, kind, *args):
+        request_id = next(self._request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self._requests[request_id] = (wid, future)
+        self.workers[wid]["link"].send(kind, request_id, *args)
+        ok, value = await future
+        if not ok:
+            raise RuntimeError(value)
+        return value
+
+    async def _rebalance(self, lost=None):
+        self._routable.clear()
+        try:
+            self.ring = TableRing(wid for wid, w in self.workers.items() if not w["draining"])
+            await asyncio.gather(*(self._request(wid, "rebalance", self.ring.workers, lost) for wid in list(self.workers)),
+                                 return_exceptions=True)
+        finally:
+            self._routable.set()
+
+    async def add_worker(self):
+        async with self._membership:
+            wid = f"w{next(self._worker_ids)}"
+            await self._start_worker(wid, self.ring.workers + (wid,), False)
+            await self._rebalance()
+            return wid
+
+    async def remove_worker(self, wid):
+        async with self._membership:
+            worker = self.workers[wid]
+            worker["draining"] = True
+            await self._rebalance() # its tables move to the remaining workers
+            del self.workers[wid]
+            worker["link"].send("stop")
+            await worker["reader"]
+            await asyncio.get_running_loop().run_in_executor(None, worker["process"].join, 10)
+
+    async def stop_workers(self):
+        for wid in list(self.workers):
+            worker = self.workers.pop(wid)
+            worker["link"].send("stop")
+            await worker["reader"]
+            await asyncio.get_running_loop().run_in_executor(None, worker["process"].join, 10)
+
+    async def _route_key(self, user_id, action, data):
+        if action in self.SEATED_ACTIONS:
+            return self.user_tables.get(user_id)
+        if action in ('join_private_game', 'join_friend_game'):
+            async with self.db.read() as db:
+                cursor = await db.execute("SELECT id FROM private_games WHERE game_name = ? AND password = ?",
+                                          (str(data.get('game_name', '')).strip(), str(data.get('password', '')).strip()))
+                game = await cursor.fetchone()
+            return f"private_{game['id']}" if game else None
+        table_id = data.get('table_id')
+        return table_id if isinstance(table_id, str) else self.user_tables.get(user_id)
+
+    async def _route_owner(self, user_id, action, data):
+        if action == 'get_hand_replay':
+            # Replayed by the worker that logged the hand, see HandHistory
+            hand_id = data.get('hand_id')
+            return f"w{(hand_id >> 48) - 1}" if isinstance(hand_id, int) and hand_id >> 48 else None
+        table_id = await self._route_key(user_id, action, data)
+        await self._routable.wait()
+        return self.ring.owner(table_id) if table_id else None
+
+    async def handle_message(self, ws, message: str):
+        self._conns[ws.conn_id] = ws
+        try:
+            data = message if isinstance(message, dict) else self.json.loads(message)
+        except json.JSONDecodeError:
+            data = None
+        user_id = self.connections.get(ws)
+        if user_id and isinstance(data, dict):
+            action = data.get('action') or data.get('type', '')
+            if action in self.ROUTED_ACTIONS:
+                owner = await self._route_owner(user_id, action, data)
+                if owner in self.workers:
+                    self._attached.setdefault(ws.conn_id, set()).add(owner)
+                    self.metrics.inc("poker_routed_messages_total", (owner,))
+                    self.workers[owner]["link"].send("message", ws.conn_id, user_id, ws.remote_address,
+                                                     ws in self.delta_clients, getattr(ws, "binary", False), message)
+                    return
+                # No owner (not seated, unknown table): the local handler gives the usual error
+
+        await super().handle_message(ws, message)
+        self._ship_tables()
+
+        # Back after a reconnect while seated: the owner must send table updates to this connection
+        user_id = self.connections.get(ws)
+        table_id = self.user_tables.get(user_id)
+        owner = self.ring.owner(table_id) if table_id else None
+        if owner in self.workers and owner not in self._attached.get(ws.conn_id, ()):
+            self._attached.setdefault(ws.conn_id, set()).add(owner)
+            self.workers[owner]["link"].send("attach", ws.conn_id, user_id, ws.remote_address, getattr(ws, "binary", False))
+
+    async def _handle_disconnect(self, adapter):
+        self._conns.pop(adapter.conn_id, None)
+        for wid in self._attached.pop(adapter.conn_id, ()):
+            if wid in self.workers:
+                self.workers[wid]["link"].send("disconnect", adapter.conn_id)
+        await super()._handle_disconnect(adapter)
+
+    def _table_changed(self, table_id):
+        pass # Tables only pass through here: their owners report them
+
+    async def _table_info(self, kind):
+        parts = await asyncio.gather(*(self._request(wid, "call", "table_info", (kind,)) for wid in list(self.workers)),
+                                     return_exceptions=True)
+        rows = [row for part in parts if not isinstance(part, BaseException) for row in part]
+        return sorted(rows, key=self._lobby_order)
+
+    async def _close_table(self, table_id):
+        owner = self.ring.owner(table_id)
+        if owner not in self.workers:
+            return {"success": False, "error": "Table not found"}
+        result = await self._request(owner, "call", "close_table", (table_id,))
+        if result["success"]:
+            for uid in [uid for uid, tid in self.user_tables.items() if tid == table_id]:
+                del self.user_tables[uid]
+        return result
+
+    async def admin_restore_defaults(self, request):
+        response = await super().admin_restore_defaults(request)
+        self._ship_tables() # owners keep their live copy, see ShardWorker._adopt
+        return response
+
+    async def admin_reactivate_game(self, request):
+        response = await super().admin_reactivate_game(request)
+        self._ship_tables()
+        return response
+
+    async def admin_get_workers(self, request):
+        async def describe(wid, worker):
+            try:
+                stats = await self._request(wid, "call", "stats", ())
+            except Exception as e:
+                stats = {"error": str(e)}
+            return {"id": wid, "draining": worker["draining"], **stats}
+        workers = await asyncio.gather(*(describe(wid, w) for wid, w in list(self.workers.items())))
+        return web.json_response({"sharded": True, "ring": list(self.ring.workers), "workers": workers})
+
+    async def admin_add_worker(self, request):
+        try:
+            return web.json_response({"success": True, "worker": await self.add_worker()})
+        except Exception as e:
+            return web.json_response({"success": False, "error": str(e)}, status=500)
+
+    async def admin_remove_worker(self, request):
+        wid = request.match_info['id']
+        if wid not in self.workers:
+            return web.json_response({"success": False, "error": "Worker not found"}, status=404)
+        if len(self.workers) == 1:
+            return web.json_response({"success": False, "error": "Cannot remove the last worker"}, status=400)
+        await self.remove_worker(wid)
+        return web.json_response({"success": True})
 
 
 if __name__ == "__main__":
-    server = PokerServer()
+    workers = int(os.environ.get("POKER_WORKERS", 1))
+    server = ShardGateway(workers) if workers > 1 else PokerServer()
     asyncio.run(server.run())
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+"""
+Headless table simulation: plays complete hands straight through
+PokerTable.start_hand / handle_action with bot policies and a seeded RNG,
+no server and no sockets. Reports hands/second and checks that chips are
+conserved after every action and every hand, so it doubles as an engine fuzzer.
+
+    python simulate.py --hands 100000 --tables 8 --policies passive,random,aggressive
+    python simulate.py --hands 1000000 --workers 4           # one process per worker
+    python simulate.py --hands 50000 --profile               # time split per engine method
+    python simulate.py --hands 200000 --churn 0.05 --seed 7  # players leave/sit out/join mid hand
+
+On a failure the table, hand and seed are printed; rerunning with the same
+arguments replays the same hands.
+"""
+
+import argparse
+import multiprocessing
+import random
+import time
+from collections import defaultdict
+
+from server_online import LookupHandEvaluator, PokerTable
+
+PROFILED = ("start_hand", "handle_action", "_next_turn", "_next_phase", "run_out_street", "_evaluate_showdown", "publish", "get_state")
+MAX_ACTIONS = 1000 # per hand, anything longer is a stuck hand
+
+
+class SimulationError(Exception):
+    pass
+
+
+# ==========================================
+# POLICIES: (table, user_id, rng) -> (action, amount)
+# ==========================================
+
+def _to_call(table, player):
+    return table.current_bet - player['current_bet']
+
+def passive(table, uid, rng):
+    return ("check", 0) if _to_call(table, table.players[uid]) <= 0 else ("call", 0)
+
+def aggressive(table, uid, rng):
+    p = table.players[uid]
+    target = max(table.current_bet * 2, table.big_blind * 2)
+    if target - p['current_bet'] <= p['chips']:
+        return "raise", target
+    return "call", 0
+
+def allin(table, uid, rng):
+    p = table.players[uid]
+    return "raise", p['chips'] + p['current_bet']
+
+def random_policy(table, uid, rng):
+    """Any action with any amount, legal or not: rejected actions fall back to passive."""
+    p = table.players[uid]
+    r = rng.random()
+    if r < 0.15:
+        return "fold", 0
+    if r < 0.55:
+        return ("check", 0) if _to_call(table, p) <= 0 else ("call", 0)
+    if r < 0.65:
+        return rng.choice(("check", "call", "bet", "")), 0
+    top = p['chips'] + p['current_bet']
+    return "raise", rng.choice((top, rng.uniform(0, top * 1.2), table.current_bet * 2, rng.randint(0, int(top) + 1)))
+
+POLICIES = {"passive": passive, "aggressive": aggressive, "allin": allin, "random": random_policy}
+
+
+# ==========================================
+# PROFILER
+# ==========================================
+
+class Profiler:
+    """Wraps table methods on the instance: inclusive and self time per method."""
+    def __init__(self):
+        self.calls = defaultdict(int)
+        self.inclusive = defaultdict(float)
+        self.own = defaultdict(float)
+        self._stack = [] # child time of each open call
+
+    def wrap(self, table):
+        for name in PROFILED:
+            setattr(table, name, self._timed(name, getattr(table, name)))
+
+    def _timed(self, name, fn):
+        stack, clock = self._stack, time.perf_counter
+        def timed(*args, **kwargs):
+            stack.append(0.0)
+            start = clock()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed = clock() - start
+                child = stack.pop()
+                self.calls[name] += 1
+                self.inclusive[name] += elapsed
+                self.own[name] += elapsed - child
+                if stack:
+                    stack[-1] += elapsed
+        return timed
+
+    def snapshot(self):
+        return {name: (self.calls[name], self.inclusive[name], self.own[name]) for name in PROFILED}
+
+
+# ==========================================
+# DRIVER
+# ==========================================
+
+class TableSim:
+    """One table with its own RNG; keeps the chip ledger the engine is checked against."""
+    def __init__(self, index, seed, seats, policies, stack=100.0, blinds=(1, 2), churn=0.0, publish=True, profiler=None):
+        self.index = index
+        self.rng = random.Random(f"{seed}:{index}")
+        self.table = PokerTable(f"sim{index}", f"Sim {index}", blinds[0], blinds[1], stack, stack,
+                                max_players=seats, rng=self.rng)
+        if profiler:
+            profiler.wrap(self.table)
+        self.policies = policies
+        self.stack = stack
+        self.churn = churn
+        self.publish = publish
+        self.policy_of = {}
+        self.next_uid = 1
+        self.ledger = 0.0 # chips brought to the table minus chips taken away
+        self.hands = self.actions = self.rejected = 0
+        for _ in range(seats):
+            self.join()
+
+    def join(self):
+        uid = self.next_uid
+        self.next_uid += 1
+        self.policy_of[uid] = self.policies[uid % len(self.policies)]
+        self.ledger += self.stack
+        ok, _ = self.table.add_player(uid, f"bot{uid}", self.stack)
+        if not ok:
+            raise SimulationError(f"seat refused for bot{uid}")
+
+    def leave(self, uid):
+        self.ledger -= self.table.remove_player(uid)
+        del self.policy_of[uid]
+
+    def check_chips(self, where):
+        t = self.table
+        chips = sum(p['chips'] for p in t.players.values())
+        in_pot = t.pot if t.game_phase not in ("showdown", "waiting") else 0.0
+        if abs(chips + in_pot - self.ledger) > 1e-6 * max(1.0, self.ledger):
+            raise SimulationError(f"{where}: {chips:.4f} in stacks + {in_pot:.4f} in pot != {self.ledger:.4f} brought in")
+        for uid, p in t.players.items():
+            if p['chips'] < -1e-9:
+                raise SimulationError(f"{where}: bot{uid} has {p['chips']} chips")
+
+    def top_up(self):
+        # Busted (or short) bots rebuy so the table keeps playing
+        for p in self.table.players.values():
+            if p['chips'] < self.table.big_blind:
+                self.ledger += self.stack - p['chips']
+                p['chips'] = self.stack
+
+    def play_hand(self):
+        t = self.table
+        self.top_up()
+        if t.game_phase != "preflop": # add_player already dealt the first hand
+            t.start_hand()
+        self.hands += 1
+        self.check_chips("after blinds")
+        for step in range(MAX_ACTIONS):
+            if t.game_phase in ("showdown", "waiting"):
+                break
+            if t.running_out: # all-in: the server deals a street per timer tick
+                t.run_out_street()
+                self.check_chips("after run-out street")
+                continue
+            uid = t.current_player
+            if uid not in t.players or t.players[uid]['folded'] or t.players[uid]['all_in']:
+                raise SimulationError(f"{t.game_phase}: bot{uid} is asked to act")
+            if self.churn and self.rng.random() < self.churn:
+                gone = self.rng.choice(list(t.players))
+                if self.rng.random() < 0.5:
+                    t.sit_out(gone) # disconnect: still in the hand
+                    self.check_chips("after sit out")
+                else:
+                    self.leave(gone)
+                    self.check_chips("after leave")
+                continue
+            if t.players[uid]['is_sitting_out']: # what the server's turn timeout forces
+                action, amount = ("check" if _to_call(t, t.players[uid]) <= 0 else "fold"), 0
+            else:
+                action, amount = self.policy_of[uid](t, uid, self.rng)
+            ok, _ = t.handle_action(uid, action, amount)
+            if not ok:
+                self.rejected += 1
+                ok, message = t.handle_action(uid, *passive(t, uid, self.rng))
+                if not ok:
+                    raise SimulationError(f"{t.game_phase}: fallback {message!r} for bot{uid}")
+            self.actions += 1
+            if self.publish:
+                t.publish() # what every broadcast does
+            self.check_chips(f"after {action}")
+        else:
+            raise SimulationError(f"hand did not finish after {MAX_ACTIONS} actions")
+        self.check_chips("after hand")
+        # Disconnected bots come back, then fill the seats that emptied; a join at
+        # a waiting table deals the next hand
+        for uid, p in t.players.items():
+            if p['is_sitting_out']:
+                t.handle_action(uid, "sitin")
+        while self.churn and len(t.players) < t.max_players:
+            self.join()
+
+
+def run(args, worker=0):
+    """Plays this worker's share of hands; returns counters (and the profile)."""
+    policies = [POLICIES[name] for name in args.policies.split(",")]
+    LookupHandEvaluator.build_tables() # as the server does at startup, not on the first showdown
+    profiler = Profiler() if args.profile else None
+    first = worker * args.tables
+    sims = [TableSim(first + i, args.seed, args.seats, policies, churn=args.churn,
+                     publish=not args.no_publish, profiler=profiler)
+            for i in range(args.tables)]
+    hands = args.hands // args.workers + (1 if worker < args.hands % args.workers else 0)
+    start = time.perf_counter()
+    for n in range(hands):
+        sim = sims[n % len(sims)]
+        try:
+            sim.play_hand()
+        except SimulationError as e:
+            raise SimulationError(f"table {sim.index} hand {sim.hands} (seed {args.seed}): {e}") from None
+    return {
+        "elapsed": time.perf_counter() - start,
+        "hands": sum(s.hands for s in sims),
+        "actions": sum(s.actions for s in sims),
+        "rejected": sum(s.rejected for s in sims),
+        "profile": profiler.snapshot() if profiler else None,
+    }
+
+
+def merge(results):
+    total = {"elapsed": max(r["elapsed"] for r in results), "profile": None}
+    for key in ("hands", "actions", "rejected"):
+        total[key] = sum(r[key] for r in results)
+    profiles = [r["profile"] for r in results if r["profile"]]
+    if profiles:
+        total["profile"] = {name: tuple(sum(p[name][i] for p in profiles) for i in range(3)) for name in PROFILED}
+        total["cpu"] = sum(r["elapsed"] for r in results)
+    return total
+
+
+def simulate(args):
+    if args.workers > 1:
+        with multiprocessing.Pool(args.workers) as pool:
+            return merge(pool.starmap(run, [(args, w) for w in range(args.workers)]))
+    return merge([run(args)])
+
+
+def report(args, result):
+    elapsed = result["elapsed"]
+    print(f"{result['hands']} hands, {result['actions']} actions in {elapsed:.2f}s: "
+          f"{result['hands'] / elapsed:.0f} hands/s, {result['actions'] / elapsed:.0f} actions/s "
+          f"({args.workers} worker(s), {args.tables} table(s) each, {result['rejected']} rejected actions)")
+    if result["profile"]:
+        cpu = result["cpu"]
+        print(f"{'method':<20}{'calls':>11}{'incl s':>9}{'self s':>9}{'self %':>8}{'us/call':>9}")
+        for name, (calls, inclusive, own) in result["profile"].items():
+            print(f"{name:<20}{calls:>11}{inclusive:>9.2f}{own:>9.2f}{100 * own / cpu:>7.1f}%"
+                  f"{1e6 * inclusive / max(calls, 1):>9.2f}")
+        rest = cpu - sum(own for _, _, own in result["profile"].values())
+        print(f"{'driver + policies':<20}{'':>11}{'':>9}{rest:>9.2f}{100 * rest / cpu:>7.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--hands", type=int, default=100_000)
+    parser.add_argument("--tables", type=int, default=8, help="tables per worker")
+    parser.add_argument("--seats", type=int, default=6)
+    parser.add_argument("--policies", default="passive,random,aggressive,allin",
+                        help=f"comma separated, assigned round robin: {', '.join(POLICIES)}")
+    parser.add_argument("--churn", type=float, default=0.0, help="chance per action that a random player leaves or sits out")
+    parser.add_argument("--no-publish", action="store_true", help="engine only, no state snapshot per action")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--profile", action="store_true", help="time start_hand, handle_action, _next_turn, ...")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    for name in args.policies.split(","):
+        if name not in POLICIES:
+            parser.error(f"unknown policy {name!r}")
+
+    try:
+        result = simulate(args)
+    except SimulationError as e:
+        raise SystemExit(f"FAILED {e}")
+    report(args, result)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,11 @@
+import asyncio
+import itertools
+import os
+import random
 import unittest
-from server_online import Card, Deck, HandEvaluator
+from server_online import (Card, Deck, EquityCalculator, EquityService, HandEvaluator, LRUCache,
+                           LookupHandEvaluator, PokerTable, SERVER_CONFIG, EVALUATION_CACHE,
+                           canonical_mask, canonicalize, np)
 
 def C(rank_str, suit_str):
     rank_map = {
@@ -115,5 +121,285 @@ class TestPokerLogic(unittest.TestCase):
         
         self.assertGreater(score1, score2)
 
+class TestCardEncoding(unittest.TestCase):
+    def test_codes_round_trip(self):
+        codes = {Card(r, s) for r in range(2, 15) for s in Card.SUITS}
+        self.assertEqual(codes, set(range(52)))
+        card = C('T', 'hearts')
+        self.assertEqual((card.rank, card.suit), (10, 'h'))
+        self.assertEqual(Card.to_dict(int(card)), {"rank": "T", "suit": "h", "value": 10})
+        self.assertEqual(Card.codes_from_mask(Card.mask([card, C('A', 's')])), sorted([card, C('A', 's')]))
+
+    def test_deck_reshuffles_in_place(self):
+        deck = Deck()
+        cards = deck.cards
+        dealt = deck.deal(2) + deck.deal(5)
+        self.assertEqual(len(set(dealt)), 7)
+        self.assertEqual(len(deck.remaining()), 45)
+        deck.shuffle()
+        self.assertIs(deck.cards, cards)
+        self.assertEqual(sorted(deck.deal(52)), list(range(52)))
+
+    def test_checked_down_hand_reaches_showdown(self):
+        table = PokerTable("t", "Test", 1, 2, 10, 100)
+        table.add_player(1, "a", 100)
+        table.add_player(2, "b", 100)
+        table.handle_action(table.current_player, "call")
+        while table.game_phase != "showdown":
+            table.handle_action(table.current_player, "check")
+        self.assertEqual(len(table.community_cards), 5)
+        self.assertEqual(table.board_mask, Card.mask(table.community_cards))
+        self.assertAlmostEqual(sum(p['chips'] for p in table.players.values()), 200)
+        self.assertTrue(table.winners)
+
+    def test_players_can_leave_mid_hand(self):
+        table = PokerTable("t", "Test", 1, 2, 10, 100)
+        for uid in (1, 2, 3, 4):
+            table.add_player(uid, f"p{uid}", 50)
+        bystander = next(uid for uid in table.players if uid != table.current_player)
+        table.remove_player(bystander)
+        table.remove_player(table.current_player)
+        while table.game_phase not in ("showdown", "waiting"):
+            self.assertTrue(table.handle_action(table.current_player, "call")[0] or
+                            table.handle_action(table.current_player, "check")[0])
+        self.assertEqual(len(table.players), 2)
+
+    def test_leaving_out_of_turn_heads_up_awards_the_pot(self):
+        table = PokerTable("t", "Test", 1, 2, 10, 100)
+        table.add_player(1, "a", 100)
+        table.add_player(2, "b", 100)
+        waiting = next(uid for uid in table.players if uid != table.current_player)
+        self.assertEqual(table.remove_player(waiting), 98)
+        self.assertEqual(table.players[table.current_player]['chips'], 102)
+
+    def test_leaving_beside_a_sitting_out_contender_keeps_the_pot(self):
+        table = PokerTable("t", "Test", 1, 2, 10, 100)
+        for uid in (1, 2, 3):
+            table.add_player(uid, f"p{uid}", 100)
+        table.handle_action(table.current_player, "fold") # p3 sat down during the first hand
+        table.start_hand()
+        away, leaver = [uid for uid in table.active_seat_order if uid != table.current_player]
+        table.sit_out(away)
+        returned = table.remove_player(leaver)
+        self.assertNotEqual(table.game_phase, "waiting")
+        self.assertGreater(table.pot, 0)
+        while table.game_phase not in ("showdown", "waiting"): # the away player is checked or folded by the timer
+            uid = table.current_player
+            to_call = table.current_bet - table.players[uid]['current_bet']
+            action = ("check" if to_call <= 0 else "fold") if uid == away else ("check" if to_call <= 0 else "call")
+            self.assertTrue(table.handle_action(uid, action)[0])
+        self.assertAlmostEqual(sum(p['chips'] for p in table.players.values()) + returned, 300)
+
+    def test_short_all_in_does_not_lower_the_bet(self):
+        table = PokerTable("t", "Test", 1, 2, 10, 100)
+        for uid in (1, 2, 3):
+            table.add_player(uid, f"p{uid}", 100)
+        table.start_hand()
+        first = table.current_player
+        short = table.active_seat_order[(table.active_seat_order.index(first) + 1) % 3]
+        table.players[short]['chips'] = 10 - table.players[short]['current_bet']
+        self.assertTrue(table.handle_action(first, "raise", 40)[0])
+        self.assertTrue(table.handle_action(short, "raise", 10)[0])
+        self.assertTrue(table.players[short]['all_in'])
+        self.assertEqual(table.current_bet, 40)
+        self.assertEqual(table.game_phase, "preflop")
+
+    def test_unknown_action_is_rejected(self):
+        table = PokerTable("t", "Test", 1, 2, 10, 100)
+        table.add_player(1, "a", 100)
+        table.add_player(2, "b", 100)
+        first = table.current_player
+        self.assertEqual(table.handle_action(first, "bet"), (False, "Unknown action"))
+        self.assertEqual(table.current_player, first)
+
+class TestLookupEvaluator(unittest.TestCase):
+    # A hand's result only depends on its rank multiset, unless one suit holds
+    # 5+ cards; then (with at most 7 cards) it only depends on that suit's ranks.
+    # Covering every such class covers every possible 5, 6 and 7 card hand.
+
+    def assertSameAsLegacy(self, cards):
+        self.assertEqual(LookupHandEvaluator.evaluate(cards[:2], cards[2:]),
+                         HandEvaluator.evaluate_legacy(cards[:2], cards[2:]), cards)
+
+    def test_every_rank_multiset(self):
+        rng = random.Random(7)
+        for size in (5, 6, 7):
+            for ranks in itertools.combinations_with_replacement(range(2, 15), size):
+                if any(ranks.count(r) > 4 for r in set(ranks)):
+                    continue
+                while True:
+                    cards = [Card(r, s) for r in set(ranks) for s in rng.sample(Card.SUITS, ranks.count(r))]
+                    if max(sum(1 for c in cards if c.suit == s) for s in Card.SUITS) < 5:
+                        break
+                rng.shuffle(cards)
+                self.assertSameAsLegacy(cards)
+
+    def test_every_flush_rank_set(self):
+        rng = random.Random(11)
+        for size in (5, 6, 7):
+            for ranks in itertools.combinations(range(2, 15), size):
+                suit = rng.choice(Card.SUITS)
+                cards = [Card(r, suit) for r in ranks]
+                others = [Card(r, s) for r in range(2, 15) for s in Card.SUITS if s != suit]
+                cards += rng.sample(others, 7 - size)
+                rng.shuffle(cards)
+                self.assertSameAsLegacy(cards)
+
+    def test_short_hands_fall_back(self):
+        self.assertEqual(LookupHandEvaluator.evaluate([], []), (0, "No Hand"))
+        self.assertSameAsLegacy([C('A', 'h'), C('A', 'd'), C('K', 'c')])
+
+    @unittest.skipIf(np is None, "numpy not installed")
+    def test_batch_matches_scalar(self):
+        rng = random.Random(3)
+        for size in (5, 6, 7):
+            hands = [rng.sample(range(52), size) for _ in range(5000)]
+            scores = HandEvaluator.evaluate_batch(np.array(hands))
+            self.assertEqual(scores.tolist(), [HandEvaluator.evaluate(h[:2], h[2:])[0] for h in hands])
+        royal = [C('A', 'h'), C('K', 'h'), C('Q', 'h'), C('J', 'h'), C('T', 'h'), C('2', 'c'), C('3', 'd')]
+        self.assertEqual(HandEvaluator.category_name(HandEvaluator.evaluate_batch([royal])[0]), "Royal Flush")
+
+    @unittest.skipUnless(os.environ.get("POKER_EXHAUSTIVE_TESTS"), "set POKER_EXHAUSTIVE_TESTS=1 (takes ~30 minutes)")
+    def test_every_7_card_hand(self):
+        deck = [Card(r, s) for r in range(2, 15) for s in Card.SUITS]
+        for combo in itertools.combinations(deck, 7):
+            cards = list(combo)
+            self.assertSameAsLegacy(cards)
+
+class TestCanonicalization(unittest.TestCase):
+    def test_isomorphic_spots_share_a_representative(self):
+        spot = [[C('A', 'h'), C('K', 'h')], [C('Q', 's'), C('Q', 'c')], [C('2', 'h'), C('7', 'd')]]
+        for perm in itertools.permutations(range(4)):
+            permuted = [[(c & ~3) | perm[c & 3] for c in g] for g in spot]
+            self.assertEqual(canonicalize(permuted), canonicalize(spot))
+            self.assertEqual(canonical_mask(Card.mask(permuted[0] + permuted[2])),
+                             canonical_mask(Card.mask(spot[0] + spot[2])))
+
+    def test_different_spots_stay_different(self):
+        suited = [[C('A', 'h'), C('K', 'h')], [C('2', 'h'), C('7', 'h'), C('9', 'c')]]
+        offsuit = [[C('A', 'h'), C('K', 'd')], [C('2', 'h'), C('7', 'h'), C('9', 'c')]]
+        self.assertNotEqual(canonicalize(suited), canonicalize(offsuit))
+
+    def test_lru_cache_is_bounded(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3) # evicts b, the least recently used
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.stats(), {"size": 2, "maxsize": 2, "hits": 1, "misses": 1, "hit_rate": 0.5})
+
+    def test_legacy_evaluator_is_memoized(self):
+        previous = SERVER_CONFIG.get("hand_evaluator")
+        SERVER_CONFIG["hand_evaluator"] = "legacy"
+        try:
+            hole = [C('A', 'h'), C('A', 'd')]
+            board = [C('K', 'c'), C('K', 's'), C('Q', 'h'), C('2', 'c'), C('3', 'd')]
+            expected = HandEvaluator.evaluate_legacy(hole, board)
+            self.assertEqual(HandEvaluator.evaluate(hole, board), expected)
+            hits = EVALUATION_CACHE.hits
+            swapped = [C('A', 's'), C('A', 'c')], [C('K', 'd'), C('K', 'h'), C('Q', 's'), C('2', 'd'), C('3', 'c')]
+            self.assertEqual(HandEvaluator.evaluate(*swapped), expected)
+            self.assertEqual(EVALUATION_CACHE.hits, hits + 1)
+        finally:
+            SERVER_CONFIG["hand_evaluator"] = previous
+
+class TestEquity(unittest.TestCase):
+    def test_exact_on_the_flop(self):
+        hands = [[C('A', 'h'), C('A', 'd')], [C('K', 'c'), C('K', 's')]]
+        board = [C('2', 'c'), C('7', 'd'), C('9', 'h')]
+        result = EquityCalculator.compute(hands, board)
+        self.assertTrue(result['exact'])
+        self.assertEqual(result['runouts'], 990)
+        # KK needs one of the two kings (87 run-outs) but not with one of the two aces (4)
+        self.assertAlmostEqual(result['players'][1]['win'], (87 - 4) / 990)
+        self.assertAlmostEqual(sum(p['equity'] for p in result['players']), 1.0)
+
+    def test_scalar_and_batch_tallies_agree(self):
+        hands = [[C('A', 'h'), C('K', 'h')], [C('Q', 'c'), C('Q', 's')], [C('5', 'd'), C('4', 'd')]]
+        board = [C('Q', 'h'), C('J', 'h'), C('2', 'd'), C('3', 'c')]
+        runouts = [(c,) for c in range(52) if c not in {*board, *hands[0], *hands[1], *hands[2]}]
+        scalar = EquityCalculator._tally_scalar(hands, board, runouts)
+        if np is not None:
+            batch = EquityCalculator._tally_batch(hands, board, runouts)
+            self.assertEqual(scalar[:2], batch[:2])
+            for a, b in zip(scalar[2], batch[2]):
+                self.assertAlmostEqual(a, b)
+        self.assertAlmostEqual(sum(scalar[2]), len(runouts))
+
+    def test_monte_carlo_is_seeded(self):
+        hands = [[C('A', 'h'), C('A', 'd')], [C('K', 'c'), C('K', 's')]]
+        first = EquityCalculator.compute(hands, trials=3000, seed=5)
+        self.assertFalse(first['exact'])
+        self.assertEqual(first, EquityCalculator.compute(hands, trials=3000, seed=5))
+        self.assertGreater(first['players'][0]['equity'], 0.75)
+        self.assertLess(first['players'][0]['equity'], 0.88)
+
+    def test_canonical_key_ignores_suit_names(self):
+        a = EquityCalculator.canonical_key([[C('A', 'h'), C('K', 'h')], [C('Q', 's'), C('Q', 'c')]], [C('2', 'h')])
+        b = EquityCalculator.canonical_key([[C('A', 'd'), C('K', 'd')], [C('Q', 'c'), C('Q', 'h')]], [C('2', 'd')])
+        self.assertEqual(a, b)
+
+    def test_service_caches_isomorphic_spots(self):
+        service = EquityService(workers=1, cache=LRUCache(16))
+        try:
+            board = [C('2', 'c'), C('7', 'd'), C('9', 'h'), C('T', 's')]
+            first = asyncio.run(service.compute([[C('A', 'h'), C('A', 'd')], [C('K', 'c'), C('K', 's')]], board))
+            swapped = [C('2', 'd'), C('7', 'c'), C('9', 'h'), C('T', 's')]
+            second = asyncio.run(service.compute([[C('A', 'h'), C('A', 'c')], [C('K', 'd'), C('K', 's')]], swapped))
+            self.assertIs(first, second)
+            self.assertEqual((service.cache.hits, service.cache.misses), (1, 1))
+        finally:
+            service.shutdown()
+
+    def test_compute_cached_reuses_isomorphic_spots(self):
+        cache = LRUCache(16)
+        hands = [[C('A', 'h'), C('K', 'h')], [C('9', 'c'), C('9', 'd')]]
+        board = [C('2', 'h'), C('7', 'h'), C('J', 's')]
+        result = EquityCalculator.compute_cached(hands, board, cache=cache)
+        swapped = [[C('A', 's'), C('K', 's')], [C('9', 'h'), C('9', 'c')]]
+        self.assertIs(EquityCalculator.compute_cached(swapped, [C('2', 's'), C('7', 's'), C('J', 'd')], cache=cache), result)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def test_all_in_preflop_requests_equity_and_runs_out(self):
+        table = PokerTable("t", "Test", 1, 2, 10, 100)
+        table.add_player(1, "a", 100)
+        table.add_player(2, "b", 50)
+        first = table.current_player
+        table.handle_action(first, "raise", table.players[first]['chips'] + table.players[first]['current_bet'])
+        table.handle_action(table.current_player, "call")
+        self.assertEqual((table.game_phase, table.current_player, table.running_out), ("preflop", None, True))
+        self.assertEqual(table.equity_request['board'], [])
+        self.assertEqual(set(table.equity_request['hands']), {1, 2})
+        for phase, cards in (("flop", 3), ("turn", 4), ("river", 5)):
+            self.assertEqual(table.run_out_street(), (True, phase))
+            self.assertEqual(table.equity_request['board'], table.community_cards)
+            self.assertEqual(len(table.community_cards), cards)
+        self.assertEqual(table.run_out_street(), (True, "showdown"))
+        self.assertFalse(table.running_out)
+        self.assertTrue(table.winners)
+        self.assertFalse(table.run_out_street()[0])
+
+class TestSimulation(unittest.TestCase):
+    def test_fuzzed_hands_conserve_chips(self):
+        import argparse
+        import simulate
+        args = argparse.Namespace(hands=400, tables=3, seats=6, policies="random,allin,passive,aggressive",
+                                  churn=0.05, no_publish=False, workers=1, profile=True, seed=3)
+        result = simulate.run(args)
+        self.assertEqual(result["hands"], 400)
+        self.assertGreater(result["profile"]["_evaluate_showdown"][0], 0)
+        self.assertGreater(result["profile"]["get_state"][0], result["hands"])
+
+    def test_seeded_runs_repeat(self):
+        import simulate
+        runs = []
+        for _ in range(2):
+            sim = simulate.TableSim(0, 42, 4, [simulate.random_policy], churn=0.02)
+            for _ in range(50):
+                sim.play_hand()
+            runs.append(({uid: p['chips'] for uid, p in sim.table.players.items()}, sim.actions))
+        self.assertEqual(runs[0], runs[1])
+
 if __name__ == '__main__':
     unittest.main()
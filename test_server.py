@@ -0,0 +1,1121 @@
+import asyncio
+import contextlib
+import io
+import json
+import os
+import socket
+import sqlite3
+import tempfile
+import time
+import unittest
+import unittest.mock
+import aiohttp
+import aiosqlite
+import server_online
+from aiohttp import web
+from paypal_stub import make_app as make_paypal_stub
+from server_online import (BinaryFrame, BinaryProtocol, Card, DatabasePool, HandHistory, PasswordHasher, PayPalClient,
+                           PokerServer, PokerTable, ShardGateway, TableRing, TableStore, TimingWheel, WebSocketAdapter,
+                           SCHEMA_VERSION, apply_migrations)
+
+
+class FakeSocket:
+    backlog = 0
+
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, data, **kwargs):
+        self.sent.append(data)
+
+    async def close(self):
+        pass
+
+
+def seat_players(server, table_id, count):
+    sockets = {}
+    for uid in range(1, count + 1):
+        ws = FakeSocket()
+        sockets[uid] = ws
+        server.connections[ws] = uid
+        server.user_connections[uid] = ws
+        server.user_tables[uid] = table_id
+        server.tables[table_id].add_player(uid, f"player{uid}", 50.0)
+    return sockets
+
+
+class TestBroadcast(unittest.TestCase):
+    def setUp(self):
+        self.server = PokerServer()
+
+    def test_broadcast_matches_per_player_state(self):
+        table = self.server.tables['table_low']
+        sockets = seat_players(self.server, 'table_low', 4)
+        table.handle_action(table.current_player, "fold")
+        asyncio.run(self.server.broadcast_table_state('table_low'))
+        for uid, ws in sockets.items():
+            self.assertEqual(json.loads(ws.sent[-1]), {"type": "table_update", "table_state": table.get_state(uid)})
+
+    def test_showdown_cards_are_public(self):
+        table = self.server.tables['table_low']
+        sockets = seat_players(self.server, 'table_low', 2)
+        table.handle_action(table.current_player, "call")
+        while table.game_phase != "showdown":
+            table.handle_action(table.current_player, "check")
+        public, private = self.server._table_update_messages(table)
+        self.assertEqual(private, {})
+        self.assertEqual(json.loads(public)['table_state'], table.get_state(1))
+        asyncio.run(self.server.broadcast_table_state('table_low'))
+        self.assertEqual(sockets[1].sent[-1], sockets[2].sent[-1]) # one encoding for everyone
+
+    def test_usernames_cannot_forge_card_slots(self):
+        table = PokerTable("t", "Test", 1, 2, 10, 100)
+        self.server.tables["t"] = table
+        table.add_player(1, f'"@@{self.server._card_slot_nonce}:2@@"', 50)
+        table.add_player(2, "b", 50)
+        public, private = self.server._table_update_messages(table)
+        self.assertEqual(json.loads(private[1])['table_state'], table.get_state(1))
+        self.assertEqual(json.loads(private[2])['table_state'], table.get_state(2))
+
+
+def apply_delta(state, message):
+    for op in message['ops']:
+        if op[0] == "set":
+            state[op[1]] = op[2]
+        elif op[0] == "player":
+            players = {p['user_id']: p for p in state['players']}
+            if op[1] in players:
+                players[op[1]].update(op[2])
+            else:
+                state['players'].append(dict(op[2]))
+        elif op[0] == "remove_player":
+            state['players'] = [p for p in state['players'] if p['user_id'] != op[1]]
+    state['seq'] = message['seq']
+
+
+class TestTableDeltas(unittest.TestCase):
+    def setUp(self):
+        self.server = PokerServer()
+        self.table = self.server.tables['table_low']
+        self.sockets = seat_players(self.server, 'table_low', 3)
+        for ws in self.sockets.values():
+            asyncio.run(self.server.handle_enable_table_deltas(ws, {}))
+
+    def play(self, action):
+        asyncio.run(self.server.handle_game_action(self.sockets[self.table.current_player], {"action": action}))
+
+    def test_deltas_rebuild_each_players_view(self):
+        asyncio.run(self.server.broadcast_table_state('table_low'))
+        views = {uid: json.loads(ws.sent[-1])['table_state'] for uid, ws in self.sockets.items()}
+        for action in ["call", "fold", "check", "check", "check"]:
+            self.play(action)
+        for uid, ws in self.sockets.items():
+            for raw in ws.sent[1:]:
+                message = json.loads(raw)
+                self.assertEqual(message['type'], "table_delta")
+                self.assertEqual(message['base_seq'], views[uid]['seq'])
+                apply_delta(views[uid], message)
+            self.assertEqual(views[uid], self.table.get_state(uid))
+
+    def test_unchanged_state_sends_nothing(self):
+        asyncio.run(self.server.broadcast_table_state('table_low'))
+        asyncio.run(self.server.broadcast_table_state('table_low'))
+        self.assertEqual([len(ws.sent) for ws in self.sockets.values()], [1, 1, 1])
+
+    def test_gap_falls_back_to_full_snapshot(self):
+        asyncio.run(self.server.broadcast_table_state('table_low'))
+        ws = self.sockets[1]
+        self.server.delta_clients[ws] = ('table_low', 0) # client missed an update
+        self.play("call")
+        self.assertEqual(json.loads(ws.sent[-1])['type'], "table_update")
+        response = asyncio.run(self.server.handle_get_table_state(ws, {}))
+        self.assertEqual(self.server.delta_clients[ws], ('table_low', response['table_state']['seq']))
+
+    def test_legacy_clients_keep_full_updates(self):
+        legacy = self.sockets[2]
+        del self.server.delta_clients[legacy]
+        self.play("call")
+        message = json.loads(legacy.sent[-1])
+        self.assertEqual(message['type'], "table_update")
+        self.assertEqual(message['table_state'], self.table.get_state(2))
+
+
+class TestAllInRunOut(unittest.TestCase):
+    def test_equity_is_published_before_each_street_and_the_showdown(self):
+        server = PokerServer()
+        server.RUN_OUT_DELAY = 0.01
+        sockets = seat_players(server, 'table_low', 2)
+        table = server.tables['table_low']
+
+        async def equity(hands, board=(), dead=()):
+            return {"players": [{"win": 0.5, "tie": 0.0, "equity": 0.5}] * len(hands), "exact": True}
+
+        async def scenario():
+            first = table.current_player
+            await server.handle_game_action(sockets[first], {"action": "raise", "amount": 50.0})
+            await server.handle_game_action(sockets[table.current_player], {"action": "call"})
+            self.assertEqual((table.game_phase, table.running_out), ("preflop", True))
+            for _ in range(200):
+                if table.game_phase == "showdown":
+                    break
+                await asyncio.sleep(0.01)
+            server.timers.stop()
+
+        with unittest.mock.patch.object(server.equity, "compute", equity):
+            asyncio.run(scenario())
+        events = []
+        for raw in sockets[1].sent:
+            message = json.loads(raw)
+            if message['type'] == "equity_update":
+                events.append("equity")
+            elif message['type'] == "table_update":
+                state = message['table_state']
+                events.append((state['game_phase'], len(state['community_cards'])))
+                if state['game_phase'] == "showdown":
+                    self.assertIsNone(state['equity'])
+        run_out = events[events.index("equity") - 1:]
+        self.assertEqual(run_out, [("preflop", 0), "equity", ("flop", 3), "equity", ("turn", 4), "equity",
+                                   ("river", 5), "equity", ("showdown", 5)])
+
+
+class SlowWebSocket:
+    """aiohttp WebSocketResponse stand-in whose sends block until released."""
+    def __init__(self):
+        self.sent = []
+        self.gate = asyncio.Event()
+        self.closed = False
+
+    async def send_str(self, data):
+        await self.gate.wait()
+        self.sent.append(data)
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeRequest:
+    remote = "127.0.0.1"
+
+
+class TestSendQueues(unittest.TestCase):
+    def test_slow_client_does_not_block_and_snapshots_coalesce(self):
+        async def scenario():
+            raw = SlowWebSocket()
+            adapter = WebSocketAdapter(raw, FakeRequest())
+            await adapter.send("hello")
+            await asyncio.sleep(0) # writer picks up "hello" and blocks
+            await adapter.send("delta-1", table="t")
+            await adapter.send("chat")
+            await adapter.send("full-1", table="t", snapshot=True)
+            await adapter.send("full-2", table="t", snapshot=True)
+            await adapter.send("other-table", table="u", snapshot=True)
+            self.assertEqual(adapter.backlog, 3)
+            raw.gate.set()
+            for _ in range(10):
+                await asyncio.sleep(0)
+            adapter.stop()
+            return raw.sent
+        self.assertEqual(asyncio.run(scenario()), ["hello", "chat", "full-2", "other-table"])
+
+    def test_client_over_the_queue_limit_is_disconnected(self):
+        async def scenario():
+            raw = SlowWebSocket()
+            adapter = WebSocketAdapter(raw, FakeRequest())
+            for i in range(WebSocketAdapter.MAX_QUEUE + 5):
+                await adapter.send(f"chat {i}")
+            await asyncio.sleep(0)
+            return raw, adapter
+        raw, adapter = asyncio.run(scenario())
+        self.assertTrue(adapter.closed)
+        self.assertTrue(raw.closed)
+
+    def test_only_large_messages_are_deflated(self):
+        server = PokerServer()
+        big = json.dumps({"type": "admin_broadcast", "message": "tavolo " * 2000})
+
+        async def scenario():
+            app = web.Application()
+            app.router.add_get("/ws", server.handle_websocket_request)
+            runner = web.AppRunner(app)
+            await runner.setup()
+            site = web.TCPSite(runner, "127.0.0.1", 0)
+            await site.start()
+            port = site._server.sockets[0].getsockname()[1]
+            try:
+                async with aiohttp.ClientSession() as session:
+                    async with session.ws_connect(f"http://127.0.0.1:{port}/ws", compress=15) as ws:
+                        await ws.receive() # connection ack
+                        await ws.send_str('{"action": "ping"}')
+                        pong = json.loads((await ws.receive()).data)
+                        adapter, = server.sockets
+                        self.assertTrue(adapter.compressed)
+                        await adapter.send(big)
+                        received = (await ws.receive()).data
+            finally:
+                await runner.cleanup()
+            return pong, received
+        with unittest.mock.patch("builtins.print"):
+            pong, received = asyncio.run(scenario())
+        self.assertEqual(pong, {"type": "pong"})
+        self.assertEqual(received, big)
+        messages, compressed, payload, wire, seconds = server.wire_stats["pong"]
+        self.assertEqual((messages, compressed, payload), (1, 0, len('{"type":"pong"}')))
+        self.assertGreater(wire, payload) # frame header, no deflate
+        messages, compressed, payload, wire, seconds = server.wire_stats["admin_broadcast"]
+        self.assertEqual((messages, compressed), (1, 1))
+        self.assertLess(wire, payload // 10)
+        self.assertEqual(WebSocketAdapter.message_type(BinaryFrame(b"\x03")), "chat_message (binary)")
+
+    def test_broadcast_replaces_backlogged_deltas_with_snapshot(self):
+        server = PokerServer()
+        sockets = seat_players(server, 'table_low', 2)
+        ws = sockets[1]
+        server.delta_clients[ws] = None
+        asyncio.run(server.broadcast_table_state('table_low'))
+        ws.backlog = WebSocketAdapter.COALESCE_AFTER + 1
+        table = server.tables['table_low']
+        table.handle_action(table.current_player, "call")
+        asyncio.run(server.broadcast_table_state('table_low'))
+        self.assertEqual(json.loads(ws.sent[-1])['type'], "table_update")
+
+
+def temp_server(testcase):
+    tmp = tempfile.TemporaryDirectory()
+    testcase.addCleanup(tmp.cleanup)
+    server = PokerServer()
+    server.db_path = os.path.join(tmp.name, "poker.db")
+    server.db = DatabasePool(server.db_path, readers=2)
+    return server
+
+
+def register_data(i):
+    return {"email": f"user{i}@example.com", "username": f"user{i}", "password": "secret123",
+            "security_question": "pet", "security_answer": "rex"}
+
+
+class TestDatabasePool(unittest.TestCase):
+    def test_handlers_share_persistent_connections(self):
+        server = temp_server(self)
+
+        async def scenario():
+            await server.init_db()
+            regs = await asyncio.gather(*(server.handle_register(FakeSocket(), register_data(i)) for i in range(8)))
+            logins = await asyncio.gather(*(
+                server.handle_login(FakeSocket(), {"email": f"user{i}@example.com", "password": "secret123"})
+                for i in range(8)))
+            stats = server.db.stats()
+            await server.db.close()
+            return regs, logins, stats
+        regs, logins, stats = asyncio.run(scenario())
+        self.assertTrue(all(r["success"] for r in regs))
+        self.assertTrue(all(l["success"] for l in logins))
+        self.assertEqual(len({l["user_id"] for l in logins}), 8)
+        self.assertGreaterEqual(stats["write"]["acquired"], 16)
+        self.assertGreaterEqual(stats["read"]["acquired"], 16)
+        self.assertEqual(stats["read"]["in_use"] + stats["write"]["in_use"], 0)
+
+    def test_readers_are_query_only_and_writes_roll_back(self):
+        server = temp_server(self)
+
+        async def scenario():
+            await server.init_db()
+            async with server.db.read() as db:
+                with self.assertRaises(sqlite3.OperationalError):
+                    await db.execute("DELETE FROM users")
+            async with server.db.write() as db:
+                await db.execute("INSERT INTO users (email, username, password_hash, security_question, security_answer) "
+                                 "VALUES ('a@b.c', 'abc', 'x', 1, 'y')")
+                # No commit: the pool must not leak the open transaction to the next user
+            async with server.db.read() as db:
+                cursor = await db.execute("SELECT COUNT(*) FROM users")
+                count = (await cursor.fetchone())[0]
+            async with server.db.write() as db:
+                cursor = await db.execute("PRAGMA journal_mode")
+                mode = (await cursor.fetchone())[0]
+            await server.db.close()
+            return count, mode
+        count, mode = asyncio.run(scenario())
+        self.assertEqual(count, 0)
+        self.assertEqual(mode, "wal")
+
+
+class TestMigrations(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, "poker.db")
+
+    def run_on_db(self, fn):
+        async def scenario():
+            async with aiosqlite.connect(self.path) as db:
+                return await fn(db)
+        return asyncio.run(scenario())
+
+    async def version_and_indexes(self, db):
+        version = (await (await db.execute("PRAGMA user_version")).fetchone())[0]
+        cursor = await db.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'idx_%'")
+        return version, {row[0] for row in await cursor.fetchall()}
+
+    def test_fresh_database_is_migrated_once(self):
+        self.assertEqual(self.run_on_db(apply_migrations), list(range(1, SCHEMA_VERSION + 1)))
+        self.assertEqual(self.run_on_db(apply_migrations), [])
+        version, indexes = self.run_on_db(self.version_and_indexes)
+        self.assertEqual(version, SCHEMA_VERSION)
+        self.assertIn("idx_transactions_user_created", indexes)
+
+    def test_legacy_database_gains_column_and_indexes(self):
+        async def legacy(db):
+            await db.execute("CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, email TEXT UNIQUE NOT NULL, "
+                             "username TEXT UNIQUE NOT NULL, password_hash TEXT NOT NULL, security_question INTEGER NOT NULL, "
+                             "security_answer TEXT NOT NULL)")
+            await db.execute("INSERT INTO users (email, username, password_hash, security_question, security_answer) "
+                             "VALUES ('a@b.c', 'abc', 'x', 1, 'y')")
+            await db.commit()
+            await apply_migrations(db)
+            cursor = await db.execute("SELECT is_banned FROM users")
+            return (await cursor.fetchone())[0]
+        self.assertEqual(self.run_on_db(legacy), 0)
+        self.assertEqual(self.run_on_db(self.version_and_indexes)[0], SCHEMA_VERSION)
+
+    def test_failed_migration_rolls_back(self):
+        self.run_on_db(lambda db: apply_migrations(db, 2))
+        broken = (SCHEMA_VERSION + 1, "broken", ["CREATE TABLE extra (id INTEGER)", "NOT SQL"])
+        original = server_online.MIGRATIONS
+        server_online.MIGRATIONS = original + [broken]
+        self.addCleanup(setattr, server_online, "MIGRATIONS", original)
+        with self.assertRaises(sqlite3.OperationalError):
+            self.run_on_db(lambda db: apply_migrations(db, SCHEMA_VERSION + 1))
+        # Migrations below the broken one committed; the broken one left nothing behind
+        version, indexes = self.run_on_db(self.version_and_indexes)
+        self.assertEqual(version, SCHEMA_VERSION)
+        tables = self.run_on_db(lambda db: db.execute_fetchall("SELECT name FROM sqlite_master WHERE name = 'extra'"))
+        self.assertEqual(list(tables), [])
+
+
+class TestPasswords(unittest.TestCase):
+    def test_hashes_are_salted_and_verify(self):
+        a, b = PasswordHasher.hash_sync("secret123"), PasswordHasher.hash_sync("secret123")
+        self.assertNotEqual(a, b)
+        self.assertTrue(a.startswith("scrypt$"))
+        self.assertEqual(PasswordHasher.verify_sync("secret123", a), (True, False))
+        self.assertEqual(PasswordHasher.verify_sync("wrong", a), (False, False))
+        self.assertEqual(PasswordHasher.verify_sync("secret123", None), (False, False))
+
+    def test_legacy_hash_is_upgraded_on_login(self):
+        server = temp_server(self)
+        legacy = PasswordHasher.legacy_hash("secret123")
+
+        async def scenario():
+            await server.init_db()
+            async with server.db.write() as db:
+                await db.execute("INSERT INTO users (email, username, password_hash, security_question, security_answer) "
+                                 "VALUES ('old@example.com', 'old', ?, 1, 'y')", (legacy,))
+                await db.commit()
+            wrong = await server.handle_login(FakeSocket(), {"email": "old@example.com", "password": "nope123"})
+            first = await server.handle_login(FakeSocket(), {"email": "old@example.com", "password": "secret123"})
+            async with server.db.read() as db:
+                stored = (await (await db.execute("SELECT password_hash FROM users")).fetchone())[0]
+            second = await server.handle_login(FakeSocket(), {"email": "old@example.com", "password": "secret123"})
+            await server.db.close()
+            return wrong, first, stored, second
+        wrong, first, stored, second = asyncio.run(scenario())
+        self.assertFalse(wrong["success"])
+        self.assertTrue(first["success"])
+        self.assertTrue(stored.startswith("scrypt$"))
+        self.assertTrue(second["success"])
+
+    def test_upgrade_does_not_undo_a_concurrent_reset(self):
+        server = temp_server(self)
+        legacy = PasswordHasher.legacy_hash("secret123")
+        hash_password = server.passwords.hash
+
+        async def reset_meanwhile(password):
+            new_hash = await hash_password(password)
+            async with server.db.write() as db: # a reset_password committing while login hashes
+                await db.execute("UPDATE users SET password_hash = 'reset'")
+                await db.commit()
+            return new_hash
+
+        async def scenario():
+            await server.init_db()
+            async with server.db.write() as db:
+                await db.execute("INSERT INTO users (email, username, password_hash, security_question, security_answer) "
+                                 "VALUES ('old@example.com', 'old', ?, 1, 'y')", (legacy,))
+                await db.commit()
+            with unittest.mock.patch.object(server.passwords, "hash", reset_meanwhile):
+                login = await server.handle_login(FakeSocket(), {"email": "old@example.com", "password": "secret123"})
+            async with server.db.read() as db:
+                stored = (await (await db.execute("SELECT password_hash FROM users")).fetchone())[0]
+            await server.db.close()
+            return login, stored
+        login, stored = asyncio.run(scenario())
+        self.assertTrue(login["success"])
+        self.assertEqual(stored, "reset")
+
+    def test_change_password(self):
+        server = temp_server(self)
+
+        async def scenario():
+            await server.init_db()
+            ws = FakeSocket()
+            await server.handle_register(ws, register_data(1))
+            await server.handle_login(ws, {"email": "user1@example.com", "password": "secret123"})
+            bad = await server.handle_change_password(ws, {"old_password": "nope123", "new_password": "another1"})
+            good = await server.handle_change_password(ws, {"old_password": "secret123", "new_password": "another1"})
+            login = await server.handle_login(FakeSocket(), {"email": "user1@example.com", "password": "another1"})
+            await server.db.close()
+            return bad, good, login
+        bad, good, login = asyncio.run(scenario())
+        self.assertFalse(bad["success"])
+        self.assertTrue(good["success"])
+        self.assertTrue(login["success"])
+
+
+class TestTimingWheel(unittest.TestCase):
+    def test_timers_fire_in_order_across_levels(self):
+        # 4 slots per level: delays up to 0.64s cross both cascades
+        wheel = TimingWheel(tick=0.01, slots=(4, 4, 4))
+        fired = []
+
+        async def scenario():
+            loop = asyncio.get_running_loop()
+            start = loop.time()
+            for delay in (0.5, 0.02, 0.9, 0.15, 0.07, 0.33):
+                wheel.arm(delay, lambda d: fired.append((d, loop.time() - start)), delay)
+            await asyncio.sleep(1.1)
+            wheel.stop()
+        asyncio.run(scenario())
+        self.assertEqual([d for d, _ in fired], [0.02, 0.07, 0.15, 0.33, 0.5, 0.9])
+        for delay, at in fired:
+            self.assertGreaterEqual(at, delay - 1e-3)
+            self.assertLess(at, delay + 0.1)
+        self.assertEqual(wheel.stats()["armed"], 0)
+        self.assertEqual(wheel.stats()["fired"], 6)
+
+    def test_cancel_and_coroutine_callbacks(self):
+        wheel = TimingWheel(tick=0.01, slots=(8, 8))
+        fired = []
+
+        async def later(tag):
+            fired.append(tag)
+
+        async def scenario():
+            keep = wheel.arm(0.05, later, "keep")
+            drop = wheel.arm(0.05, later, "drop")
+            drop.cancel()
+            drop.cancel()
+            self.assertEqual(wheel.armed, 1)
+            await asyncio.sleep(0.15)
+            wheel.stop()
+            return keep
+        keep = asyncio.run(scenario())
+        self.assertEqual(fired, ["keep"])
+        self.assertFalse(keep.active)
+        self.assertEqual(wheel.stats()["cancelled"], 1)
+
+    def test_turn_timeout_forces_action(self):
+        server = PokerServer()
+        server.timers = TimingWheel(tick=0.01)
+        table = server.tables['table_low']
+        seat_players(server, 'table_low', 2)
+
+        async def scenario():
+            first = table.current_player
+            with unittest.mock.patch.dict("server_online.SERVER_CONFIG", {"turn_timer": 0.05}):
+                server._start_turn_timer('table_low')
+            # The re-armed timer for the next player uses the normal timeout
+            await asyncio.sleep(0.2)
+            server.timers.stop()
+            return first
+        first = asyncio.run(scenario())
+        self.assertTrue(table.players[first]['is_sitting_out'])
+        self.assertTrue(table.players[first]['folded'])
+
+
+async def with_paypal_stub(fn, **stub_options):
+    app = make_paypal_stub(seed=1, **stub_options)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    client = PayPalClient(api_base=f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}",
+                          client_id="test", secret="test")
+    client.BACKOFF = 0.001
+    try:
+        return await fn(client), app["stats"], client.stats
+    finally:
+        await client.close()
+        await runner.cleanup()
+
+
+class TestPayPalClient(unittest.TestCase):
+    def test_concurrent_calls_share_one_token(self):
+        async def flows(client):
+            orders = await asyncio.gather(*(client.create_order(5.0) for _ in range(20)))
+            return [await client.capture_order(o["id"]) for o in orders]
+        captures, stub, client = asyncio.run(with_paypal_stub(flows))
+        self.assertTrue(all(c["status"] == "COMPLETED" for c in captures))
+        self.assertEqual(stub["token"], 1)
+        self.assertEqual(client["token_refreshes"], 1)
+
+    def test_server_errors_are_retried(self):
+        async def flows(client):
+            return await asyncio.gather(*(client.create_payout("a@b.c", 1.0) for _ in range(30)))
+        payouts, stub, client = asyncio.run(with_paypal_stub(flows, fail_rate=0.2))
+        self.assertTrue(all("batch_header" in p for p in payouts))
+        self.assertGreater(stub["injected_failures"], 0)
+        self.assertEqual(client["retries"], stub["injected_failures"])
+
+    def test_rejected_token_is_refreshed(self):
+        async def flow(client):
+            client.access_token = "revoked"
+            client.token_expires = time.time() + 3600
+            return await client.create_order(5.0)
+        order, stub, _ = asyncio.run(with_paypal_stub(flow))
+        self.assertEqual(order["status"], "CREATED")
+        self.assertEqual(stub["token"], 1)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_actions_db_time_and_broadcasts_are_recorded(self):
+        server = temp_server(self)
+        server.db.metrics = server.metrics
+        sockets = seat_players(server, 'table_low', 2)
+        table = server.tables['table_low']
+
+        async def scenario():
+            await server.init_db()
+            ws = FakeSocket()
+            await server.handle_message(ws, json.dumps({"action": "ping"}))
+            await server.handle_message(ws, json.dumps({"action": "login", "email": "x@y.z", "password": "secret123"}))
+            await server.handle_message(ws, json.dumps({"action": "nope"}))
+            await server.handle_message(ws, "{broken")
+            await server.handle_message(sockets[table.current_player], json.dumps({"action": "call"}))
+            await server.db.close()
+        asyncio.run(scenario())
+
+        m = server.metrics
+        self.assertEqual(m.value("poker_action_seconds", ("ping",))[0], 1)
+        self.assertEqual(m.value("poker_action_errors_total", ("login", "rejected")), 1)
+        self.assertEqual(m.value("poker_action_errors_total", ("unknown", "rejected")), 1)
+        self.assertEqual(m.value("poker_action_errors_total", ("invalid_json", "rejected")), 1)
+        self.assertGreaterEqual(m.value("poker_db_seconds", ("login", "read"))[0], 1)
+        self.assertGreaterEqual(m.value("poker_broadcast_recipients")[0], 1)
+
+        text = m.render()
+        self.assertIn('poker_action_seconds_bucket{action="call",le="+Inf"} 1', text)
+        self.assertIn('poker_tables{phase="preflop"}', text)
+        self.assertIn("poker_connections 0", text)
+
+
+class TestDispatch(unittest.TestCase):
+    def test_fields_are_validated_before_the_handler(self):
+        server = PokerServer()
+        sockets = seat_players(server, 'table_low', 2)
+        table = server.tables['table_low']
+        ws = sockets[table.current_player]
+
+        async def scenario():
+            await server.handle_message(ws, json.dumps({"action": "raise", "amount": "big"}))
+            await server.handle_message(ws, json.dumps({"action": "raise", "amount": "0.4"})) # strings still float()
+            await server.handle_message(ws, json.dumps([1, 2]))
+        asyncio.run(scenario())
+        replies = [json.loads(raw) for raw in ws.sent if b'"table_update"' not in raw]
+        self.assertEqual(replies[0], {"type": "error", "success": False, "error": "Campo non valido: amount"})
+        self.assertEqual(replies[1], {"type": "action_result", "success": True})
+        self.assertEqual(replies[2]["error"], "Invalid JSON")
+        self.assertEqual(server.metrics.value("poker_action_errors_total", ("raise", "rejected")), 1)
+
+    def test_codecs_agree(self):
+        message = {"type": "x", "text": "più", "ids": {7: [1.5, None, True]}}
+        for codec in server_online.JSON_CODECS.values():
+            encoded = codec.dumps(message)
+            self.assertIsInstance(encoded, bytes)
+            self.assertEqual(codec.loads(encoded), json.loads(encoded))
+            self.assertEqual(json.loads(encoded), json.loads(json.dumps(message)))
+        self.assertIs(server_online.json_codec("json"), server_online.StdlibJson)
+
+
+class TestBinaryProtocol(unittest.TestCase):
+    def test_table_update_roundtrip(self):
+        server = PokerServer()
+        seat_players(server, 'table_low', 3)
+        table = server.tables['table_low']
+        table.handle_action(table.current_player, "raise", 0.5)
+        state = table.get_state(1)
+        frame, _ = BinaryProtocol.encode_table_update(state)
+        state['pot'] = round(state['pot'], 2) # money travels in cents
+        self.assertEqual(BinaryProtocol.decode_table_update(frame), state)
+        self.assertLess(len(frame), len(json.dumps(state)) / 4)
+
+    def test_binary_and_json_clients_share_a_table(self):
+        server = PokerServer()
+        sockets = seat_players(server, 'table_low', 3)
+        sockets[2].binary = True
+        table = server.tables['table_low']
+
+        async def scenario():
+            await server.broadcast_table_state('table_low')
+            await server.handle_message(sockets[2], BinaryProtocol.decode_request(
+                BinaryProtocol.encode_chat_request('table_low', "ciao")))
+        with unittest.mock.patch.object(server.db, "read") as read:
+            read.return_value.__aenter__.return_value.execute = unittest.mock.AsyncMock(
+                return_value=unittest.mock.Mock(fetchone=unittest.mock.AsyncMock(return_value=("user2",))))
+            asyncio.run(scenario())
+
+        update = sockets[2].sent[0]
+        self.assertIsInstance(update, server_online.BinaryFrame)
+        seen = {p['user_id']: p['cards'] for p in BinaryProtocol.decode_table_update(update)['players']}
+        self.assertEqual(seen[2], [Card.to_dict(c) for c in table.players[2]['cards']])
+        self.assertEqual(seen[1][0]['rank'], "?")
+        self.assertEqual(json.loads(sockets[1].sent[0]), {"type": "table_update", "table_state": table.get_state(1)})
+        self.assertEqual(BinaryProtocol.decode_chat(sockets[2].sent[1])['message'], "ciao")
+        self.assertEqual(json.loads(sockets[1].sent[1])['message'], "ciao")
+        self.assertEqual(json.loads(sockets[2].sent[2]), {"type": "chat_sent", "success": True})
+
+    def test_subprotocol_is_negotiated_at_connect(self):
+        server = PokerServer()
+
+        async def scenario():
+            app = web.Application()
+            app.router.add_get("/ws", server.handle_websocket_request)
+            runner = web.AppRunner(app)
+            await runner.setup()
+            site = web.TCPSite(runner, "127.0.0.1", 0)
+            await site.start()
+            port = site._server.sockets[0].getsockname()[1]
+            replies = {}
+            try:
+                async with aiohttp.ClientSession() as session:
+                    for name, protocols in (("json", ()), ("binary", (BinaryProtocol.SUBPROTOCOL,))):
+                        async with session.ws_connect(f"http://127.0.0.1:{port}/ws", protocols=protocols) as ws:
+                            ack = json.loads((await ws.receive()).data)
+                            await ws.send_bytes(BinaryProtocol.encode_action("fold"))
+                            await ws.send_str('{"action": "ping"}')
+                            replies[name] = (ack['protocol'], json.loads((await ws.receive()).data))
+            finally:
+                await runner.cleanup()
+            return replies
+        with unittest.mock.patch("builtins.print"):
+            replies = asyncio.run(scenario())
+        self.assertEqual(replies["json"], ("json", {"type": "pong"})) # binary frames ignored
+        self.assertEqual(replies["binary"], ("binary", {"type": "error", "error": "Non autenticato"}))
+
+
+class TestBenchSuite(unittest.TestCase):
+    def test_compare_flags_slowdowns_over_threshold(self):
+        import bench_suite
+        rows, regressions = bench_suite.compare({"a": 10.0, "b": 10.0}, {"a": 12.0, "b": 13.0, "c": 1.0}, 0.25)
+        self.assertEqual(regressions, ["b"])
+        self.assertEqual(rows[2], ("c", None, 1.0, None))
+
+    def test_only_selects_suites_and_benchmarks(self):
+        import argparse
+        import contextlib
+        import io
+        import bench_suite
+        args = argparse.Namespace(only=["deck", "get_state 2"], repeat=1, seed=1, users=20)
+        with bench_suite.RESOURCES, contextlib.redirect_stderr(io.StringIO()):
+            results, ops = bench_suite.run(args)
+        self.assertEqual(set(results), {"deck create", "deck shuffle + deal 6 players", "get_state 2 players"})
+        self.assertTrue(all(us > 0 for us in results.values()))
+
+
+class TestTableStore(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = os.path.join(tmp.name, "tables")
+
+    def journaled_server(self):
+        server = PokerServer()
+        server.store = TableStore(self.dir)
+        server.store.open()
+        return server
+
+    def play_hands(self, server, hands):
+        table = server.tables['table_low']
+        for uid in (1, 2, 3):
+            server._apply(table, "add_player", uid, f"player{uid}", 50.0)
+        actions = iter(["call", "raise", "fold", "call", "check", "check", "call"] * 100)
+        while table.hand_number <= hands:
+            if table.game_phase in ("waiting", "showdown"):
+                server.store.tick() # snapshots land between hands, the rest stays in the journal
+                server._apply(table, "start_hand")
+                continue
+            action = next(actions)
+            amount = table.current_bet * 2 if action == "raise" else 0
+            if not server._apply(table, "handle_action", table.current_player, action, amount)[0]:
+                server._apply(table, "handle_action", table.current_player, "fold")
+        return table
+
+    def test_restore_replays_journal_and_deck_order(self):
+        server = self.journaled_server()
+        table = self.play_hands(server, 5)
+        self.assertGreater(server.store.dirty, 0)
+
+        restored = self.journaled_server()
+        asyncio.run(restored.restore_tables())
+        copy = restored.tables['table_low']
+        for uid in (1, 2, 3):
+            theirs, ours = copy.get_state(uid), table.get_state(uid)
+            for p in theirs['players'] + ours['players']:
+                p.pop('is_sitting_out')
+            self.assertEqual(theirs, ours)
+        self.assertEqual(copy.deck.remaining(), table.deck.remaining())
+        self.assertTrue(all(p['is_sitting_out'] for p in copy.players.values()))
+        self.assertEqual(restored.user_tables, {1: 'table_low', 2: 'table_low', 3: 'table_low'})
+        self.assertEqual(restored.store.dirty, 0)
+
+    def test_unreplayable_table_is_refunded_once(self):
+        server = self.journaled_server()
+        table = self.play_hands(server, 2)
+        server._apply(table, "handle_action", table.current_player, "call")
+        with open(os.path.join(self.dir, "table_low.log"), "ab") as f:
+            f.write(b"[999,\"drop_table\",[],null]\n")
+        chips = sum(p['chips'] for p in table.players.values()) + table.pot
+
+        restored = temp_server(self)
+        restored.store = TableStore(self.dir)
+
+        async def scenario():
+            await restored.init_db()
+            for i in (1, 2, 3):
+                await restored.handle_register(FakeSocket(), register_data(i))
+            await restored.restore_tables()
+            await restored._refund_table(table) # same journal position: already paid
+            async with restored.db.read() as db:
+                cursor = await db.execute("SELECT SUM(balance) FROM wallets")
+                balance = (await cursor.fetchone())[0]
+            await restored.db.close()
+            return balance
+        self.assertAlmostEqual(asyncio.run(scenario()), chips)
+        self.assertNotIn('table_low', restored.store.table_ids())
+        self.assertEqual(restored.tables['table_low'].players, {}) # the fresh default table
+
+
+class TestHandHistory(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = os.path.join(tmp.name, "hands")
+
+    def test_hands_are_logged_replayed_and_recorded(self):
+        server = temp_server(self)
+        server.hand_history = HandHistory(self.dir)
+
+        async def scenario():
+            await server.init_db()
+            sockets = {}
+            for i in (1, 2, 3):
+                sockets[i] = FakeSocket()
+                await server.handle_register(sockets[i], register_data(i))
+                server.connections[sockets[i]] = i
+            server.hand_history.open()
+            table = server.tables['table_low']
+            server._apply(table, "add_player", 1, "user1", 50.0)
+            server._apply(table, "add_player", 2, "user2", 50.0) # deals hand 1
+            server._apply(table, "handle_action", table.current_player, "fold")
+            server._apply(table, "start_hand")
+            while table.game_phase != "showdown":
+                player = table.players[table.current_player]
+                server._apply(table, "handle_action", table.current_player,
+                              "call" if player['current_bet'] < table.current_bet else "check")
+            server.hand_history.flush()
+            self.addCleanup(server.hand_history.close)
+
+            first, second = reversed(server.hand_history.hands(table_id='table_low'))
+            self.assertEqual(server.hand_history.hands(user_id=1), [second, first])
+            self.assertEqual(server.hand_history.hands(user_id=3), [])
+            folded = (await server.handle_get_hand_replay(sockets[1], {"hand_id": first}))['states']
+            shown = await server.handle_get_hand_replay(sockets[1], {"hand_id": second})
+            self.assertEqual(shown['hand_number'], 2)
+            self.assertTrue(all(p['cards'][0]['rank'] != "?" for p in shown['states'][-1]['players']))
+            self.assertEqual(sum(p['cards'][0]['rank'] == "?" for p in folded[-1]['players']), 1)
+            self.assertEqual(shown['states'][-1]['pot'], 0)
+            self.assertEqual({p['user_id']: p['chips'] for p in shown['states'][-1]['players']},
+                             {uid: round(p['chips'], 2) for uid, p in table.players.items()})
+            self.assertFalse((await server.handle_get_hand_replay(sockets[3], {"hand_id": first}))['success'])
+
+            await server.flush_game_history()
+            async with server.db.read() as db:
+                cursor = await db.execute("SELECT hand_id, SUM(chips_change) FROM game_history GROUP BY hand_id ORDER BY hand_id")
+                per_hand = [tuple(r) for r in await cursor.fetchall()]
+                cursor = await db.execute("SELECT SUM(games_played), SUM(games_won) FROM statistics")
+                stats = tuple(await cursor.fetchone())
+            await server.db.close()
+            return first, second, per_hand, stats
+        first, second, per_hand, stats = asyncio.run(scenario())
+        self.assertEqual(per_hand, [(first, 0), (second, 0)])
+        self.assertEqual(stats[0], 4)
+        self.assertIn(stats[1], (1, 2)) # the showdown may be a split
+
+    def test_shutdown_writes_what_is_still_queued(self):
+        server = temp_server(self)
+        server.data_dir = self.dir
+        server.store = TableStore(os.path.join(self.dir, "tables"))
+        server.hand_history = HandHistory(os.path.join(self.dir, "hands"))
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+
+        async def scenario():
+            serving = asyncio.ensure_future(server.run(host="127.0.0.1", port=port))
+            while True:
+                with contextlib.suppress(OSError):
+                    _, writer = await asyncio.open_connection("127.0.0.1", port)
+                    writer.close()
+                    break
+                await asyncio.sleep(0.05)
+            for i in (1, 2):
+                await server.handle_register(FakeSocket(), register_data(i))
+            table = server.tables['table_low']
+            server._apply(table, "add_player", 1, "user1", 50.0)
+            server._apply(table, "add_player", 2, "user2", 50.0)
+            server._apply(table, "handle_action", table.current_player, "fold")
+            serving.cancel() # as Ctrl+C does under asyncio.run
+            with contextlib.suppress(asyncio.CancelledError):
+                await serving
+        with contextlib.redirect_stdout(io.StringIO()):
+            asyncio.run(scenario())
+        with sqlite3.connect(server.db_path) as db:
+            self.assertEqual(db.execute("SELECT COUNT(*) FROM game_history").fetchone()[0], 2)
+        self.assertEqual(server.store.dirty, 0)
+        log = HandHistory(os.path.join(self.dir, "hands"))
+        log.open()
+        self.addCleanup(log.close)
+        self.assertEqual(len(log.hands(table_id='table_low')), 1)
+
+    def test_segments_roll_over_and_the_index_is_rebuilt(self):
+        def events(hand):
+            seats = [(7, 0, 50.0), (8, 1, 49.9 + hand)]
+            return [("start", 1000.0 + hand, 0, seats), ("deal", 7, 0, 1), ("deal", 8, 50, 51),
+                    ("blind", 7, 0.1), ("blind", 8, 0.2), ("raise", 7, 0.5), ("call", 8, 0.4),
+                    ("board", [2, 3, 4]), ("check", 8), ("fold", 7), ("win", 8, 1.2)]
+
+        log = HandHistory(self.dir, segment_size=4096)
+        log.open()
+        ids = [log.submit("table_a" if i % 2 else "table_b", i, events(i)) for i in range(100)]
+        log.close()
+
+        log = HandHistory(self.dir, segment_size=4096)
+        log.open()
+        self.addCleanup(log.close)
+        self.assertGreater(log.stats()["segments"], 1)
+        self.assertEqual(log.hands(table_id="table_a", limit=1000), ids[1::2][::-1])
+        self.assertEqual(log.hands(user_id=8, table_id="table_b", limit=3), ids[0::2][::-1][:3])
+        hand = log.read(ids[42])
+        self.assertEqual((hand['table_id'], hand['hand_number'], hand['seats'][1]['chips']), ("table_b", 42, 91.9))
+        self.assertEqual(hand['events'], [tuple(e) for e in events(42)[1:]])
+        recent = log.hands(since=hand['ended'], limit=1000)
+        self.assertEqual(recent[-1], ids[42])
+        self.assertEqual(log.submit("table_a", 100, events(100)), ids[-1] + 1)
+
+
+class GatewaySocket(FakeSocket):
+    remote_address = "test"
+
+    def __init__(self):
+        super().__init__()
+        self.conn_id = next(WebSocketAdapter._ids)
+
+    def send_nowait(self, data, table=None, snapshot=False):
+        self.sent.append(data)
+
+    async def reply(self, type_, after=0, timeout=10.0):
+        # Routed messages are answered by a worker process, asynchronously
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            for raw in self.sent[after:]:
+                message = json.loads(raw)
+                if message.get("type") == type_:
+                    return message
+            await asyncio.sleep(0.01)
+        raise AssertionError(f"no {type_} in {self.sent[after:]}")
+
+
+class TestLobby(unittest.TestCase):
+    def test_subscribers_get_coalesced_changes(self):
+        server = PokerServer()
+        ws = GatewaySocket()
+        self.assertFalse(asyncio.run(server.handle_subscribe_lobby(ws, {}))["success"])
+        server.connections[ws] = 1
+        server.lobby_tick()
+        snapshot = asyncio.run(server.handle_subscribe_lobby(ws, {}))
+        self.assertEqual([t["table_id"] for t in snapshot["cash_tables"]], [t[0] for t in server.DEFAULT_TABLES])
+        self.assertEqual(snapshot["friend_games"], [])
+
+        table = server.tables['table_low']
+        for uid in (1, 2):
+            server._apply(table, "add_player", uid, f"player{uid}", 10.0)
+        server._apply(server.tables['table_high'], "add_player", 3, "player3", 20.0)
+        server._apply(server.tables['table_high'], "remove_player", 3)
+        private = PokerTable('private_7', "Amici", 0.1, 0.2, 5.0, 5.0)
+        private.is_private = True
+        server.tables['private_7'] = private
+        del server.tables['table_vip']
+        server.lobby_tick()
+        server.lobby_tick() # nothing new: nothing sent
+        self.assertEqual(len(ws.sent), 1)
+        update = json.loads(ws.sent[0])
+        self.assertEqual(update["type"], "lobby_update")
+        self.assertEqual([(t["table_id"], t["players"]) for t in update["cash_tables"]["upsert"]], [("table_low", 2)])
+        self.assertEqual(update["cash_tables"]["remove"], ["table_vip"])
+        self.assertEqual([g["id"] for g in update["friend_games"]["upsert"]], ["private_7"])
+
+        asyncio.run(server.handle_unsubscribe_lobby(ws, {}))
+        server._apply(table, "remove_player", 2)
+        server.lobby_tick()
+        self.assertEqual(len(ws.sent), 1)
+
+    def test_merged_rows_belong_to_the_last_reporter(self):
+        lobby = server_online.Lobby()
+        row = {"table_id": "table_low", "players": 2}
+        lobby.merge("w0", {"table_low": ("cash_tables", row)})
+        lobby.merge("w1", {"table_low": ("cash_tables", row)}) # migrated: the new owner reports first
+        lobby.merge("w0", {"table_low": ("cash_tables", None)})
+        self.assertEqual(lobby.rows, {"table_low": ("cash_tables", row)})
+        self.assertEqual(list(lobby.take()), ["table_low"])
+        lobby.drop("w0")
+        self.assertEqual(lobby.take(), {})
+        lobby.drop("w1")
+        self.assertEqual(lobby.take(), {"table_low": ("cash_tables", None)})
+
+
+class TestAdminFeed(unittest.TestCase):
+    def test_panel_gets_snapshot_then_changes(self):
+        server = temp_server(self)
+
+        async def scenario():
+            await server.init_db()
+            app = web.Application()
+            app.router.add_get("/api/admin/feed", server.admin_get_feed)
+            app.on_shutdown.append(server._close_admin_feed)
+            runner = web.AppRunner(app)
+            await runner.setup()
+            site = web.TCPSite(runner, "127.0.0.1", 0)
+            await site.start()
+            port = site._server.sockets[0].getsockname()[1]
+            events = []
+            try:
+                async with aiohttp.ClientSession() as session:
+                    async with session.get(f"http://127.0.0.1:{port}/api/admin/feed") as resp:
+                        async def event():
+                            name, data = (await resp.content.readuntil(b"\n\n")).decode().strip().split("\n")
+                            return name.removeprefix("event: "), json.loads(data.removeprefix("data: "))
+                        events.append(await event())
+                        server._apply(server.tables['table_low'], "add_player", 5, "player5", 10.0)
+                        server.user_connections[5] = FakeSocket()
+                        await server.admin_feed_tick()
+                        events.append(await event())
+                        del server.user_connections[5]
+                        await server.admin_feed_tick()
+                        events.append(await event())
+            finally:
+                await runner.cleanup()
+                await server.db.close()
+            return events
+        with unittest.mock.patch("builtins.print"):
+            (first, snapshot), (second, update), (third, offline) = asyncio.run(scenario())
+        self.assertEqual((first, second, third), ("snapshot", "update", "update"))
+        self.assertEqual([t["id"] for t in snapshot["tables"]], [t[0] for t in server.DEFAULT_TABLES])
+        self.assertEqual((snapshot["online"], snapshot["withdrawals"]), ([], []))
+        self.assertIn("poker_connections", snapshot["metrics"])
+        self.assertEqual([(t["id"], t["players"]) for t in update["tables"]["upsert"]], [("table_low", 1)])
+        self.assertEqual((update["online"], update["offline"]), ([5], []))
+        self.assertNotIn("withdrawals", update)
+        self.assertEqual((offline["online"], offline["offline"]), ([], [5]))
+        self.assertNotIn("tables", offline)
+
+    def test_panel_that_falls_behind_is_dropped(self):
+        feed = server_online.AdminFeed()
+        slow, fast = feed.join(), feed.join()
+        feed.publish(None, b"{}")
+        fast.get_nowait()
+        for i in range(feed.QUEUE):
+            feed.publish(b"{}", None)
+            fast.get_nowait()
+        self.assertEqual(feed.clients, {fast})
+        self.assertEqual((slow.qsize(), slow.get_nowait()), (1, None))
+
+
+class TestSharding(unittest.TestCase):
+    def test_ring_moves_only_the_tables_of_a_new_worker(self):
+        tables = [f"private_{i}" for i in range(4000)]
+        before = TableRing(["w0", "w1", "w2"])
+        after = TableRing(["w3", "w1", "w0", "w2"])
+        moved = [t for t in tables if before.owner(t) != after.owner(t)]
+        self.assertTrue(all(after.owner(t) == "w3" for t in moved))
+        self.assertAlmostEqual(len(moved) / len(tables), 0.25, delta=0.03)
+
+    def test_tables_run_on_workers_and_move_with_live_hands(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        server = ShardGateway(2)
+        server.data_dir = tmp.name
+        server.db_path = os.path.join(tmp.name, "poker.db")
+        server.db = DatabasePool(server.db_path, readers=2)
+
+        async def scenario():
+            await server.init_db()
+            try:
+                sockets = {}
+                for i in (1, 2):
+                    ws = GatewaySocket()
+                    await server.handle_message(ws, json.dumps({"action": "register", **register_data(i)}))
+                    await server.handle_message(ws, json.dumps({"action": "login", "email": f"user{i}@example.com",
+                                                                "password": "secret123"}))
+                    sockets[server.connections[ws]] = ws
+                async with server.db.write() as db:
+                    await db.execute("UPDATE wallets SET balance = 100")
+                    await db.commit()
+                for ws in sockets.values():
+                    await server.handle_message(ws, json.dumps({"action": "join_cash_table", "table_id": "table_low",
+                                                                "buy_in": 10}))
+                    await ws.reply("cash_table_joined")
+                self.assertEqual(set(server.user_tables.values()), {"table_low"})
+
+                lobby = await server.handle_get_cash_tables(None, {})
+                self.assertEqual([t["table_id"] for t in lobby["tables"]], [t[0] for t in server.DEFAULT_TABLES])
+                self.assertEqual(next(t for t in lobby["tables"] if t["table_id"] == "table_low")["players"], 2)
+
+                # Drain the owner: the hand in progress continues on another worker
+                await server.add_worker()
+                owner = server.ring.owner("table_low")
+                await server.remove_worker(owner)
+                self.assertNotEqual(server.ring.owner("table_low"), owner)
+                ws = next(iter(sockets.values()))
+                mark = len(ws.sent)
+                await server.handle_message(ws, json.dumps({"action": "get_table_state"}))
+                state = (await ws.reply("table_state_response", mark))["table_state"]
+                self.assertEqual(state["game_phase"], "preflop")
+
+                actor = sockets[state["current_player"]]
+                mark = len(actor.sent)
+                await server.handle_message(actor, json.dumps({"action": "call"}))
+                self.assertTrue((await actor.reply("action_result", mark))["success"])
+                mark = len(ws.sent)
+                await server.handle_message(ws, json.dumps({"action": "get_table_state"}))
+                state = (await ws.reply("table_state_response", mark))["table_state"]
+                self.assertNotEqual(sockets[state["current_player"]], actor)
+                self.assertAlmostEqual(state["pot"], 0.4)
+                self.assertAlmostEqual(sum(p["chips"] for p in state["players"]) + state["pot"], 20.0)
+
+                # The lobby rows reported by the workers survive the move
+                for _ in range(50):
+                    row = server.lobby.rows.get("table_low")
+                    if row and row[1]["status"] != "waiting" and len(server.lobby.rows) == 5:
+                        break
+                    await asyncio.sleep(0.1)
+                snapshot = await server.handle_subscribe_lobby(ws, {})
+                self.assertEqual([t["table_id"] for t in snapshot["cash_tables"]], [t[0] for t in server.DEFAULT_TABLES])
+                self.assertEqual(snapshot["cash_tables"][1]["players"], 2)
+                self.assertEqual(server.admin_feed.tables.rows["table_low"][1]["players"], 2)
+            finally:
+                await server.stop_workers()
+                await server.db.close()
+        asyncio.run(scenario())
+
+
+if __name__ == '__main__':
+    unittest.main()